@@ -1,19 +1,28 @@
+import asyncio
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
+from ..db.redis import redis_client
+from ..services.metrics import MATCH_ATTEMPTS
 from ..services.queue import (
     join_queue,
-    leave_all_queues,
+    keep_alive,
+    stage_leave_all_queues,
     try_match,
-    is_on_cooldown,
-    is_specific_filter_allowed,
     increment_specific_filter_usage,
-    get_active_match
+    get_active_match,
+    MATCHMAKER_ENABLED,
 )
-from ..services.moderation import is_banned, get_ban_reason
-from ..services.user_store import get_gender, get_preference
+from ..services.user_state import load_user_state
+from ..services.user_store import get_gender, stage_preference
+from ..ws.connection_manager import manager
 
 router = APIRouter(prefix="/match", tags=["Match"])
 
+LONG_POLL_MAX_SECONDS = 30
+# A match made on another worker can't wake this one's waiters, so
+# long-polls still re-read the pairing from Redis at this interval.
+LONG_POLL_RECHECK_SECONDS = 5
+
 
 class MatchRequest(BaseModel):
     device_id: str
@@ -23,14 +32,16 @@ class MatchRequest(BaseModel):
 
 class MatchStatusRequest(BaseModel):
     device_id: str
+    wait: float = 0  # seconds to block until matched (long-poll)
 
 
 @router.post("/find")
-def find_match(data: MatchRequest):
-    if is_banned(data.device_id):
+async def find_match(data: MatchRequest):
+    state = await load_user_state(data.device_id)
+    if state.banned:
         raise HTTPException(
             status_code=403,
-            detail=f"Account suspended: {get_ban_reason(data.device_id)}"
+            detail=f"Account suspended: {state.ban_reason}"
         )
 
     preference = data.preference.strip().lower()
@@ -40,70 +51,99 @@ def find_match(data: MatchRequest):
             detail="Invalid preference. Use male, female, or any."
         )
 
+    # All writes before matching go out in one pipeline
+    pipe = redis_client.pipeline()
+
     # Update preference immediately (before cooldown check)
-    from ..services.user_store import set_preference
-    set_preference(data.device_id, preference)
+    stage_preference(pipe, data.device_id, preference)
 
     # Skip cooldown check for "Next" auto-find (continuing to chat, not spam)
-    if not data.is_next and is_on_cooldown(data.device_id):
+    if not data.is_next and state.on_cooldown:
+        await pipe.execute()
         raise HTTPException(
             status_code=429,
             detail="Cooldown active. Please wait."
         )
 
-    if not is_specific_filter_allowed(data.device_id, preference):
+    if not state.is_specific_filter_allowed(preference):
+        await pipe.execute()
         raise HTTPException(
             status_code=429,
             detail="Daily limit reached for specific gender filters."
         )
 
-    leave_all_queues(data.device_id)
-    match = try_match(data.device_id, preference)
+    stage_leave_all_queues(pipe, data.device_id)
+    await pipe.execute()
+
+    # With the batch matchmaker on, pairing happens only in its passes
+    match = None
+    if not MATCHMAKER_ENABLED:
+        match = await try_match(data.device_id, preference, gender=state.gender)
 
     if match:
-        increment_specific_filter_usage(data.device_id, preference)
+        MATCH_ATTEMPTS.inc("matched")
+        await increment_specific_filter_usage(data.device_id, preference)
+        # Tell the partner who was waiting in the queue right away
+        await manager.notify_matched(match, data.device_id)
         return {
             "status": "matched",
             "partner_id": match
         }
 
-    joined = join_queue(data.device_id, preference)
+    joined = await join_queue(data.device_id, preference, gender=state.gender)
     if not joined:
         raise HTTPException(
             status_code=400,
             detail="Gender not verified. Complete verification first."
         )
+    MATCH_ATTEMPTS.inc("queued")
     return {
         "status": "queued"
     }
 
 
 @router.post("/status")
-def match_status(data: MatchStatusRequest):
-    partner_id = get_active_match(data.device_id)
-    if partner_id:
-        return {
-            "status": "matched",
-            "partner_id": partner_id
-        }
-    return {"status": "waiting"}
+async def match_status(data: MatchStatusRequest):
+    """
+    Returns the current match. With `wait` > 0 this is a long-poll: it
+    blocks until a match is made or the wait expires. Polling keeps the
+    device's presence and queue lease alive for clients without a socket.
+    """
+    await keep_alive(data.device_id)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + min(max(data.wait, 0), LONG_POLL_MAX_SECONDS)
+    while True:
+        partner_id = await get_active_match(data.device_id)
+        if partner_id:
+            return {
+                "status": "matched",
+                "partner_id": partner_id
+            }
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return {"status": "waiting"}
+        await manager.wait_for_match(
+            data.device_id,
+            min(remaining, LONG_POLL_RECHECK_SECONDS)
+        )
 
 
 @router.post("/debug")
-def debug_status(data: MatchStatusRequest):
+async def debug_status(data: MatchStatusRequest):
     """Debug endpoint to check user state."""
+    state = await load_user_state(data.device_id)
     return {
         "device_id": data.device_id,
-        "gender": get_gender(data.device_id),
-        "preference": get_preference(data.device_id),
-        "banned": is_banned(data.device_id),
-        "cooldown": is_on_cooldown(data.device_id),
-        "active_match": get_active_match(data.device_id),
+        "gender": state.gender,
+        "preference": state.preference,
+        "banned": state.banned,
+        "cooldown": state.on_cooldown,
+        "active_match": state.active_match,
     }
 
 
 @router.post("/test-match")
-def test_match(data: MatchStatusRequest):
+async def test_match(data: MatchStatusRequest):
     """
     TEST ONLY: Simulate a second user joining the queue to trigger a match.
     Use this to test matching without needing 2 browser windows.
@@ -112,20 +152,21 @@ def test_match(data: MatchStatusRequest):
     test_user_id = "test-user-" + data.device_id[:8]
     
     # Save fake user's gender (opposite of first user) and preference
-    user_gender = get_gender(data.device_id)
+    user_gender = await get_gender(data.device_id)
     test_gender = "female" if user_gender == "male" else "male"
     
     from ..services.user_store import save_gender, set_preference
-    save_gender(test_user_id, test_gender)
-    set_preference(test_user_id, "any")
+    await save_gender(test_user_id, test_gender)
+    await set_preference(test_user_id, "any")
     
     # Join test user to queue
-    join_queue(test_user_id, "any")
+    await join_queue(test_user_id, "any")
     
     # Try to match the real user with the test user
-    match = try_match(data.device_id, "any")
+    match = await try_match(data.device_id, "any")
     
     if match:
+        await manager.set_partner(data.device_id, match)
         return {
             "status": "matched",
             "partner_id": match,
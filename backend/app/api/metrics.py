@@ -0,0 +1,48 @@
+import time
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from ..services import metrics
+from ..services.queue import get_queue_sizes
+from ..ws.connection_manager import manager
+
+router = APIRouter(tags=["Metrics"])
+
+
+class MetricsMiddleware:
+    """Time every HTTP request, labelled by route template rather than raw path."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            metrics.HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - started,
+                scope["method"],
+                getattr(route, "path", "unmatched"),
+                status,
+            )
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def scrape():
+    """Prometheus scrape endpoint for this worker."""
+    metrics.WS_CONNECTIONS.set(len(manager.active_connections))
+    for queue, size in (await get_queue_sizes()).items():
+        metrics.QUEUE_SIZE.set(size, queue)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
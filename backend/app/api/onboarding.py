@@ -9,7 +9,7 @@ class OnboardingInitRequest(BaseModel):
 
 
 @router.post("/init")
-def init_onboarding(data: OnboardingInitRequest):
+async def init_onboarding(data: OnboardingInitRequest):
     device_id = (data.device_id or "").strip()
     if not device_id or len(device_id) < 8:
         return {
@@ -12,7 +12,7 @@ class ProfileRequest(BaseModel):
 
 
 @router.post("/setup")
-def setup_profile(data: ProfileRequest):
+async def setup_profile(data: ProfileRequest):
     device_id = (data.device_id or "").strip()
     nickname = (data.nickname or "").strip()
     bio = (data.bio or "").strip()
@@ -24,7 +24,7 @@ def setup_profile(data: ProfileRequest):
     if not bio or len(bio) < 3 or len(bio) > 100:
         raise HTTPException(status_code=400, detail="Bio must be 3-100 characters")
     
-    save_profile(device_id, nickname, bio)
+    await save_profile(device_id, nickname, bio)
     return {
         "status": "ok",
         "nickname": nickname,
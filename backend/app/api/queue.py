@@ -1,6 +1,13 @@
+import time
 from fastapi import APIRouter
 from pydantic import BaseModel
-from ..services.queue import join_queue, leave_all_queues
+from ..services.queue import (
+    join_queue,
+    leave_all_queues,
+    renew_queue_lease,
+    get_wait_time,
+    get_queue_wait_stats
+)
 
 router = APIRouter(prefix="/queue", tags=["Queue"])
 
@@ -11,22 +18,44 @@ class QueueRequest(BaseModel):
 
 
 @router.post("/join")
-def join(data: QueueRequest):
+async def join(data: QueueRequest):
     preference = data.preference.strip().lower()
-    joined = join_queue(data.device_id, preference)
+    joined = await join_queue(data.device_id, preference)
     if not joined:
         return {"status": "blocked", "reason": "gender_not_verified"}
     return {"status": "joined"}
 
 
 @router.post("/leave")
-def leave(data: QueueRequest):
-    leave_all_queues(data.device_id)
+async def leave(data: QueueRequest):
+    await leave_all_queues(data.device_id)
     return {"status": "left"}
 
 
-# @router.get("/status")
-# def status():
-#     return {
-#         "queue": get_queue()
-#     }
+@router.post("/renew")
+async def renew(data: QueueRequest):
+    """Keep a queue entry alive; entries not renewed within the lease expire."""
+    deadline = await renew_queue_lease(data.device_id)
+    if deadline is None:
+        return {"status": "not_queued"}
+    return {
+        "status": "renewed",
+        "expires_in": round(max(0.0, deadline - time.time()), 3)
+    }
+
+
+@router.post("/wait")
+async def wait(data: QueueRequest):
+    wait_seconds = await get_wait_time(data.device_id)
+    if wait_seconds is None:
+        return {"status": "not_queued"}
+    return {
+        "status": "queued",
+        "wait_seconds": round(wait_seconds, 3)
+    }
+
+
+@router.get("/stats")
+async def stats():
+    """Queue depth and p50/p95 time-to-match over recent matches."""
+    return await get_queue_wait_stats()
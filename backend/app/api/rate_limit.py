@@ -0,0 +1,44 @@
+import math
+from starlette.responses import JSONResponse
+from ..services.rate_limit import (
+    rate_limiter,
+    API_LIMIT,
+    FIND_LIMIT,
+    VERIFY_LIMIT,
+)
+
+# First matching prefix wins; everything else gets API_LIMIT
+ROUTE_LIMITS = [
+    ("/verify/", VERIFY_LIMIT),
+    ("/match/find", FIND_LIMIT),
+]
+EXEMPT_PATHS = {"/health", "/metrics"}
+
+
+class RateLimitMiddleware:
+    """
+    Per client IP HTTP rate limiting. Behind a reverse proxy, run uvicorn
+    with FORWARDED_ALLOW_IPS set so the client address is the real one.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            return await self.app(scope, receive, send)
+        path = scope["path"]
+        if path in EXEMPT_PATHS:
+            return await self.app(scope, receive, send)
+
+        limit = next((limit for prefix, limit in ROUTE_LIMITS if path.startswith(prefix)), API_LIMIT)
+        client = scope.get("client")
+        allowed, retry_after = await rate_limiter.check(limit, client[0] if client else "unknown")
+        if not allowed:
+            response = JSONResponse(
+                {"detail": "Too many requests. Please slow down."},
+                status_code=429,
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+            return await response(scope, receive, send)
+        await self.app(scope, receive, send)
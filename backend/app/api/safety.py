@@ -1,6 +1,6 @@
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-from ..services.moderation import is_banned, get_ban_reason
+from ..services.moderation import get_ban_reason
 
 router = APIRouter(prefix="/safety", tags=["Safety"])
 
@@ -10,10 +10,10 @@ class SafetyCheckRequest(BaseModel):
 
 
 @router.post("/check")
-def safety_check(data: SafetyCheckRequest):
+async def safety_check(data: SafetyCheckRequest):
     """Check if a user is banned."""
-    if is_banned(data.device_id):
-        reason = get_ban_reason(data.device_id)
+    reason = await get_ban_reason(data.device_id)
+    if reason is not None:
         raise HTTPException(
             status_code=403,
             detail=f"Account suspended. Reason: {reason}. Try again later."
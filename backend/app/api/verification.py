@@ -1,31 +1,119 @@
-from fastapi import APIRouter, HTTPException
+import asyncio
+import os
+from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel
-from ..services.gender_ai import classify_gender
+from ..services.classifier_pool import classifier_pool, ClassifierBusy
 from ..services.user_store import save_gender
 
 router = APIRouter(prefix="/verify", tags=["Verification"])
 
+# Largest image accepted by /verify/gender/upload
+VERIFY_MAX_UPLOAD_BYTES = int(os.getenv("VERIFY_MAX_UPLOAD_BYTES", str(5 * 1024 * 1024)))
+# Room for the multipart boundaries and the device_id field
+MULTIPART_OVERHEAD_BYTES = 16 * 1024
+
 
 class VerificationRequest(BaseModel):
     device_id: str
     image_base64: str
 
 
-@router.post("/gender")
-def verify_gender(data: VerificationRequest):
-    device_id = (data.device_id or "").strip()
-    image_b64 = (data.image_base64 or "").strip()
-    
+def _validate_device_id(device_id: str | None) -> str:
+    device_id = (device_id or "").strip()
     if not device_id or len(device_id) < 8:
         raise HTTPException(status_code=400, detail="Invalid device ID")
-    if not image_b64 or len(image_b64) < 100:
-        raise HTTPException(status_code=400, detail="Invalid image data")
-    
-    gender = classify_gender(image_b64)
-    save_gender(device_id, gender)
-    data.image_base64 = None
+    return device_id
+
+
+async def _classify_and_save(device_id: str, image: str | bytes) -> dict:
+    # CPU-bound decode runs in the classifier's worker processes
+    try:
+        gender = await classifier_pool.classify(image)
+    except ClassifierBusy:
+        raise HTTPException(
+            status_code=429,
+            detail="Verification is busy, please try again",
+            headers={"Retry-After": "1"},
+        )
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Verification timed out, please try again")
+    await save_gender(device_id, gender)
 
     return {
         "status": "verified",
         "gender": gender
     }
+
+
+def _too_large() -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"Image too large (max {VERIFY_MAX_UPLOAD_BYTES // 1024}KB)"
+    )
+
+
+def _capped_request(request: Request, limit: int) -> Request:
+    """
+    Same request, but reading more than `limit` body bytes raises 413.
+    A declared Content-Length over the limit is refused before reading.
+    """
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > limit:
+        raise _too_large()
+
+    received = 0
+
+    async def receive():
+        nonlocal received
+        message = await request.receive()
+        received += len(message.get("body", b""))
+        if received > limit:
+            raise _too_large()
+        return message
+
+    return Request(request.scope, receive)
+
+
+@router.post("/gender")
+async def verify_gender(data: VerificationRequest):
+    device_id = _validate_device_id(data.device_id)
+    image_b64 = (data.image_base64 or "").strip()
+
+    if not image_b64 or len(image_b64) < 100:
+        raise HTTPException(status_code=400, detail="Invalid image data")
+
+    result = await _classify_and_save(device_id, image_b64)
+    data.image_base64 = None
+    return result
+
+
+@router.post("/gender/upload")
+async def verify_gender_upload(request: Request, device_id: str | None = None):
+    """
+    Binary variant of /verify/gender. Send either the encoded image as the
+    raw body (e.g. Content-Type: image/jpeg) with ?device_id=..., or
+    multipart/form-data with `device_id` and `image` fields.
+    """
+    content_type = request.headers.get("content-type", "")
+
+    if content_type.startswith("multipart/form-data"):
+        capped = _capped_request(request, VERIFY_MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES)
+        async with capped.form(max_files=1, max_fields=1) as form:
+            device_id = _validate_device_id(form.get("device_id") or device_id)
+            upload = form.get("image")
+            if upload is None or isinstance(upload, str):
+                raise HTTPException(status_code=400, detail="Missing image file")
+            image = await upload.read()
+    else:
+        device_id = _validate_device_id(device_id)
+        body = bytearray()
+        async for chunk in _capped_request(request, VERIFY_MAX_UPLOAD_BYTES).stream():
+            body += chunk
+        image = bytes(body)
+
+    if len(image) > VERIFY_MAX_UPLOAD_BYTES:
+        raise _too_large()
+    if len(image) < 100:
+        raise HTTPException(status_code=400, detail="Invalid image data")
+
+    return await _classify_and_save(device_id, image)
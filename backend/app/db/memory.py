@@ -0,0 +1,583 @@
+"""
+Embedded Redis stand-in for single-node deployments, local development and
+load tests. Implements the subset of commands the services use with the
+same return values as redis.asyncio (decode_responses=True), including
+real key expiry and a bounded keyspace.
+"""
+import asyncio
+import bisect
+import fnmatch
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from redis.exceptions import ResponseError
+
+WRONGTYPE = "WRONGTYPE Operation against a key holding the wrong kind of value"
+
+
+class _SortedSet:
+    """
+    Scores by member plus a (score, member) list kept ordered with bisect,
+    so reading the head of a queue is a slice rather than a sort.
+    """
+
+    __slots__ = ("scores", "ordered")
+
+    def __init__(self):
+        self.scores = {}
+        self.ordered = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add(self, member: str, score: float):
+        old = self.scores.get(member)
+        if old is not None:
+            self._unlink(old, member)
+        self.scores[member] = score
+        bisect.insort(self.ordered, (score, member))
+
+    def remove(self, member: str) -> bool:
+        score = self.scores.pop(member, None)
+        if score is None:
+            return False
+        self._unlink(score, member)
+        return True
+
+    def _unlink(self, score: float, member: str):
+        del self.ordered[bisect.bisect_left(self.ordered, (score, member))]
+
+
+class _HyperLogLog(set):
+    """PFADD/PFCOUNT stand-in; counts exactly instead of estimating."""
+
+
+class _Stream:
+    """Append-only log with consumer groups; ids are (milliseconds, sequence)."""
+
+    __slots__ = ("entries", "last_id", "groups")
+
+    def __init__(self):
+        self.entries = OrderedDict()  # (ms, seq) -> fields
+        self.last_id = (0, 0)
+        self.groups = {}
+
+
+class _ConsumerGroup:
+    __slots__ = ("last_delivered", "pending")
+
+    def __init__(self, last_delivered: tuple[int, int]):
+        self.last_delivered = last_delivered
+        # (ms, seq) -> [consumer, monotonic ms of last delivery]
+        self.pending = OrderedDict()
+
+
+def _parse_stream_id(entry_id: str) -> tuple[int, int]:
+    ms, _, seq = str(entry_id).partition("-")
+    return int(ms), int(seq or 0)
+
+
+def _format_stream_id(entry_id: tuple[int, int]) -> str:
+    return f"{entry_id[0]}-{entry_id[1]}"
+
+
+def _encode(value) -> str:
+    """Store values the way Redis would hand them back: as strings."""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        raise ResponseError("Invalid input of type: 'bool'")
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _stop(end: int) -> int | None:
+    """Redis ranges are inclusive; -1 means "to the end"."""
+    return None if end == -1 else end + 1
+
+
+class _Keyspace:
+    """
+    Synchronous command implementations. Not thread-safe on its own;
+    InMemoryRedis serializes access with a lock.
+
+    Keys are kept in LRU order. Once `max_keys` is reached, writing a new
+    key evicts the least recently used one (Redis' allkeys-lru). Expired
+    keys are removed lazily when touched and by sweep(), which the
+    background task runs periodically.
+    """
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self.data = OrderedDict()
+        self.expires = {}  # key -> monotonic deadline
+        self.deadlines = []  # heap of (deadline, key); may hold stale entries
+
+    # -- keyspace helpers -------------------------------------------------
+
+    def _alive(self, key) -> bool:
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self._remove(key)
+            return False
+        return key in self.data
+
+    def _remove(self, key) -> bool:
+        self.expires.pop(key, None)
+        return self.data.pop(key, None) is not None
+
+    def _read(self, key, kind):
+        if not self._alive(key):
+            return None
+        value = self.data[key]
+        if type(value) is not kind:
+            raise ResponseError(WRONGTYPE)
+        self.data.move_to_end(key)
+        return value
+
+    def _write(self, key, kind, factory=None):
+        value = self._read(key, kind)
+        if value is None:
+            value = factory() if factory else None
+            self._store(key, value)
+        return value
+
+    def _store(self, key, value, keep_ttl=False):
+        if key not in self.data:
+            while len(self.data) >= self.max_keys:
+                oldest, _ = self.data.popitem(last=False)
+                self.expires.pop(oldest, None)
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if not keep_ttl:
+            self.expires.pop(key, None)
+
+    def _set_deadline(self, key, seconds: float):
+        deadline = time.monotonic() + seconds
+        self.expires[key] = deadline
+        heapq.heappush(self.deadlines, (deadline, key))
+
+    def _drop_if_empty(self, key):
+        if key in self.data and not self.data[key]:
+            self._remove(key)
+
+    def sweep(self, limit: int = 1000) -> int:
+        """Delete up to `limit` keys whose TTL has passed."""
+        now = time.monotonic()
+        removed = 0
+        while self.deadlines and removed < limit and self.deadlines[0][0] <= now:
+            deadline, key = heapq.heappop(self.deadlines)
+            # Skip heap entries made stale by a later EXPIRE/SET
+            if self.expires.get(key) == deadline:
+                self._remove(key)
+                removed += 1
+        return removed
+
+    # -- generic ----------------------------------------------------------
+
+    def ping(self):
+        return True
+
+    def exists(self, *keys):
+        return sum(1 for key in keys if self._alive(key))
+
+    def delete(self, *keys):
+        return sum(1 for key in keys if self._alive(key) and self._remove(key))
+
+    def expire(self, key, seconds):
+        if not self._alive(key):
+            return False
+        self._set_deadline(key, float(seconds))
+        return True
+
+    def pttl(self, key):
+        if not self._alive(key):
+            return -2
+        deadline = self.expires.get(key)
+        if deadline is None:
+            return -1
+        return max(0, int((deadline - time.monotonic()) * 1000))
+
+    def ttl(self, key):
+        ms = self.pttl(key)
+        return ms if ms < 0 else (ms + 999) // 1000
+
+    def dbsize(self):
+        return len(self.data)
+
+    def flushall(self):
+        self.data.clear()
+        self.expires.clear()
+        self.deadlines.clear()
+        return True
+
+    def keys_matching(self, pattern):
+        return [key for key in list(self.data) if fnmatch.fnmatchcase(key, pattern) and self._alive(key)]
+
+    # -- strings ----------------------------------------------------------
+
+    def get(self, key):
+        return self._read(key, str)
+
+    def mget(self, keys, *args):
+        # Like Redis, non-string keys read as nil instead of erroring
+        values = []
+        for key in [*keys, *args]:
+            try:
+                values.append(self._read(key, str))
+            except ResponseError:
+                values.append(None)
+        return values
+
+    def set(self, key, value, ex=None, px=None, nx=False):
+        if nx and self._alive(key):
+            return None
+        self._store(key, _encode(value))
+        if ex is not None:
+            self._set_deadline(key, float(ex))
+        elif px is not None:
+            self._set_deadline(key, px / 1000)
+        return True
+
+    def setex(self, key, seconds, value):
+        return self.set(key, value, ex=seconds)
+
+    def incr(self, key, amount=1):
+        return self.incrby(key, amount)
+
+    def incrby(self, key, amount=1):
+        current = self._read(key, str)
+        try:
+            value = int(current or 0) + amount
+        except ValueError:
+            raise ResponseError("value is not an integer or out of range")
+        self._store(key, str(value), keep_ttl=True)
+        return value
+
+    # -- sets -------------------------------------------------------------
+
+    def sadd(self, key, *members):
+        members_set = self._write(key, set, set)
+        before = len(members_set)
+        members_set.update(_encode(m) for m in members)
+        return len(members_set) - before
+
+    def srem(self, key, *members):
+        members_set = self._read(key, set)
+        if members_set is None:
+            return 0
+        before = len(members_set)
+        members_set.difference_update(_encode(m) for m in members)
+        removed = before - len(members_set)
+        self._drop_if_empty(key)
+        return removed
+
+    def smembers(self, key):
+        return set(self._read(key, set) or ())
+
+    # -- hyperloglogs -----------------------------------------------------
+
+    def pfadd(self, key, *elements):
+        registers = self._write(key, _HyperLogLog, _HyperLogLog)
+        before = len(registers)
+        registers.update(_encode(e) for e in elements)
+        return int(len(registers) != before or before == 0)
+
+    def pfcount(self, *keys):
+        union = set()
+        for key in keys:
+            union.update(self._read(key, _HyperLogLog) or ())
+        return len(union)
+
+    # -- sorted sets ------------------------------------------------------
+
+    def zadd(self, key, mapping, nx=False, xx=False):
+        if xx and not self._alive(key):
+            return 0
+        zset = self._write(key, _SortedSet, _SortedSet)
+        added = 0
+        for member, score in mapping.items():
+            member = _encode(member)
+            exists = member in zset.scores
+            if (exists and nx) or (not exists and xx):
+                continue
+            added += not exists
+            zset.add(member, float(score))
+        return added
+
+    def zrem(self, key, *members):
+        zset = self._read(key, _SortedSet)
+        if zset is None:
+            return 0
+        removed = sum(1 for m in members if zset.remove(_encode(m)))
+        self._drop_if_empty(key)
+        return removed
+
+    def zscore(self, key, member):
+        zset = self._read(key, _SortedSet)
+        return None if zset is None else zset.scores.get(_encode(member))
+
+    def zcard(self, key):
+        return len(self._read(key, _SortedSet) or ())
+
+    def zrangebyscore(self, key, min, max, start=None, num=None):
+        zset = self._read(key, _SortedSet)
+        if not zset:
+            return []
+        low, high = float(min), float(max)
+        i = bisect.bisect_left(zset.ordered, (low,)) + (start or 0)
+        limit = num if num is not None and num >= 0 else len(zset.ordered)
+        members = []
+        while i < len(zset.ordered) and zset.ordered[i][0] <= high and len(members) < limit:
+            members.append(zset.ordered[i][1])
+            i += 1
+        return members
+
+    def zremrangebyscore(self, key, min, max):
+        members = self.zrangebyscore(key, min, max)
+        return self.zrem(key, *members) if members else 0
+
+    def zrange(self, key, start, end, withscores=False):
+        zset = self._read(key, _SortedSet)
+        if not zset:
+            return []
+        window = zset.ordered[start:_stop(end)]
+        if withscores:
+            return [(member, score) for score, member in window]
+        return [member for _, member in window]
+
+    # -- streams ----------------------------------------------------------
+    # Reads never block: BLOCK is accepted and ignored, so consumers poll.
+
+    def _group(self, key, groupname) -> tuple[_Stream, _ConsumerGroup]:
+        stream = self._read(key, _Stream)
+        group = stream.groups.get(groupname) if stream is not None else None
+        if group is None:
+            raise ResponseError(f"NOGROUP No such key '{key}' or consumer group '{groupname}'")
+        return stream, group
+
+    def xadd(self, key, fields, id="*", maxlen=None, approximate=True):
+        stream = self._write(key, _Stream, _Stream)
+        if id != "*":
+            raise ResponseError("only auto-generated stream ids are supported")
+        ms = int(time.time() * 1000)
+        last_ms, last_seq = stream.last_id
+        entry_id = (ms, 0) if ms > last_ms else (last_ms, last_seq + 1)
+        stream.entries[entry_id] = {f: _encode(v) for f, v in fields.items()}
+        stream.last_id = entry_id
+        if maxlen is not None:
+            while len(stream.entries) > maxlen:
+                stream.entries.popitem(last=False)
+        return _format_stream_id(entry_id)
+
+    def xlen(self, key):
+        stream = self._read(key, _Stream)
+        return 0 if stream is None else len(stream.entries)
+
+    def xgroup_create(self, key, groupname, id="$", mkstream=False):
+        stream = self._read(key, _Stream)
+        if stream is None:
+            if not mkstream:
+                raise ResponseError("ERR The XGROUP subcommand requires the key to exist")
+            stream = self._write(key, _Stream, _Stream)
+        if groupname in stream.groups:
+            raise ResponseError("BUSYGROUP Consumer Group name already exists")
+        start = stream.last_id if id == "$" else _parse_stream_id(id)
+        stream.groups[groupname] = _ConsumerGroup(start)
+        return True
+
+    def xreadgroup(self, groupname, consumername, streams, count=None, block=None, noack=False):
+        now = time.monotonic() * 1000
+        response = []
+        for key, start in streams.items():
+            stream, group = self._group(key, groupname)
+            entries = []
+            if start == ">":
+                for entry_id, fields in stream.entries.items():
+                    if count is not None and len(entries) >= count:
+                        break
+                    if entry_id <= group.last_delivered:
+                        continue
+                    entries.append((_format_stream_id(entry_id), dict(fields)))
+                    group.last_delivered = entry_id
+                    if not noack:
+                        group.pending[entry_id] = [consumername, now]
+            else:
+                # Re-read this consumer's own pending entries
+                after = _parse_stream_id(start)
+                for entry_id, (owner, _) in group.pending.items():
+                    if count is not None and len(entries) >= count:
+                        break
+                    if owner == consumername and entry_id > after and entry_id in stream.entries:
+                        entries.append((_format_stream_id(entry_id), dict(stream.entries[entry_id])))
+            if entries or start != ">":
+                response.append([key, entries])
+        return response
+
+    def xack(self, key, groupname, *ids):
+        _, group = self._group(key, groupname)
+        return sum(1 for entry_id in ids if group.pending.pop(_parse_stream_id(entry_id), None) is not None)
+
+    def xautoclaim(self, key, groupname, consumername, min_idle_time, start_id="0-0", count=None):
+        stream, group = self._group(key, groupname)
+        now = time.monotonic() * 1000
+        start = _parse_stream_id(start_id)
+        limit = count or 100
+        claimed = []
+        next_id = "0-0"
+        for entry_id in [entry_id for entry_id in group.pending if entry_id >= start]:
+            if len(claimed) >= limit:
+                next_id = _format_stream_id(entry_id)
+                break
+            owner, delivered_at = group.pending[entry_id]
+            if now - delivered_at < min_idle_time:
+                continue
+            if entry_id not in stream.entries:
+                # Trimmed away; nothing left to deliver
+                del group.pending[entry_id]
+                continue
+            group.pending[entry_id] = [consumername, now]
+            claimed.append((_format_stream_id(entry_id), dict(stream.entries[entry_id])))
+        return [next_id, claimed]
+
+    # -- lists ------------------------------------------------------------
+
+    def lpush(self, key, *values):
+        lst = self._write(key, list, list)
+        for value in values:
+            lst.insert(0, _encode(value))
+        return len(lst)
+
+    def ltrim(self, key, start, end):
+        lst = self._read(key, list)
+        if lst is not None:
+            lst[:] = lst[start:_stop(end)]
+            self._drop_if_empty(key)
+        return True
+
+    def lrange(self, key, start, end):
+        return list((self._read(key, list) or [])[start:_stop(end)])
+
+    # -- hashes -----------------------------------------------------------
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        fields = self._write(key, dict, dict)
+        items = dict(mapping or {})
+        if field is not None:
+            items[field] = value
+        added = sum(1 for f in items if f not in fields)
+        fields.update((f, _encode(v)) for f, v in items.items())
+        return added
+
+    def hget(self, key, field):
+        fields = self._read(key, dict)
+        return None if fields is None else fields.get(field)
+
+    def hmget(self, key, keys, *args):
+        fields = self._read(key, dict) or {}
+        return [fields.get(f) for f in [*keys, *args]]
+
+    def hgetall(self, key):
+        return dict(self._read(key, dict) or {})
+
+    def hincrby(self, key, field, amount=1):
+        fields = self._write(key, dict, dict)
+        value = int(fields.get(field, 0)) + amount
+        fields[field] = str(value)
+        return value
+
+    def hdel(self, key, *fields):
+        hash_fields = self._read(key, dict)
+        if hash_fields is None:
+            return 0
+        removed = sum(1 for f in fields if hash_fields.pop(f, None) is not None)
+        self._drop_if_empty(key)
+        return removed
+
+
+class InMemoryPipeline:
+    """Buffers commands and applies them atomically on execute()."""
+
+    def __init__(self, client: "InMemoryRedis"):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self.client.keyspace, name)
+
+        def queue_command(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue_command
+
+    async def execute(self):
+        commands, self.commands = self.commands, []
+        results = []
+        with self.client.lock:
+            for command, args, kwargs in commands:
+                # Like MULTI/EXEC, a failing command doesn't stop the rest
+                try:
+                    results.append(command(*args, **kwargs))
+                except ResponseError as e:
+                    results.append(e)
+        for result in results:
+            if isinstance(result, ResponseError):
+                raise result
+        return results
+
+
+class InMemoryRedis:
+    """
+    Async facade over _Keyspace with the redis.asyncio call signatures.
+    Every command runs under one lock, so it is safe to share between the
+    event loop and worker threads, and each command (or pipeline) is atomic.
+    """
+
+    def __init__(self, max_keys: int = 1_000_000, sweep_interval: float = 0.1):
+        self.keyspace = _Keyspace(max_keys)
+        self.lock = threading.RLock()
+        self.sweep_interval = sweep_interval
+        self._sweeper = None
+
+    def __getattr__(self, name):
+        command = getattr(self.keyspace, name)
+
+        async def run(*args, **kwargs):
+            with self.lock:
+                return command(*args, **kwargs)
+
+        # Cache so later calls skip __getattr__
+        setattr(self, name, run)
+        return run
+
+    def pipeline(self, transaction: bool = True):
+        return InMemoryPipeline(self)
+
+    async def scan_iter(self, match: str = "*", count: int | None = None):
+        with self.lock:
+            keys = self.keyspace.keys_matching(match)
+        for key in keys:
+            yield key
+
+    def start(self):
+        """Start the background sweeper that reclaims expired keys."""
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_forever())
+
+    async def aclose(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            with self.lock:
+                removed = self.keyspace.sweep()
+            # A full batch means there is a backlog; go again right away
+            while removed >= 1000:
+                await asyncio.sleep(0)
+                with self.lock:
+                    removed = self.keyspace.sweep()
@@ -0,0 +1,79 @@
+import asyncio
+from .redis import redis_client, IN_MEMORY_BACKEND
+
+
+class RedisBroker:
+    """
+    Pub/sub transport between workers. Each worker holds one subscriber
+    connection and subscribes it to a channel per locally connected device.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        # Takes a dedicated connection from the client's pool on first use
+        self.pubsub = client.pubsub()
+
+    async def publish(self, channel: str, message: str) -> int:
+        """Publish a message. Returns how many subscribers received it."""
+        return await self.client.publish(channel, message)
+
+    async def subscribe(self, channel: str) -> None:
+        await self.pubsub.subscribe(channel)
+
+    async def unsubscribe(self, channel: str) -> None:
+        await self.pubsub.unsubscribe(channel)
+
+    async def get_message(self, timeout: float) -> tuple[str, str] | None:
+        """Next (channel, data) delivered to this worker, or None on timeout."""
+        if not self.pubsub.subscribed:
+            await asyncio.sleep(timeout)
+            return None
+        message = await self.pubsub.get_message(
+            ignore_subscribe_messages=True,
+            timeout=timeout
+        )
+        if not message:
+            return None
+        return message["channel"], message["data"]
+
+
+class LocalBroker:
+    """
+    In-process stand-in for RedisBroker. Brokers created in the same
+    process share one channel registry, so tests can run several
+    "workers" side by side without a Redis server.
+    """
+
+    _channels: dict[str, set["LocalBroker"]] = {}
+
+    def __init__(self):
+        self.inbox = asyncio.Queue()
+
+    async def publish(self, channel: str, message: str) -> int:
+        subscribers = self._channels.get(channel, set())
+        for broker in subscribers:
+            broker.inbox.put_nowait((channel, message))
+        return len(subscribers)
+
+    async def subscribe(self, channel: str) -> None:
+        self._channels.setdefault(channel, set()).add(self)
+
+    async def unsubscribe(self, channel: str) -> None:
+        subscribers = self._channels.get(channel)
+        if subscribers is not None:
+            subscribers.discard(self)
+            if not subscribers:
+                del self._channels[channel]
+
+    async def get_message(self, timeout: float) -> tuple[str, str] | None:
+        try:
+            return await asyncio.wait_for(self.inbox.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+def create_broker():
+    """Broker for this worker, matching the backend redis_client uses."""
+    if IN_MEMORY_BACKEND:
+        return LocalBroker()
+    return RedisBroker(redis_client)
@@ -1,73 +1,60 @@
+import logging
 import redis
+import redis.asyncio as aioredis
 import os
 from dotenv import load_dotenv
+from .memory import InMemoryRedis
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 
-try:
-    redis_client = redis.Redis.from_url(
-        REDIS_URL,
-        decode_responses=True,
-        socket_connect_timeout=2
-    )
-    # Test connection
-    redis_client.ping()
-except Exception as e:
-    print(f"⚠️  Redis connection failed ({e}). Using in-memory mock.")
-    
-    # In-memory mock for development (not for production!)
-    class MockRedis:
-        def __init__(self):
-            self.data = {}
-        
-        def exists(self, key):
-            return 1 if key in self.data else 0
-        
-        def get(self, key):
-            return self.data.get(key)
-        
-        def set(self, key, value):
-            self.data[key] = value
-        
-        def setex(self, key, ttl, value):
-            self.data[key] = value
-        
-        def incr(self, key):
-            self.data[key] = int(self.data.get(key, 0)) + 1
-            return self.data[key]
-        
-        def sadd(self, key, *members):
-            if key not in self.data:
-                self.data[key] = set()
-            self.data[key].update(members)
-        
-        def srem(self, key, member):
-            if key in self.data:
-                self.data[key].discard(member)
-        
-        def smembers(self, key):
-            return self.data.get(key, set())
-        
-        def hset(self, key, mapping=None, **kwargs):
-            if key not in self.data:
-                self.data[key] = {}
-            if mapping:
-                self.data[key].update(mapping)
-            self.data[key].update(kwargs)
-        
-        def hget(self, key, field):
-            return self.data.get(key, {}).get(field)
-        
-        def delete(self, *keys):
-            for key in keys:
-                self.data.pop(key, None)
-        
-        def expire(self, key, ttl):
-            pass  # TTL not implemented in mock
-        
-        def ping(self):
-            return True
-    
-    redis_client = MockRedis()
+# Size of the shared asyncio connection pool. Requests wait for a free
+# connection (up to REDIS_POOL_TIMEOUT seconds) instead of opening more.
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "100"))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "5"))
+
+# Key budget for the embedded backend; least recently used keys are
+# evicted past it.
+MEMORY_BACKEND_MAX_KEYS = int(os.getenv("MEMORY_BACKEND_MAX_KEYS", "1000000"))
+
+# True when running on the embedded in-memory backend instead of a real
+# server, either because REDIS_URL=memory:// or because the server was
+# unreachable. Services that rely on server-side scripts or pub/sub use
+# it to pick their in-process equivalent.
+IN_MEMORY_BACKEND = REDIS_URL.startswith("memory://")
+
+if not IN_MEMORY_BACKEND:
+    try:
+        # Test connection once, synchronously, at import time
+        with redis.Redis.from_url(REDIS_URL, socket_connect_timeout=2) as probe:
+            probe.ping()
+
+        redis_pool = aioredis.BlockingConnectionPool.from_url(
+            REDIS_URL,
+            decode_responses=True,
+            socket_connect_timeout=2,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            timeout=REDIS_POOL_TIMEOUT,
+        )
+        redis_client = aioredis.Redis(connection_pool=redis_pool)
+    except Exception as e:
+        logger.warning("Redis connection failed (%s). Using in-memory backend.", e)
+        IN_MEMORY_BACKEND = True
+
+if IN_MEMORY_BACKEND:
+    # Single-process only: state is not shared between workers
+    redis_client = InMemoryRedis(max_keys=MEMORY_BACKEND_MAX_KEYS)
+
+
+async def start_redis():
+    """Start background work for the backend (expiry sweeper)."""
+    if IN_MEMORY_BACKEND:
+        redis_client.start()
+
+
+async def close_redis():
+    """Release pooled connections (or stop the sweeper) on shutdown."""
+    await redis_client.aclose()
@@ -1,19 +1,58 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from .ws.socket import router as ws_router
+from .ws.socket import router as ws_router, notify_suspended
 from .api.onboarding import router as onboarding_router
 from .api.verification import router as verification_router
 from .api.profile import router as profile_router
 from dotenv import load_dotenv
 load_dotenv()
+from .services.log import configure_logging
+configure_logging()
 from .api.queue import router as queue_router
 from .api.match import router as match_router
 from .api.safety import router as safety_router
+from .api.rate_limit import RateLimitMiddleware
+from .api.metrics import router as metrics_router, MetricsMiddleware
+from .db.redis import redis_client, start_redis, close_redis, IN_MEMORY_BACKEND
+from .services.classifier_pool import classifier_pool
+from .services.metrics import instrument_redis
+from .services.moderation import ban_cache
+from .services.moderation_worker import run_moderation_worker, MODERATION_WORKER_ENABLED
+from .services.queue import run_queue_compaction, run_matchmaker, MATCHMAKER_ENABLED
+from .ws.connection_manager import manager
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await start_redis()
+    if not IN_MEMORY_BACKEND:
+        instrument_redis(redis_client)
+    classifier_pool.start()
+    compaction = asyncio.create_task(run_queue_compaction())
+    ban_sync = asyncio.create_task(ban_cache.run())
+    moderation = None
+    if MODERATION_WORKER_ENABLED:
+        moderation = asyncio.create_task(run_moderation_worker(notify_suspended))
+    matchmaker = None
+    if MATCHMAKER_ENABLED:
+        matchmaker = asyncio.create_task(run_matchmaker(manager.notify_matched))
+    yield
+    if matchmaker is not None:
+        matchmaker.cancel()
+    if moderation is not None:
+        moderation.cancel()
+    ban_sync.cancel()
+    compaction.cancel()
+    classifier_pool.shutdown()
+    await close_redis()
 
-app = FastAPI(title="Controlled Anonymity Chat API")
 
+app = FastAPI(title="Controlled Anonymity Chat API", lifespan=lifespan)
+
+# Added before CORS so it runs inside it and 429s still carry CORS headers
+app.add_middleware(RateLimitMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -23,6 +62,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Outermost, so rate-limited and CORS-rejected requests are timed too
+app.add_middleware(MetricsMiddleware)
+
 app.include_router(onboarding_router)
 app.include_router(verification_router)
 app.include_router(profile_router)
@@ -30,10 +72,11 @@ app.include_router(queue_router)
 app.include_router(match_router)
 app.include_router(safety_router)
 app.include_router(ws_router)
+app.include_router(metrics_router)
 
 
 @app.get("/health")
-def health_check():
+async def health_check():
     return {
         "status": "ok",
         "message": "Backend is running"
@@ -0,0 +1,157 @@
+"""
+Runs image classification in a pool of worker processes, so decoding and
+inference never hold the GIL of the worker serving chat and matching.
+
+Concurrent requests are grouped into micro-batches (up to
+CLASSIFIER_BATCH_SIZE images, or whatever arrived within
+CLASSIFIER_BATCH_WAIT_MS of the first one) and each batch is classified
+in a single call, which is what a real model needs to use its batched
+forward pass.
+"""
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from .gender_ai import classify_batch, warm_up
+from .metrics import CLASSIFIER_SECONDS
+
+CLASSIFIER_WORKERS = int(os.getenv("CLASSIFIER_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Images allowed in flight (queued or being classified, including ones
+# whose caller already timed out) before new requests get a 429
+CLASSIFIER_MAX_PENDING = int(os.getenv("CLASSIFIER_MAX_PENDING", str(CLASSIFIER_WORKERS * 8)))
+CLASSIFIER_TIMEOUT_SECONDS = float(os.getenv("CLASSIFIER_TIMEOUT_SECONDS", "10"))
+CLASSIFIER_BATCH_SIZE = int(os.getenv("CLASSIFIER_BATCH_SIZE", "8"))
+CLASSIFIER_BATCH_WAIT_MS = float(os.getenv("CLASSIFIER_BATCH_WAIT_MS", "5"))
+
+
+class ClassifierBusy(Exception):
+    """Too many classifications already pending, or the pool is being rebuilt; retry later."""
+
+
+def _ready() -> bool:
+    return True
+
+
+class ClassifierPool:
+    def __init__(
+        self,
+        workers: int,
+        max_pending: int,
+        timeout: float,
+        batch_size: int = 1,
+        batch_wait_ms: float = 0,
+    ):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait_ms / 1000
+        self.pending = 0
+        self.executor = None
+        # (image, future) pairs waiting for the current batch to close
+        self.batch = []
+        self._flush_timer = None
+        self._running = set()
+
+    def start(self):
+        """Spawn the worker processes and load the classifier in each."""
+        if self.executor is not None:
+            return
+        # spawn, not fork: the API process has an event loop and threads
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=warm_up,
+        )
+        # Workers start on demand; one job each brings them all up now
+        for _ in range(self.workers):
+            self.executor.submit(_ready)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def classify(self, image: str | bytes) -> str:
+        """
+        Classify in a worker process. Raises ClassifierBusy when the pool
+        is saturated and asyncio.TimeoutError if the result takes too long.
+        """
+        if self.pending >= self.max_pending:
+            CLASSIFIER_SECONDS.observe(0, "busy")
+            raise ClassifierBusy()
+        self.start()
+        # Released by _run_batch once the image's batch is done, so images
+        # still being classified for callers that gave up keep counting
+        self.pending += 1
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            loop = asyncio.get_running_loop()
+            result = loop.create_future()
+            self.batch.append((image, result))
+            if len(self.batch) >= self.batch_size:
+                self._flush()
+            elif self._flush_timer is None:
+                self._flush_timer = loop.call_later(self.batch_wait, self._flush)
+            gender = await asyncio.wait_for(result, self.timeout)
+            outcome = "ok"
+            return gender
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            raise
+        finally:
+            CLASSIFIER_SECONDS.observe(time.perf_counter() - started, outcome)
+
+    def _flush(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        batch, self.batch = self.batch, []
+        if batch:
+            task = asyncio.create_task(self._run_batch(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run_batch(self, batch: list):
+        try:
+            await self._classify_batch(batch)
+        finally:
+            self.pending -= len(batch)
+
+    async def _classify_batch(self, batch: list):
+        # Requests that already timed out are not worth classifying
+        batch = [(image, result) for image, result in batch if not result.done()]
+        if not batch:
+            return
+        self.start()
+        executor = self.executor
+        try:
+            genders = await asyncio.get_running_loop().run_in_executor(
+                executor, classify_batch, [image for image, _ in batch]
+            )
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                # A worker died (e.g. out of memory); rebuild on the next call
+                executor.shutdown(wait=False, cancel_futures=True)
+                if self.executor is executor:
+                    self.executor = None
+                e = ClassifierBusy()
+            for _, result in batch:
+                if not result.done():
+                    result.set_exception(e)
+            return
+        for (_, result), gender in zip(batch, genders):
+            if not result.done():
+                result.set_result(gender)
+
+
+classifier_pool = ClassifierPool(
+    CLASSIFIER_WORKERS,
+    CLASSIFIER_MAX_PENDING,
+    CLASSIFIER_TIMEOUT_SECONDS,
+    CLASSIFIER_BATCH_SIZE,
+    CLASSIFIER_BATCH_WAIT_MS,
+)
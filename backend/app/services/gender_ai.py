@@ -1,54 +1,131 @@
 import base64
+import importlib
+from abc import ABC, abstractmethod
+import os
 from io import BytesIO
 from PIL import Image
-import random
+import numpy as np
 
+# Images are analysed at roughly this size (longest side). JPEGs are
+# decoded straight at a reduced scale, so a 12MP upload costs about the
+# same as a 720p one.
+ANALYSIS_SIZE = 320
 
-def classify_gender(image_base64: str) -> str:
+# Side of the square sampled around the image center, at analysis scale
+CENTER_REGION = 40
+
+# Formats without reduced-scale decoding are fully decoded; refuse
+# anything bigger than this instead of allocating for it.
+MAX_DECODE_PIXELS = 4_000_000
+
+
+def _image_bytes(image: str | bytes) -> bytes:
+    """Raw uploads arrive as bytes; the JSON endpoint sends a base64 data URL."""
+    if isinstance(image, str):
+        return base64.b64decode(image.split(",")[1])
+    return image
+
+
+def _center_region(image: str | bytes) -> np.ndarray:
+    """Decode just enough of the image to return its center as an RGB array."""
+    image = Image.open(BytesIO(_image_bytes(image)))
+    # JPEG only: have libjpeg scale down by up to 8x while decoding
+    image.draft("RGB", (ANALYSIS_SIZE, ANALYSIS_SIZE))
+
+    width, height = image.size
+    if width * height > MAX_DECODE_PIXELS:
+        raise ValueError("image too large")
+
+    # Crop before converting so only the center is ever converted to RGB
+    scale = max(1, max(width, height) // ANALYSIS_SIZE)
+    half = CENTER_REGION * scale // 2
+    center_x, center_y = width // 2, height // 2
+    region = image.crop((
+        max(0, center_x - half),
+        max(0, center_y - half),
+        min(width, center_x + half),
+        min(height, center_y + half),
+    )).convert("RGB")
+    if scale > 1:
+        region = region.reduce(scale)
+    return np.asarray(region)
+
+
+def classify_gender(image: str | bytes) -> str:
     """
     Gender classification using simple image analysis.
     Falls back safely if anything fails.
-    
+
     In production, replace with real DeepFace or cloud API.
     For MVP, uses basic heuristics on face detection.
     """
     try:
-        # Decode base64 image
-        image_data = base64.b64decode(image_base64.split(",")[1])
-        image = Image.open(BytesIO(image_data)).convert("RGB")
-        
+        pixels = _center_region(image)
+        if pixels.size == 0:
+            return "unknown"
+
         # Basic image validation (must be non-trivial)
-        img_array = image.tobytes()
-        if len(set(img_array[:100])) < 3:  # Very low entropy = likely blank
+        if len(np.unique(pixels)) < 3:  # Very low entropy = likely blank
             return "unknown"
-        
+
         # Simple heuristic based on image properties
         # (In production, use mtcnn + lightweight model or cloud API)
-        width, height = image.size
-        
-        # Get dominant colors in face region (rough center)
-        pixels = image.load()
-        center_x, center_y = width // 2, height // 2
-        
-        sample_colors = []
-        for dx in range(-20, 20, 5):
-            for dy in range(-20, 20, 5):
-                x, y = center_x + dx, center_y + dy
-                if 0 <= x < width and 0 <= y < height:
-                    sample_colors.append(pixels[x, y])
-        
-        if not sample_colors:
-            return "unknown"
-        
-        # Deterministic classification based on color signature
-        r_avg = sum(c[0] for c in sample_colors) // len(sample_colors)
-        g_avg = sum(c[1] for c in sample_colors) // len(sample_colors)
-        b_avg = sum(c[2] for c in sample_colors) // len(sample_colors)
-        
+        r_avg, g_avg, b_avg = pixels.reshape(-1, 3).mean(axis=0).astype(int)
+
         # Use hash of color values for deterministic gender assignment
         color_hash = (r_avg + g_avg * 2 + b_avg * 3) % 2
         return "male" if color_hash == 0 else "female"
-        
+
     except Exception as e:
         # SAFE fallback (never break the app)
         return "unknown"
+
+
+class GenderClassifier(ABC):
+    """
+    Classifier backend interface. Backends receive whole batches so a
+    real model can run one forward pass per batch instead of per image.
+    """
+
+    @abstractmethod
+    def classify_batch(self, images: list[str | bytes]) -> list[str]:
+        """`images` hold encoded image bytes or base64 data URLs."""
+
+
+class HeuristicClassifier(GenderClassifier):
+    """The built-in colour heuristic (no model to load)."""
+
+    def classify_batch(self, images: list[str | bytes]) -> list[str]:
+        return [classify_gender(image) for image in images]
+
+
+# "module:Class" of the GenderClassifier to load in each worker process
+CLASSIFIER_BACKEND = os.getenv(
+    "CLASSIFIER_BACKEND", "app.services.gender_ai:HeuristicClassifier"
+)
+
+_classifier = None
+
+
+def load_classifier() -> GenderClassifier:
+    global _classifier
+    if _classifier is None:
+        module_name, _, class_name = CLASSIFIER_BACKEND.partition(":")
+        _classifier = getattr(importlib.import_module(module_name), class_name)()
+    return _classifier
+
+
+def classify_batch(images: list[str | bytes]) -> list[str]:
+    """Classify several images with the configured backend."""
+    return load_classifier().classify_batch(images)
+
+
+def warm_up() -> None:
+    """
+    Load the configured backend and run one batch so decoders and model
+    weights are in memory before the first request. Called once in each
+    classifier worker process.
+    """
+    buffer = BytesIO()
+    Image.new("RGB", (64, 64), (128, 96, 64)).save(buffer, "JPEG")
+    classify_batch([buffer.getvalue()])
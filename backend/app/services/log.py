@@ -0,0 +1,25 @@
+"""
+Logging setup. Events that happen per message or per connection go
+through log_sampled, so at high traffic only a fraction of them is
+formatted and written.
+"""
+import logging
+import os
+import random
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Share of per-message/per-connection events that are logged
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+
+
+def configure_logging() -> None:
+    logging.basicConfig(
+        level=LOG_LEVEL,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+
+
+def log_sampled(logger: logging.Logger, level: int, msg: str, *args) -> None:
+    """Log about LOG_SAMPLE_RATE of calls. Arguments are only formatted if logged."""
+    if random.random() < LOG_SAMPLE_RATE and logger.isEnabledFor(level):
+        logger.log(level, msg, *args)
@@ -0,0 +1,165 @@
+"""
+Process-local metrics rendered in the Prometheus text format at /metrics.
+
+Recording is a dict update, cheap enough for per-message paths. Values
+are kept per worker process: with several uvicorn workers, a scrape sees
+whichever worker answered it.
+"""
+import math
+import time
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+WAIT_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600)
+
+_registry = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        _registry.append(self)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, value in list(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *label_values):
+        self.values[label_values] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *label_values):
+        # [per-bucket counts..., +Inf count, sum]
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, series in list(self.values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), series):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template.", ("method", "route", "status")
+)
+REDIS_COMMANDS = Counter("redis_commands_total", "Redis commands sent, pipelined ones included.", ("command",))
+REDIS_ROUNDTRIP_SECONDS = Histogram(
+    "redis_roundtrip_duration_seconds", "Redis round-trip latency; a pipeline counts as one.", ("command",)
+)
+WS_CONNECTIONS = Gauge("ws_connections", "WebSocket connections open on this worker.")
+WS_MESSAGES_RELAYED = Counter("ws_messages_relayed_total", "Chat messages relayed to a partner.")
+WS_MESSAGES_THROTTLED = Counter(
+    "ws_messages_throttled_total", "WebSocket frames dropped by the rate limiter, by limit (ws or ws_control).", ("limit",)
+)
+QUEUE_SIZE = Gauge("queue_size", "Devices waiting in each match queue bucket.", ("queue",))
+MATCH_ATTEMPTS = Counter("match_attempts_total", "/match/find outcomes (matched or queued).", ("result",))
+MATCHMAKER_PAIRS = Counter("matchmaker_pairs_total", "Pairs made by the batch matchmaker.")
+TIME_TO_MATCH_SECONDS = Histogram(
+    "time_to_match_seconds", "Time the matched partner (both sides, for batch matches) spent queued.", buckets=WAIT_BUCKETS
+)
+BAN_CHECKS = Counter(
+    "ban_checks_total", "Ban checks by where they were answered (filtered, cached or redis).", ("result",)
+)
+MODERATION_EVENTS = Counter(
+    "moderation_events_total", "Reports applied and bans issued by the moderation worker.", ("event",)
+)
+CLASSIFIER_SECONDS = Histogram(
+    "classifier_duration_seconds", "Verification classification latency, batching wait included.", ("outcome",)
+)
+
+
+def instrument_redis(client) -> None:
+    """
+    Count and time every command sent through `client` (redis.asyncio).
+    Scripts are included since they are sent with EVALSHA.
+    """
+    execute_command = client.execute_command
+    make_pipeline = client.pipeline
+
+    async def timed_execute_command(*args, **options):
+        command = str(args[0]).upper()
+        started = time.perf_counter()
+        try:
+            return await execute_command(*args, **options)
+        finally:
+            REDIS_ROUNDTRIP_SECONDS.observe(time.perf_counter() - started, command)
+            REDIS_COMMANDS.inc(command)
+
+    def timed_pipeline(*args, **kwargs):
+        pipe = make_pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        async def timed_execute(*exec_args, **exec_kwargs):
+            for command_args, _ in pipe.command_stack:
+                REDIS_COMMANDS.inc(str(command_args[0]).upper())
+            started = time.perf_counter()
+            try:
+                return await execute(*exec_args, **exec_kwargs)
+            finally:
+                REDIS_ROUNDTRIP_SECONDS.observe(time.perf_counter() - started, "PIPELINE")
+
+        pipe.execute = timed_execute
+        return pipe
+
+    client.execute_command = timed_execute_command
+    client.pipeline = timed_pipeline
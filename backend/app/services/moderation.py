@@ -1,52 +1,356 @@
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+from ..db.pubsub import create_broker
 from ..db.redis import redis_client
+from .metrics import BAN_CHECKS
+from .user_store import (
+    HASH_STORAGE,
+    USER_KEY_PREFIX,
+    BAN_REASON_FIELD,
+    BAN_UNTIL_FIELD,
+    is_unexpired,
+)
 
-REPORT_THRESHOLD = 3  # Auto-ban after N reports
+REPORT_THRESHOLD = 3  # Auto-ban after N distinct reporters within the window
 BAN_DURATION_HOURS = 24
 
-REPORTS_KEY_PREFIX = "reports:"
+# Reporters are counted per reported user in HyperLogLogs, one per
+# REPORT_WINDOW_SECONDS / REPORT_WINDOW_BUCKETS slice; the current window
+# is the union of the last REPORT_WINDOW_BUCKETS slices, so reports age
+# out a slice at a time and each user costs at most that many small keys.
+REPORTERS_KEY_PREFIX = "reporters:"
+REPORT_WINDOW_SECONDS = int(os.getenv("REPORT_WINDOW_SECONDS", "86400"))
+REPORT_WINDOW_BUCKETS = 12
+REPORT_BUCKET_SECONDS = max(1, REPORT_WINDOW_SECONDS // REPORT_WINDOW_BUCKETS)
+
 BAN_KEY_PREFIX = "ban:"
 
+# device_id -> ban expiry (epoch seconds) for every ban, in either storage
+# format; workers build their ban filter from it
+BAN_INDEX_KEY = "ban_index"
+BAN_INDEX_READY_KEY = "ban_index:ready"
+BAN_CHANNEL = "moderation:bans"
+
+# Report events awaiting the moderation worker (see moderation_worker.py)
+REPORT_STREAM_KEY = "moderation:reports"
+REPORT_STREAM_MAXLEN = 100_000
+
+BAN_CACHE_TTL_SECONDS = float(os.getenv("BAN_CACHE_TTL_SECONDS", "60"))
+BAN_CACHE_MAX_ENTRIES = 100_000
+BAN_FILTER_CAPACITY = int(os.getenv("BAN_FILTER_CAPACITY", "100000"))
+BAN_FILTER_ERROR_RATE = 0.001
+BAN_FILTER_REBUILD_SECONDS = float(os.getenv("BAN_FILTER_REBUILD_SECONDS", "60"))
+
+logger = logging.getLogger(__name__)
+
 
-def report_user(reported_id: str, reporter_id: str) -> None:
-    """Record a report against a user."""
+async def enqueue_report(reported_id: str, reporter_id: str) -> None:
+    """
+    Queue a report for the moderation worker, which counts it and applies
+    the auto-ban. A single stream append; nothing waits for the outcome.
+    """
     if not reported_id:
         return
-    redis_client.incr(f"{REPORTS_KEY_PREFIX}{reported_id}")
+    await redis_client.xadd(
+        REPORT_STREAM_KEY,
+        {
+            "reported": reported_id,
+            "reporter": reporter_id,
+            "at": time.time(),
+        },
+        maxlen=REPORT_STREAM_MAXLEN,
+        approximate=True,
+    )
+
+
+def _reporters_key(device_id: str, bucket: int) -> str:
+    return f"{REPORTERS_KEY_PREFIX}{device_id}:{bucket}"
+
+
+def _window_keys(device_id: str, now: float) -> list[str]:
+    """The bucket keys making up the current window, newest first."""
+    current = int(now // REPORT_BUCKET_SECONDS)
+    return [_reporters_key(device_id, current - i) for i in range(REPORT_WINDOW_BUCKETS)]
 
 
-def get_report_count(device_id: str) -> int:
-    """Get number of reports against a user."""
-    count = redis_client.get(f"{REPORTS_KEY_PREFIX}{device_id}")
-    return int(count) if count else 0
+async def record_reports(reports: list[tuple[str, str, float]]) -> dict[str, int]:
+    """
+    Add (reported_id, reporter_id, reported_at) reports in one pipeline.
+    Returns each reported user's distinct reporters in the current window.
+    """
+    now = time.time()
+    pipe = redis_client.pipeline()
+    reported_ids = []
+    for reported_id, reporter_id, reported_at in reports:
+        bucket = int(reported_at // REPORT_BUCKET_SECONDS)
+        # Keep the bucket until the window has moved past all of it
+        ttl = (bucket + 1) * REPORT_BUCKET_SECONDS + REPORT_WINDOW_SECONDS - now
+        if ttl <= 0:
+            continue
+        key = _reporters_key(reported_id, bucket)
+        pipe.pfadd(key, reporter_id)
+        pipe.expire(key, math.ceil(ttl))
+        if reported_id not in reported_ids:
+            reported_ids.append(reported_id)
+    for reported_id in reported_ids:
+        pipe.pfcount(*_window_keys(reported_id, now))
+    if not reported_ids:
+        return {}
+    results = await pipe.execute()
+    return dict(zip(reported_ids, results[-len(reported_ids):]))
 
 
-def is_banned(device_id: str) -> bool:
+async def get_report_count(device_id: str) -> int:
+    """Distinct users who reported `device_id` in the current window."""
+    return await redis_client.pfcount(*_window_keys(device_id, time.time()))
+
+
+async def is_banned(device_id: str) -> bool:
     """Check if user is banned."""
-    return redis_client.exists(f"{BAN_KEY_PREFIX}{device_id}") == 1
+    return await get_ban_reason(device_id) is not None
 
 
-def ban_user(device_id: str, reason: str = "abuse") -> None:
-    """Ban a user for the configured duration."""
+async def ban_user(device_id: str, reason: str = "abuse") -> None:
+    """Ban a user for the configured duration and tell every worker."""
     if not device_id:
         return
     seconds = BAN_DURATION_HOURS * 3600
-    redis_client.setex(
-        f"{BAN_KEY_PREFIX}{device_id}",
-        seconds,
-        reason
-    )
+    until = time.time() + seconds
+    pipe = redis_client.pipeline()
+    if HASH_STORAGE:
+        pipe.hset(
+            f"{USER_KEY_PREFIX}{device_id}",
+            mapping={
+                BAN_REASON_FIELD: reason,
+                BAN_UNTIL_FIELD: until,
+            },
+        )
+    else:
+        pipe.setex(
+            f"{BAN_KEY_PREFIX}{device_id}",
+            seconds,
+            reason
+        )
+    pipe.zadd(BAN_INDEX_KEY, {device_id: until})
+    await pipe.execute()
+    ban_cache.add(device_id, reason, until)
+    await ban_cache.broker.publish(BAN_CHANNEL, json.dumps({
+        "device_id": device_id,
+        "reason": reason,
+        "until": until,
+    }))
+
+
+async def auto_ban_if_needed(device_id: str, report_count: int | None = None) -> bool:
+    """
+    Check report count and auto-ban if threshold exceeded. Returns True if
+    this call banned the user; users already banned are left as they are,
+    so further reports don't extend the ban.
+    Pass `report_count` when it is already known (e.g. from record_reports).
+    """
+    if report_count is None:
+        report_count = await get_report_count(device_id)
+    if report_count < REPORT_THRESHOLD or await is_banned(device_id):
+        return False
+    await ban_user(device_id, "report_threshold")
+    return True
+
+
+async def _read_ban(device_id: str) -> tuple[str | None, float | None]:
+    """(reason, until) from Redis; until is None when not known."""
+    if HASH_STORAGE:
+        reason, until = await redis_client.hmget(
+            f"{USER_KEY_PREFIX}{device_id}", [BAN_REASON_FIELD, BAN_UNTIL_FIELD]
+        )
+        if not is_unexpired(until):
+            return None, None
+        return reason, float(until)
+    return await redis_client.get(f"{BAN_KEY_PREFIX}{device_id}"), None
+
+
+async def get_ban_reason(device_id: str) -> str | None:
+    """
+    Get the reason a user is banned (if banned). Answered locally unless
+    the bloom filter flags the id and the answer isn't cached yet.
+    """
+    if not ban_cache.might_be_banned(device_id):
+        BAN_CHECKS.inc("filtered")
+        return None
+    found, reason = ban_cache.lookup(device_id)
+    if found:
+        BAN_CHECKS.inc("cached")
+        return reason
+    BAN_CHECKS.inc("redis")
+    reason, until = await _read_ban(device_id)
+    ban_cache.store(device_id, reason, until)
+    return reason
+
+
+class _BloomFilter:
+    """Fixed-size bloom filter over device ids; no false negatives."""
+
+    def __init__(self, capacity: int, error_rate: float = BAN_FILTER_ERROR_RATE):
+        capacity = max(1, capacity)
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item: str) -> None:
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class BanCache:
+    """
+    Per-worker view of who is banned. Every active ban is in the bloom
+    filter, so an id it doesn't contain is not banned and needs no Redis
+    read. Ids it does contain (bans and the odd false positive) are looked
+    up once and the answer is kept for BAN_CACHE_TTL_SECONDS.
+
+    New bans are added by ban_user on the worker that made them and
+    broadcast on BAN_CHANNEL to the others. The filter is rebuilt from
+    BAN_INDEX_KEY every BAN_FILTER_REBUILD_SECONDS, which drops expired
+    bans and repairs anything a missed broadcast left out. Until the
+    first build it answers "maybe" for everyone.
+    """
+
+    def __init__(self):
+        self.filter = None
+        # device_id -> (reason or None, monotonic expiry)
+        self.entries = {}
+        # Ids added while a rebuild is reading BAN_INDEX_KEY; merged into
+        # the new filter so they aren't lost with the old one
+        self.added_during_rebuild = None
+        self.broker = create_broker()
+
+    def might_be_banned(self, device_id: str) -> bool:
+        return self.filter is None or device_id in self.filter
+
+    def lookup(self, device_id: str) -> tuple[bool, str | None]:
+        """(found, reason) from the answer cache."""
+        entry = self.entries.get(device_id)
+        if entry is None:
+            return False, None
+        if entry[1] <= time.monotonic():
+            del self.entries[device_id]
+            return False, None
+        return True, entry[0]
+
+    def store(self, device_id: str, reason: str | None, until: float | None = None) -> None:
+        ttl = BAN_CACHE_TTL_SECONDS
+        if until is not None:
+            ttl = min(ttl, until - time.time())
+        now = time.monotonic()
+        if len(self.entries) >= BAN_CACHE_MAX_ENTRIES:
+            self.entries = {key: entry for key, entry in self.entries.items() if entry[1] > now}
+            if len(self.entries) >= BAN_CACHE_MAX_ENTRIES:
+                self.entries.clear()
+        self.entries[device_id] = (reason, now + ttl)
+
+    def add(self, device_id: str, reason: str, until: float) -> None:
+        if self.filter is not None:
+            self.filter.add(device_id)
+        if self.added_during_rebuild is not None:
+            self.added_during_rebuild.add(device_id)
+        self.store(device_id, reason, until)
+
+    async def rebuild(self) -> None:
+        now = time.time()
+        self.added_during_rebuild = set()
+        try:
+            pipe = redis_client.pipeline()
+            pipe.zremrangebyscore(BAN_INDEX_KEY, "-inf", now)
+            pipe.zrangebyscore(BAN_INDEX_KEY, now, "+inf")
+            _, banned = await pipe.execute()
+            bloom = _BloomFilter(max(BAN_FILTER_CAPACITY, 2 * len(banned)))
+            for device_id in [*banned, *self.added_during_rebuild]:
+                bloom.add(device_id)
+            self.filter = bloom
+        finally:
+            self.added_during_rebuild = None
+
+    def _apply(self, message: str) -> None:
+        try:
+            event = json.loads(message)
+            self.add(event["device_id"], event["reason"], float(event["until"]))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring malformed ban event: %s", e)
+
+    async def run(self) -> None:
+        """Background job: follow ban broadcasts and rebuild the filter."""
+        await self.broker.subscribe(BAN_CHANNEL)
+        next_rebuild = 0.0
+        while True:
+            if time.monotonic() >= next_rebuild:
+                try:
+                    await _index_existing_bans()
+                    await self.rebuild()
+                    next_rebuild = time.monotonic() + BAN_FILTER_REBUILD_SECONDS
+                except Exception as e:
+                    logger.warning("Ban filter rebuild failed: %s", e)
+                    next_rebuild = time.monotonic() + 5
+            try:
+                delivery = await self.broker.get_message(timeout=1.0)
+            except Exception as e:
+                logger.warning("Ban event receive failed: %s", e)
+                await asyncio.sleep(1.0)
+                continue
+            if delivery:
+                self._apply(delivery[1])
+
+
+async def _index_existing_bans() -> None:
+    """
+    Add bans made before BAN_INDEX_KEY existed to it. Runs once per
+    database; later calls return after one EXISTS.
+    """
+    if await redis_client.exists(BAN_INDEX_READY_KEY):
+        return
+    now = time.time()
+    pattern = f"{USER_KEY_PREFIX}*" if HASH_STORAGE else f"{BAN_KEY_PREFIX}*"
+    batch = []
 
+    async def flush():
+        pipe = redis_client.pipeline()
+        for key in batch:
+            if HASH_STORAGE:
+                pipe.hget(key, BAN_UNTIL_FIELD)
+            else:
+                pipe.pttl(key)
+        results = await pipe.execute()
+        bans = {}
+        for key, result in zip(batch, results):
+            if HASH_STORAGE and is_unexpired(result, now):
+                bans[key[len(USER_KEY_PREFIX):]] = float(result)
+            elif not HASH_STORAGE and result is not None and result != -2:
+                until = now + result / 1000 if result > 0 else now + BAN_DURATION_HOURS * 3600
+                bans[key[len(BAN_KEY_PREFIX):]] = until
+        if bans:
+            await redis_client.zadd(BAN_INDEX_KEY, bans)
+        batch.clear()
 
-def auto_ban_if_needed(device_id: str) -> bool:
-    """Check report count and auto-ban if threshold exceeded. Returns True if banned."""
-    if get_report_count(device_id) >= REPORT_THRESHOLD:
-        ban_user(device_id, "report_threshold")
-        return True
-    return False
+    async for key in redis_client.scan_iter(match=pattern, count=500):
+        batch.append(key)
+        if len(batch) >= 500:
+            await flush()
+    if batch:
+        await flush()
+    await redis_client.set(BAN_INDEX_READY_KEY, 1)
 
 
-def get_ban_reason(device_id: str) -> str | None:
-    """Get the reason a user is banned (if banned)."""
-    if is_banned(device_id):
-        return redis_client.get(f"{BAN_KEY_PREFIX}{device_id}")
-    return None
+ban_cache = BanCache()
@@ -0,0 +1,123 @@
+"""
+Moderation worker: applies the reports that chat sockets append to
+REPORT_STREAM_KEY, so reporting costs the socket one write.
+
+Reports are read in batches through a consumer group, added to the
+reported users' reporter counts in one pipeline, and users with
+REPORT_THRESHOLD distinct reporters in the current window are banned and
+told so on their socket. Entries are acknowledged once applied; ones left
+unacknowledged by a consumer that died are claimed by another after
+MODERATION_CLAIM_IDLE_MS. Delivery is at-least-once, which is harmless
+here: a redelivered report adds a reporter that is already counted, and
+users already banned are not banned (or notified) again.
+
+Every API worker runs a consumer by default. With
+MODERATION_WORKER_ENABLED=0 they don't, and `python -m
+app.tools.moderation_worker` runs consumers as separate processes.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+from redis.exceptions import ResponseError
+from ..db.redis import redis_client, IN_MEMORY_BACKEND
+from .metrics import MODERATION_EVENTS
+from .moderation import REPORT_STREAM_KEY, record_reports, auto_ban_if_needed
+
+logger = logging.getLogger(__name__)
+
+MODERATION_WORKER_ENABLED = os.getenv("MODERATION_WORKER_ENABLED", "1") == "1"
+MODERATION_GROUP = "moderation"
+MODERATION_BATCH_SIZE = int(os.getenv("MODERATION_BATCH_SIZE", "100"))
+MODERATION_BLOCK_MS = 1000
+MODERATION_CLAIM_IDLE_MS = 60_000
+CLAIM_INTERVAL_SECONDS = 30
+
+CONSUMER_NAME = f"{socket.gethostname()}-{os.getpid()}"
+
+
+async def _ensure_group() -> None:
+    try:
+        await redis_client.xgroup_create(REPORT_STREAM_KEY, MODERATION_GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+async def process_reports(entries: list, on_ban) -> list[str]:
+    """Apply one batch of (entry_id, fields) report entries. Returns who was banned."""
+    now = time.time()
+    reports = [
+        (fields["reported"], fields["reporter"], float(fields.get("at") or now))
+        for _, fields in entries
+        # Without a reporter an entry can't be counted as a distinct one
+        if fields.get("reported") and fields.get("reporter")
+    ]
+    banned = []
+    if reports:
+        totals = await record_reports(reports)
+        for device_id, total in totals.items():
+            if await auto_ban_if_needed(device_id, total):
+                banned.append(device_id)
+    await redis_client.xack(REPORT_STREAM_KEY, MODERATION_GROUP, *[entry_id for entry_id, _ in entries])
+    MODERATION_EVENTS.inc("report", amount=len(reports))
+    MODERATION_EVENTS.inc("ban", amount=len(banned))
+    for device_id in banned:
+        try:
+            await on_ban(device_id)
+        except Exception as e:
+            logger.warning("Could not notify banned user %s: %s", device_id, e)
+    return banned
+
+
+async def _claim_abandoned(on_ban) -> None:
+    result = await redis_client.xautoclaim(
+        REPORT_STREAM_KEY,
+        MODERATION_GROUP,
+        CONSUMER_NAME,
+        min_idle_time=MODERATION_CLAIM_IDLE_MS,
+        count=MODERATION_BATCH_SIZE,
+    )
+    # Entries trimmed from the stream come back empty
+    entries = [(entry_id, fields) for entry_id, fields in result[1] if entry_id and fields]
+    if entries:
+        logger.info("Claimed %d abandoned report entries", len(entries))
+        await process_reports(entries, on_ban)
+
+
+async def run_moderation_worker(on_ban) -> None:
+    """
+    Consume report events until cancelled. `on_ban(device_id)` is awaited
+    for every user the worker bans.
+    """
+    next_claim = 0.0
+    group_ready = False
+    while True:
+        try:
+            if not group_ready:
+                await _ensure_group()
+                group_ready = True
+            if time.monotonic() >= next_claim:
+                await _claim_abandoned(on_ban)
+                next_claim = time.monotonic() + CLAIM_INTERVAL_SECONDS
+            response = await redis_client.xreadgroup(
+                MODERATION_GROUP,
+                CONSUMER_NAME,
+                {REPORT_STREAM_KEY: ">"},
+                count=MODERATION_BATCH_SIZE,
+                block=MODERATION_BLOCK_MS,
+            )
+            entries = [entry for _, stream_entries in response for entry in stream_entries]
+            if entries:
+                await process_reports(entries, on_ban)
+            elif IN_MEMORY_BACKEND:
+                # The in-memory backend returns at once instead of blocking
+                await asyncio.sleep(MODERATION_BLOCK_MS / 1000)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # NOGROUP after the stream was deleted: recreate it next time
+            group_ready = "NOGROUP" not in str(e)
+            logger.warning("Moderation batch failed: %s", e)
+            await asyncio.sleep(1.0)
@@ -0,0 +1,32 @@
+"""
+Presence records: presence:{id} exists while a device is reachable. It is
+written when the device queues, refreshed by socket heartbeats and
+/match/status polls, and expires on its own once a client goes silent,
+so matchmaking can pass over queue members who are no longer there.
+"""
+import os
+from ..db.redis import redis_client
+
+PRESENCE_KEY_PREFIX = "presence:"
+PRESENCE_TTL_SECONDS = int(os.getenv("PRESENCE_TTL_SECONDS", "60"))
+
+
+def presence_key(device_id: str) -> str:
+    return f"{PRESENCE_KEY_PREFIX}{device_id}"
+
+
+def stage_presence(pipe, device_id: str) -> None:
+    pipe.set(presence_key(device_id), 1, ex=PRESENCE_TTL_SECONDS)
+
+
+async def mark_present(*device_ids: str) -> None:
+    if not device_ids:
+        return
+    pipe = redis_client.pipeline()
+    for device_id in device_ids:
+        stage_presence(pipe, device_id)
+    await pipe.execute()
+
+
+async def clear_presence(device_id: str) -> None:
+    await redis_client.delete(presence_key(device_id))
@@ -1,48 +1,205 @@
-from ..db.redis import redis_client
-from ..services.user_store import get_gender, get_preference, set_preference
+from ..db.redis import redis_client, IN_MEMORY_BACKEND
+from ..services.metrics import MATCHMAKER_PAIRS, TIME_TO_MATCH_SECONDS
+from ..services.presence import presence_key, stage_presence
+from ..services.user_store import (
+    get_gender,
+    set_preference,
+    stage_preference,
+    normalize_preference,
+    is_unexpired,
+    HASH_STORAGE,
+    USER_KEY_PREFIX,
+    COOLDOWN_UNTIL_FIELD,
+    LIMIT_FIELD_PREFIX,
+)
+import asyncio
+import logging
+import os
 import time
+from collections import deque
 from datetime import datetime, timedelta, timezone
 
+logger = logging.getLogger(__name__)
+
 COOLDOWN_SECONDS = 1  # very short for testing matching
 DAILY_SPECIFIC_LIMIT = 5
 
-QUEUE_MALE = "queue:male"
-QUEUE_FEMALE = "queue:female"
-
-
-def is_on_cooldown(device_id: str) -> bool:
-    return redis_client.exists(f"cooldown:{device_id}") == 1
-
-
-def set_cooldown(device_id: str):
-    redis_client.setex(
-        f"cooldown:{device_id}",
+QUEUE_KEY_PREFIX = "queue:"
+COOLDOWN_KEY_PREFIX = "cooldown:"
+ACTIVE_MATCH_KEY_PREFIX = "active_match:"
+
+# Recent time-to-match samples (seconds), newest first, capped so the
+# percentiles track current load rather than all-time history.
+WAIT_SAMPLES_KEY = "metrics:queue_wait"
+WAIT_SAMPLE_SIZE = 1000
+
+# Queue entries are leased: each waiting device has a deadline in this
+# sorted set, pushed out by keep_alive() (socket heartbeats, status polls)
+# or POST /queue/renew. Entries past their deadline are never matched and
+# are purged by the compaction job.
+QUEUE_LEASES_KEY = "queue:leases"
+QUEUE_LEASE_SECONDS = int(os.getenv("QUEUE_LEASE_SECONDS", "60"))
+QUEUE_COMPACT_INTERVAL = float(os.getenv("QUEUE_COMPACT_INTERVAL", "30"))
+COMPACT_BATCH_SIZE = 500
+COMPACTION_LOCK_KEY = "lock:queue_compaction"
+MATCH_SCAN_CHUNK = 20  # queue members read at a time when looking for a match
+# Chunks read per bucket before a find gives up on it. Offline users keep
+# their entry until the lease runs out, so this bounds the work a burst
+# of disconnects can add to each find; compaction clears them later.
+MATCH_SCAN_CHUNKS = 5
+
+# Optional batch matchmaker (see run_matchmaker). While it is on,
+# /match/find only queues users and all pairing happens in its passes.
+MATCHMAKER_ENABLED = os.getenv("MATCHMAKER_ENABLED", "0") == "1"
+MATCHMAKER_INTERVAL = float(os.getenv("MATCHMAKER_INTERVAL", "1"))
+MATCHMAKER_BATCH_SIZE = 1000  # longest waiters read from each bucket per pass
+MATCHMAKER_LOCK_KEY = "lock:matchmaker"
+
+GENDERS = ("male", "female")
+PREFERENCES = ("male", "female", "any")
+
+
+def cooldown_key(device_id: str) -> str:
+    return f"{COOLDOWN_KEY_PREFIX}{device_id}"
+
+
+def active_match_key(device_id: str) -> str:
+    return f"{ACTIVE_MATCH_KEY_PREFIX}{device_id}"
+
+
+async def is_on_cooldown(device_id: str) -> bool:
+    if HASH_STORAGE:
+        until = await redis_client.hget(f"{USER_KEY_PREFIX}{device_id}", COOLDOWN_UNTIL_FIELD)
+        return is_unexpired(until)
+    return await redis_client.exists(cooldown_key(device_id)) == 1
+
+
+async def set_cooldown(device_id: str):
+    if HASH_STORAGE:
+        await redis_client.hset(
+            f"{USER_KEY_PREFIX}{device_id}",
+            mapping={COOLDOWN_UNTIL_FIELD: time.time() + COOLDOWN_SECONDS}
+        )
+        return
+    await redis_client.setex(
+        cooldown_key(device_id),
         COOLDOWN_SECONDS,
         int(time.time())
     )
 
 
-def _queue_for_gender(gender: str | None) -> str | None:
-    if gender == "male":
-        return QUEUE_MALE
-    if gender == "female":
-        return QUEUE_FEMALE
-    return None
+def _queue_key(gender: str, preference: str) -> str:
+    """
+    Bucket holding users of `gender` who are looking for `preference`.
+    Buckets are sorted sets scored by join time, so the head of each one
+    is its longest waiter.
+    """
+    return f"{QUEUE_KEY_PREFIX}{gender}:{preference}"
+
 
+ALL_QUEUES = [_queue_key(g, p) for g in GENDERS for p in PREFERENCES]
 
-def join_queue(device_id: str, preference: str) -> bool:
-    gender = get_gender(device_id)
-    queue_key = _queue_for_gender(gender)
-    if not queue_key:
+
+async def join_queue(device_id: str, preference: str, gender: str | None = None) -> bool:
+    """Queue the user under their bucket. Pass `gender` if already known."""
+    if gender is None:
+        gender = await get_gender(device_id)
+    if gender not in GENDERS:
         return False
-    set_preference(device_id, preference)
-    redis_client.sadd(queue_key, device_id)
+    now = time.time()
+    pipe = redis_client.pipeline()
+    preference = stage_preference(pipe, device_id, preference)
+    stage_presence(pipe, device_id)
+    # A user waits in one bucket only: drop any entry left from an earlier
+    # preference, and NX keeps the original join time if already waiting here
+    target = _queue_key(gender, preference)
+    for queue_key in ALL_QUEUES:
+        if queue_key != target:
+            pipe.zrem(queue_key, device_id)
+    pipe.zadd(target, {device_id: now}, nx=True)
+    pipe.zadd(QUEUE_LEASES_KEY, {device_id: now + QUEUE_LEASE_SECONDS})
+    await pipe.execute()
     return True
 
 
-def leave_all_queues(device_id: str):
-    redis_client.srem(QUEUE_MALE, device_id)
-    redis_client.srem(QUEUE_FEMALE, device_id)
+def stage_leave_all_queues(pipe, device_id: str) -> None:
+    for queue_key in ALL_QUEUES:
+        pipe.zrem(queue_key, device_id)
+    pipe.zrem(QUEUE_LEASES_KEY, device_id)
+
+
+async def leave_all_queues(device_id: str):
+    pipe = redis_client.pipeline()
+    stage_leave_all_queues(pipe, device_id)
+    await pipe.execute()
+
+
+async def renew_queue_lease(device_id: str) -> float | None:
+    """Extend a waiting device's lease. Returns the new deadline, or None if not queued."""
+    pipe = redis_client.pipeline()
+    # XX: only renew existing leases, never queue anyone
+    pipe.zadd(QUEUE_LEASES_KEY, {device_id: time.time() + QUEUE_LEASE_SECONDS}, xx=True)
+    pipe.zscore(QUEUE_LEASES_KEY, device_id)
+    _, deadline = await pipe.execute()
+    return deadline
+
+
+async def keep_alive(*device_ids: str) -> None:
+    """Refresh presence and renew any queue leases for live clients, in one pipeline."""
+    if not device_ids:
+        return
+    deadline = time.time() + QUEUE_LEASE_SECONDS
+    pipe = redis_client.pipeline()
+    for device_id in device_ids:
+        stage_presence(pipe, device_id)
+    pipe.zadd(QUEUE_LEASES_KEY, {device_id: deadline for device_id in device_ids}, xx=True)
+    await pipe.execute()
+
+
+async def get_wait_time(device_id: str) -> float | None:
+    """Seconds the user has been waiting in the queue, or None if not queued."""
+    pipe = redis_client.pipeline()
+    for queue_key in ALL_QUEUES:
+        pipe.zscore(queue_key, device_id)
+    scores = [score for score in await pipe.execute() if score is not None]
+    if not scores:
+        return None
+    return max(0.0, time.time() - min(scores))
+
+
+def _percentile(sorted_values: list[float], pct: float) -> float:
+    index = max(0, int(round(pct / 100 * len(sorted_values))) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+async def get_queue_wait_stats() -> dict:
+    """p50/p95 time-to-match over recent matches, plus current queue depth."""
+    pipe = redis_client.pipeline()
+    pipe.lrange(WAIT_SAMPLES_KEY, 0, -1)
+    for queue_key in ALL_QUEUES:
+        pipe.zcard(queue_key)
+    samples, *sizes = await pipe.execute()
+
+    waits = sorted(float(w) for w in samples)
+    stats = {
+        "queued": sum(sizes),
+        "samples": len(waits),
+        "p50_seconds": None,
+        "p95_seconds": None,
+    }
+    if waits:
+        stats["p50_seconds"] = round(_percentile(waits, 50), 3)
+        stats["p95_seconds"] = round(_percentile(waits, 95), 3)
+    return stats
+
+
+async def get_queue_sizes() -> dict[str, int]:
+    """Devices in each queue bucket, keyed like "male:any"."""
+    pipe = redis_client.pipeline()
+    for queue_key in ALL_QUEUES:
+        pipe.zcard(queue_key)
+    sizes = await pipe.execute()
+    return {queue_key[len(QUEUE_KEY_PREFIX):]: size for queue_key, size in zip(ALL_QUEUES, sizes)}
 
 
 def _desired_genders(preference: str) -> list[str]:
@@ -53,58 +210,603 @@ def _desired_genders(preference: str) -> list[str]:
     return ["male", "female"]
 
 
-def _is_preference_compatible(requester_gender: str | None, candidate_id: str) -> bool:
-    if not requester_gender:
-        return False
-    candidate_pref = get_preference(candidate_id)
-    return candidate_pref == "any" or candidate_pref == requester_gender
+def _compatible_queues(requester_gender: str, preference: str) -> list[str]:
+    """
+    Buckets whose every member is a valid partner for the requester:
+    the genders the requester wants, restricted to people who want the
+    requester's gender or anyone.
+    """
+    accepted_prefs = ("any",)
+    if requester_gender in GENDERS:
+        accepted_prefs = (requester_gender, "any")
+    return [
+        _queue_key(gender, candidate_pref)
+        for gender in _desired_genders(preference)
+        for candidate_pref in accepted_prefs
+    ]
+
+
+# Candidate selection, queue removal and writing the pairing + cooldowns
+# all happen inside one server-side script, so a find costs a single
+# round-trip and two workers can never claim the same user. Every bucket
+# passed in is already preference-compatible, so each bucket is walked
+# from its head to its first matchable member, reading at most a fixed
+# number of chunks, and the oldest of those wins. Entries that can never match (lease ran out, or the user is
+# already in a chat) are removed as they surface. Users whose presence
+# record lapsed are only passed over: a socket that reconnects within
+# the lease finds its place still held, and compaction drops the entry
+# once the lease is gone. The matched user's wait time is recorded for
+# the queue-wait percentiles.
+#
+# KEYS: queues to search, then the wait-samples list, then the lease set
+# ARGV: device_id, cooldown_seconds, now, wait_sample_size, hash_storage,
+#       members read per ZRANGE while walking a bucket, ZRANGEs per bucket
+# Returns {partner_id, seconds the partner waited}, or nil
+MATCH_SCRIPT = """
+local leases_key = KEYS[#KEYS]
+local samples_key = KEYS[#KEYS - 1]
+local device_id = ARGV[1]
+local cooldown = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local sample_size = tonumber(ARGV[4])
+local hash_storage = ARGV[5] == '1'
+local chunk = tonumber(ARGV[6])
+local max_chunks = tonumber(ARGV[7])
+local stamp = tostring(math.floor(now))
+
+local function set_cooldown(u)
+    if hash_storage then
+        redis.call('HSET', 'user:' .. u, 'cooldown_until', tostring(now + cooldown))
+    else
+        redis.call('SETEX', 'cooldown:' .. u, cooldown, stamp)
+    end
+end
+
+-- Oldest member of `queue` that can be matched now, and its join time
+local function first_matchable(queue)
+    local offset = 0
+    for _ = 1, max_chunks do
+        local members = redis.call('ZRANGE', queue, offset, offset + chunk - 1, 'WITHSCORES')
+        if #members == 0 then
+            return nil, nil
+        end
+        local dropped = 0
+        for j = 1, #members, 2 do
+            local u = members[j]
+            if u ~= device_id then
+                local lease = tonumber(redis.call('ZSCORE', leases_key, u))
+                if not lease or lease < now or redis.call('EXISTS', 'active_match:' .. u) == 1 then
+                    redis.call('ZREM', queue, u)
+                    redis.call('ZREM', leases_key, u)
+                    dropped = dropped + 1
+                elseif redis.call('EXISTS', 'presence:' .. u) == 1 then
+                    return u, tonumber(members[j + 1])
+                end
+            end
+        end
+        offset = offset + #members / 2 - dropped
+    end
+    return nil, nil
+end
+
+local best, best_queue, best_score = nil, nil, nil
+for i = 1, #KEYS - 2 do
+    local u, score = first_matchable(KEYS[i])
+    if u and (not best_score or score < best_score) then
+        best, best_queue, best_score = u, KEYS[i], score
+    end
+end
+if not best then
+    return false
+end
+
+redis.call('ZREM', best_queue, best)
+redis.call('ZREM', leases_key, best)
+redis.call('SET', 'active_match:' .. device_id, best)
+redis.call('SET', 'active_match:' .. best, device_id)
+set_cooldown(device_id)
+set_cooldown(best)
+local waited = tostring(math.max(0, now - best_score))
+redis.call('LPUSH', samples_key, waited)
+redis.call('LTRIM', samples_key, 0, sample_size - 1)
+return {best, waited}
+"""
+
+_match_script = None if IN_MEMORY_BACKEND else redis_client.register_script(MATCH_SCRIPT)
+
+# The in-memory backend has no scripting; a process-wide lock gives the
+# in-process equivalent the same all-or-nothing behaviour across
+# concurrent requests.
+_in_process_match_lock = asyncio.Lock()
+
+
+async def _waiter_status(device_id: str, now: float) -> bool | None:
+    """
+    True if a queued device can be matched now, False if it is only
+    offline (keep its entry), None if its entry should be dropped.
+    """
+    lease = await redis_client.zscore(QUEUE_LEASES_KEY, device_id)
+    if lease is None or lease < now or await redis_client.exists(active_match_key(device_id)):
+        return None
+    return bool(await redis_client.exists(presence_key(device_id)))
+
+
+async def _first_matchable(queue: str, device_id: str, now: float):
+    offset = 0
+    for _ in range(MATCH_SCAN_CHUNKS):
+        members = await redis_client.zrange(queue, offset, offset + MATCH_SCAN_CHUNK - 1, withscores=True)
+        if not members:
+            return None
+        dropped = 0
+        for member, joined_at in members:
+            if member == device_id:
+                continue
+            status = await _waiter_status(member, now)
+            if status is None:
+                await redis_client.zrem(queue, member)
+                await redis_client.zrem(QUEUE_LEASES_KEY, member)
+                dropped += 1
+            elif status:
+                return member, joined_at
+        offset += len(members) - dropped
+    return None
 
 
-def try_match(device_id: str, preference: str):
+async def _match_in_process(queues: list[str], device_id: str):
+    """In-process equivalent of MATCH_SCRIPT for the in-memory backend."""
+    async with _in_process_match_lock:
+        now = time.time()
+        best = None
+        for queue in queues:
+            candidate = await _first_matchable(queue, device_id, now)
+            if candidate and (best is None or candidate[1] < best[2]):
+                best = (candidate[0], queue, candidate[1])
+        if best is None:
+            return None
+        u, queue, joined_at = best
+        await redis_client.zrem(queue, u)
+        await redis_client.zrem(QUEUE_LEASES_KEY, u)
+        await redis_client.set(active_match_key(device_id), u)
+        await redis_client.set(active_match_key(u), device_id)
+        await set_cooldown(device_id)
+        await set_cooldown(u)
+        waited = max(0.0, now - joined_at)
+        await redis_client.lpush(WAIT_SAMPLES_KEY, waited)
+        await redis_client.ltrim(WAIT_SAMPLES_KEY, 0, WAIT_SAMPLE_SIZE - 1)
+        return u, waited
+
+
+async def try_match(device_id: str, preference: str, gender: str | None = None):
     """
-    Attempts to find a match.
+    Attempts to find a match with the longest-waiting compatible user.
     Returns matched_device_id or None
+
+    Callers that already loaded the user's state pass `gender` and have
+    persisted the preference themselves, saving two round-trips.
     """
 
-    requester_gender = get_gender(device_id)
+    requester_gender = gender
+    if requester_gender is None:
+        requester_gender = await get_gender(device_id)
+        await set_preference(device_id, preference)
     if not requester_gender:
         return None
 
-    set_preference(device_id, preference)
+    preference = normalize_preference(preference)
+
+    queues = _compatible_queues(requester_gender, preference)
+
+    if _match_script is None:
+        match = await _match_in_process(queues, device_id)
+    else:
+        match = await _match_script(
+            keys=[*queues, WAIT_SAMPLES_KEY, QUEUE_LEASES_KEY],
+            args=[
+                device_id,
+                COOLDOWN_SECONDS,
+                time.time(),
+                WAIT_SAMPLE_SIZE,
+                int(HASH_STORAGE),
+                MATCH_SCAN_CHUNK,
+                MATCH_SCAN_CHUNKS,
+            ],
+        )
+    if not match:
+        return None
+    partner_id, waited = match
+    TIME_TO_MATCH_SECONDS.observe(float(waited))
+    return partner_id
+
+
+async def get_active_match(device_id: str) -> str | None:
+    return await redis_client.get(active_match_key(device_id))
+
+
+# Batch matchmaking. Each pass pairs a snapshot of the queues in process
+# and commits every pair with one script call. The script re-checks each
+# pair first: users matched by /match/find, offline or gone since the
+# snapshot are skipped, and stale entries are dropped from the queue as
+# in MATCH_SCRIPT.
+#
+# KEYS: queues, then the wait-samples list, then the lease set
+# ARGV: now, cooldown_seconds, wait_sample_size, hash_storage, then per
+#       pair: device_id, its queue's KEYS index, partner_id, its index
+# Returns {device_id, partner_id, device wait, partner wait} per pair made
+APPLY_PAIRS_SCRIPT = """
+local leases_key = KEYS[#KEYS]
+local samples_key = KEYS[#KEYS - 1]
+local now = tonumber(ARGV[1])
+local cooldown = tonumber(ARGV[2])
+local sample_size = tonumber(ARGV[3])
+local hash_storage = ARGV[4] == '1'
+local stamp = tostring(math.floor(now))
+
+local function set_cooldown(u)
+    if hash_storage then
+        redis.call('HSET', 'user:' .. u, 'cooldown_until', tostring(now + cooldown))
+    else
+        redis.call('SETEX', 'cooldown:' .. u, cooldown, stamp)
+    end
+end
+
+-- Join time if u is still waiting in queue and can be matched
+local function waiting_since(u, queue)
+    local joined = redis.call('ZSCORE', queue, u)
+    if not joined then
+        return nil
+    end
+    local lease = tonumber(redis.call('ZSCORE', leases_key, u))
+    if not lease or lease < now or redis.call('EXISTS', 'active_match:' .. u) == 1 then
+        redis.call('ZREM', queue, u)
+        redis.call('ZREM', leases_key, u)
+        return nil
+    end
+    -- Offline but still leased: keep the entry for when it reconnects
+    if redis.call('EXISTS', 'presence:' .. u) == 0 then
+        return nil
+    end
+    return tonumber(joined)
+end
+
+local made = {}
+for i = 5, #ARGV, 4 do
+    local a, a_queue = ARGV[i], KEYS[tonumber(ARGV[i + 1])]
+    local b, b_queue = ARGV[i + 2], KEYS[tonumber(ARGV[i + 3])]
+    local a_joined, b_joined
+    if a ~= b then
+        a_joined = waiting_since(a, a_queue)
+        b_joined = waiting_since(b, b_queue)
+    end
+    if a_joined and b_joined then
+        redis.call('ZREM', a_queue, a)
+        redis.call('ZREM', b_queue, b)
+        redis.call('ZREM', leases_key, a, b)
+        redis.call('SET', 'active_match:' .. a, b)
+        redis.call('SET', 'active_match:' .. b, a)
+        set_cooldown(a)
+        set_cooldown(b)
+        local a_waited = tostring(math.max(0, now - a_joined))
+        local b_waited = tostring(math.max(0, now - b_joined))
+        redis.call('LPUSH', samples_key, a_waited, b_waited)
+        table.insert(made, a)
+        table.insert(made, b)
+        table.insert(made, a_waited)
+        table.insert(made, b_waited)
+    end
+end
+if #made > 0 then
+    redis.call('LTRIM', samples_key, 0, sample_size - 1)
+end
+return made
+"""
+
+_apply_pairs_script = None if IN_MEMORY_BACKEND else redis_client.register_script(APPLY_PAIRS_SCRIPT)
+
+# (gender, preference) of each bucket and the buckets it can pair with,
+# both indexed like ALL_QUEUES
+_QUEUE_TYPES = [(g, p) for g in GENDERS for p in PREFERENCES]
+_COMPATIBLE_INDEXES = [
+    [ALL_QUEUES.index(queue) for queue in _compatible_queues(g, p)]
+    for g, p in _QUEUE_TYPES
+]
+
+
+async def _snapshot_waiting(now: float) -> list[tuple[float, str, int]]:
+    """(join time, device_id, queue index) of matchable waiters, oldest first."""
+    pipe = redis_client.pipeline()
+    for queue_key in ALL_QUEUES:
+        pipe.zrange(queue_key, 0, MATCHMAKER_BATCH_SIZE - 1, withscores=True)
+    waiting = [
+        (joined, device_id, index)
+        for index, members in enumerate(await pipe.execute())
+        for device_id, joined in members
+    ]
+    if not waiting:
+        return []
+
+    device_ids = [device_id for _, device_id, _ in waiting]
+    pipe = redis_client.pipeline()
+    pipe.mget([presence_key(device_id) for device_id in device_ids])
+    pipe.mget([active_match_key(device_id) for device_id in device_ids])
+    for device_id in device_ids:
+        pipe.zscore(QUEUE_LEASES_KEY, device_id)
+    present, partners, *leases = await pipe.execute()
+    return sorted(
+        entry
+        for entry, is_present, partner_id, lease in zip(waiting, present, partners, leases)
+        if is_present and partner_id is None and lease is not None and lease >= now
+    )
 
-    def pop_compatible_from(queue):
-        users = list(redis_client.smembers(queue))
-        for u in users:
-            if u == device_id:
+
+def _pair_waiting(waiting: list[tuple[float, str, int]]) -> list[tuple[str, int, str, int]]:
+    """
+    Pair the longest unpaired waiter with the longest-waiting compatible
+    user, oldest first, until no compatible users are left unpaired.
+    Returns (device_id, queue index, partner_id, queue index) tuples.
+    """
+    queues = [deque() for _ in ALL_QUEUES]
+    for joined, device_id, index in waiting:
+        queues[index].append((joined, device_id))
+
+    # Devices already handled, paired or not. A device can turn up in two
+    # buckets, so heads belonging to one are dropped lazily
+    paired = set()
+
+    def head(index):
+        queue = queues[index]
+        while queue and queue[0][1] in paired:
+            queue.popleft()
+        return queue[0] if queue else None
+
+    pairs = []
+    for _, device_id, index in waiting:
+        if device_id in paired:
+            continue
+        # Everyone older in this bucket has been handled, so it's the head
+        head(index)
+        queues[index].popleft()
+        paired.add(device_id)
+        best = None
+        for other in _COMPATIBLE_INDEXES[index]:
+            candidate = head(other)
+            if candidate and (best is None or candidate < queues[best][0]):
+                best = other
+        if best is None:
+            continue
+        _, partner_id = queues[best].popleft()
+        paired.add(partner_id)
+        pairs.append((device_id, index, partner_id, best))
+    return pairs
+
+
+async def _waiting_since(device_id: str, queue: str, now: float) -> float | None:
+    joined = await redis_client.zscore(queue, device_id)
+    if joined is None:
+        return None
+    status = await _waiter_status(device_id, now)
+    if status is None:
+        await redis_client.zrem(queue, device_id)
+        await redis_client.zrem(QUEUE_LEASES_KEY, device_id)
+    return joined if status else None
+
+
+async def _apply_pairs_in_process(pairs: list, now: float) -> list[tuple[str, str, float, float]]:
+    """In-process equivalent of APPLY_PAIRS_SCRIPT for the in-memory backend."""
+    made = []
+    async with _in_process_match_lock:
+        for device_id, index, partner_id, partner_index in pairs:
+            if device_id == partner_id:
                 continue
-            # Skip users who are already in an active chat
-            if redis_client.get(f"active_match:{u}"):
-                redis_client.srem(queue, u)
+            device_queue, partner_queue = ALL_QUEUES[index], ALL_QUEUES[partner_index]
+            device_joined = await _waiting_since(device_id, device_queue, now)
+            partner_joined = await _waiting_since(partner_id, partner_queue, now)
+            if device_joined is None or partner_joined is None:
                 continue
-            if _is_preference_compatible(requester_gender, u):
-                redis_client.srem(queue, u)
-                return u
-        return None
-
-    match = None
-    for gender in _desired_genders(preference):
-        queue_key = _queue_for_gender(gender)
-        if queue_key:
-            match = pop_compatible_from(queue_key)
-        if match:
+            pipe = redis_client.pipeline()
+            pipe.zrem(device_queue, device_id)
+            pipe.zrem(partner_queue, partner_id)
+            pipe.zrem(QUEUE_LEASES_KEY, device_id, partner_id)
+            pipe.set(active_match_key(device_id), partner_id)
+            pipe.set(active_match_key(partner_id), device_id)
+            await pipe.execute()
+            await set_cooldown(device_id)
+            await set_cooldown(partner_id)
+            waits = (max(0.0, now - device_joined), max(0.0, now - partner_joined))
+            await redis_client.lpush(WAIT_SAMPLES_KEY, *waits)
+            made.append((device_id, partner_id, *waits))
+        if made:
+            await redis_client.ltrim(WAIT_SAMPLES_KEY, 0, WAIT_SAMPLE_SIZE - 1)
+    return made
+
+
+async def match_waiting_users() -> list[tuple[str, str]]:
+    """
+    One batch matchmaking pass over the queues. Returns the pairs made;
+    both sides were waiting, so both need telling.
+    """
+    now = time.time()
+    pairs = _pair_waiting(await _snapshot_waiting(now))
+    if not pairs:
+        return []
+
+    if _apply_pairs_script is None:
+        made = await _apply_pairs_in_process(pairs, now)
+    else:
+        args = [now, COOLDOWN_SECONDS, WAIT_SAMPLE_SIZE, int(HASH_STORAGE)]
+        for device_id, index, partner_id, partner_index in pairs:
+            # Lua tables are 1-based
+            args += [device_id, index + 1, partner_id, partner_index + 1]
+        result = await _apply_pairs_script(keys=[*ALL_QUEUES, WAIT_SAMPLES_KEY, QUEUE_LEASES_KEY], args=args)
+        made = [tuple(result[i:i + 4]) for i in range(0, len(result), 4)]
+    if not made:
+        return []
+
+    # Both sides chose their filter, so a specific one counts for each
+    preference_of = {}
+    for device_id, index, partner_id, partner_index in pairs:
+        preference_of[device_id] = _QUEUE_TYPES[index][1]
+        preference_of[partner_id] = _QUEUE_TYPES[partner_index][1]
+    pipe = redis_client.pipeline()
+    for device_id, partner_id, device_waited, partner_waited in made:
+        stage_specific_filter_usage(pipe, device_id, preference_of[device_id])
+        stage_specific_filter_usage(pipe, partner_id, preference_of[partner_id])
+        TIME_TO_MATCH_SECONDS.observe(float(device_waited))
+        TIME_TO_MATCH_SECONDS.observe(float(partner_waited))
+    await pipe.execute()
+    MATCHMAKER_PAIRS.inc(amount=len(made))
+    return [(device_id, partner_id) for device_id, partner_id, _, _ in made]
+
+
+async def run_matchmaker(on_match):
+    """
+    Background job: a batch matchmaking pass every MATCHMAKER_INTERVAL
+    seconds. A short lock makes only one worker run each pass.
+    `on_match(device_id, partner_id)` is awaited for each side of a pair.
+    """
+    while True:
+        await asyncio.sleep(MATCHMAKER_INTERVAL)
+        try:
+            if not await redis_client.set(MATCHMAKER_LOCK_KEY, 1, px=max(1, int(MATCHMAKER_INTERVAL * 1000)), nx=True):
+                continue
+            pairs = await match_waiting_users()
+            notifications = [
+                (a, b) for device_id, partner_id in pairs
+                for a, b in ((device_id, partner_id), (partner_id, device_id))
+            ]
+            results = await asyncio.gather(
+                *(on_match(a, b) for a, b in notifications),
+                return_exceptions=True,
+            )
+            for (device_id, partner_id), result in zip(notifications, results):
+                if isinstance(result, Exception):
+                    # The pairing stands; the client still learns of it on
+                    # its next socket connect or /match/status poll
+                    logger.warning("Could not notify %s of match with %s: %s", device_id, partner_id, result)
+        except Exception as e:
+            logger.warning("Matchmaking pass failed: %s", e)
+
+
+# Queue hygiene. Expired leases are collected in batches, each batch
+# removed from every bucket atomically so a lease renewed meanwhile is
+# never lost.
+#
+# KEYS: queues, then the lease set
+# ARGV: now, batch size
+COMPACT_QUEUES_SCRIPT = """
+local leases_key = KEYS[#KEYS]
+local expired = redis.call('ZRANGEBYSCORE', leases_key, '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, device_id in ipairs(expired) do
+    for i = 1, #KEYS - 1 do
+        redis.call('ZREM', KEYS[i], device_id)
+    end
+    redis.call('ZREM', leases_key, device_id)
+end
+return #expired
+"""
+
+# A pairing is stale when the partner's key no longer points back (one
+# side was cleaned up without the other), or when neither side has a
+# presence record (both clients are gone). Checked and deleted per key
+# inside the script so a pairing made meanwhile is never touched.
+#
+# KEYS: active_match:* keys to check
+COMPACT_MATCHES_SCRIPT = """
+local removed = 0
+for _, key in ipairs(KEYS) do
+    local device_id = string.sub(key, string.len('active_match:') + 1)
+    local partner = redis.call('GET', key)
+    if partner then
+        local partner_key = 'active_match:' .. partner
+        if redis.call('GET', partner_key) ~= device_id then
+            removed = removed + redis.call('DEL', key)
+        elseif redis.call('EXISTS', 'presence:' .. device_id, 'presence:' .. partner) == 0 then
+            removed = removed + redis.call('DEL', key, partner_key)
+        end
+    end
+end
+return removed
+"""
+
+_compact_queues_script = None if IN_MEMORY_BACKEND else redis_client.register_script(COMPACT_QUEUES_SCRIPT)
+_compact_matches_script = None if IN_MEMORY_BACKEND else redis_client.register_script(COMPACT_MATCHES_SCRIPT)
+
+
+async def _compact_queue_batch(now: float) -> int:
+    if _compact_queues_script is not None:
+        return await _compact_queues_script(
+            keys=[*ALL_QUEUES, QUEUE_LEASES_KEY],
+            args=[now, COMPACT_BATCH_SIZE],
+        )
+    async with _in_process_match_lock:
+        expired = await redis_client.zrangebyscore(
+            QUEUE_LEASES_KEY, "-inf", now, start=0, num=COMPACT_BATCH_SIZE
+        )
+        if expired:
+            pipe = redis_client.pipeline()
+            for queue_key in [*ALL_QUEUES, QUEUE_LEASES_KEY]:
+                pipe.zrem(queue_key, *expired)
+            await pipe.execute()
+        return len(expired)
+
+
+async def _compact_match_batch(keys: list[str]) -> int:
+    if _compact_matches_script is not None:
+        return await _compact_matches_script(keys=keys)
+    removed = 0
+    async with _in_process_match_lock:
+        for key in keys:
+            device_id = key[len(ACTIVE_MATCH_KEY_PREFIX):]
+            partner_id = await redis_client.get(key)
+            if partner_id is None:
+                continue
+            if await redis_client.get(active_match_key(partner_id)) != device_id:
+                removed += await redis_client.delete(key)
+            elif not await redis_client.exists(presence_key(device_id), presence_key(partner_id)):
+                removed += await redis_client.delete(key, active_match_key(partner_id))
+    return removed
+
+
+async def compact_queues() -> dict:
+    """Purge queue entries with expired leases and stale active_match keys."""
+    now = time.time()
+    expired_entries = 0
+    while True:
+        purged = await _compact_queue_batch(now)
+        expired_entries += purged
+        if purged < COMPACT_BATCH_SIZE:
             break
 
-    if match:
-        redis_client.set(f"active_match:{device_id}", match)
-        redis_client.set(f"active_match:{match}", device_id)
-        set_cooldown(device_id)
-        set_cooldown(match)
+    stale_matches = 0
+    batch = []
+    async for key in redis_client.scan_iter(match=f"{ACTIVE_MATCH_KEY_PREFIX}*", count=COMPACT_BATCH_SIZE):
+        batch.append(key)
+        if len(batch) >= COMPACT_BATCH_SIZE:
+            stale_matches += await _compact_match_batch(batch)
+            batch = []
+    if batch:
+        stale_matches += await _compact_match_batch(batch)
 
-    return match
+    return {"expired_entries": expired_entries, "stale_matches": stale_matches}
 
 
-def get_active_match(device_id: str) -> str | None:
-    return redis_client.get(f"active_match:{device_id}")
+async def run_queue_compaction():
+    """
+    Background job: compact every QUEUE_COMPACT_INTERVAL seconds. A short
+    lock makes only one worker do each round.
+    """
+    while True:
+        await asyncio.sleep(QUEUE_COMPACT_INTERVAL)
+        try:
+            if not await redis_client.set(COMPACTION_LOCK_KEY, 1, ex=max(1, int(QUEUE_COMPACT_INTERVAL)), nx=True):
+                continue
+            result = await compact_queues()
+            if result["expired_entries"] or result["stale_matches"]:
+                logger.info(
+                    "Compaction removed %d expired entries, %d stale matches",
+                    result["expired_entries"], result["stale_matches"]
+                )
+        except Exception as e:
+            logger.warning("Compaction failed: %s", e)
 
 
 def _limit_key(device_id: str, date_key: str) -> str:
@@ -115,29 +817,58 @@ def _today_key_utc() -> str:
     return datetime.now(timezone.utc).strftime("%Y-%m-%d")
 
 
-def _expire_at_end_of_day_utc(key: str) -> None:
+def specific_limit_key(device_id: str) -> str:
+    """Today's specific-filter usage counter for the user."""
+    return _limit_key(device_id, _today_key_utc())
+
+
+def specific_limit_field(date_key: str | None = None) -> str:
+    """Field in user:{id} holding a day's usage counter (hash storage)."""
+    return f"{LIMIT_FIELD_PREFIX}{date_key or _today_key_utc()}"
+
+
+def _seconds_until_end_of_day_utc() -> int:
     now = datetime.now(timezone.utc)
     end_of_day = datetime(now.year, now.month, now.day, tzinfo=timezone.utc) + timedelta(days=1)
-    ttl_seconds = int((end_of_day - now).total_seconds())
-    redis_client.expire(key, ttl_seconds)
+    return int((end_of_day - now).total_seconds())
+
 
+def is_within_specific_limit(uses: int) -> bool:
+    return uses < DAILY_SPECIFIC_LIMIT
 
-def is_specific_filter_allowed(device_id: str, preference: str) -> bool:
+
+async def is_specific_filter_allowed(device_id: str, preference: str) -> bool:
     if preference not in {"male", "female"}:
         return True
-    date_key = _today_key_utc()
-    key = _limit_key(device_id, date_key)
-    current = redis_client.get(key)
+    if HASH_STORAGE:
+        current = await redis_client.hget(f"{USER_KEY_PREFIX}{device_id}", specific_limit_field())
+    else:
+        current = await redis_client.get(specific_limit_key(device_id))
     if not current:
         return True
-    return int(current) < DAILY_SPECIFIC_LIMIT
+    return is_within_specific_limit(int(current))
+
+
+def stage_specific_filter_usage(pipe, device_id: str, preference: str) -> None:
+    if preference not in {"male", "female"}:
+        return
+    if HASH_STORAGE:
+        # Counters are per-day fields; drop yesterday's so at most one
+        # lingers in the hash.
+        yesterday = (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%Y-%m-%d")
+        pipe.hincrby(f"{USER_KEY_PREFIX}{device_id}", specific_limit_field(), 1)
+        pipe.hdel(f"{USER_KEY_PREFIX}{device_id}", specific_limit_field(yesterday))
+        return
+    key = specific_limit_key(device_id)
+    # The key is per-day, so re-applying the same end-of-day expiry on
+    # every increment is harmless and saves reading the counter back.
+    pipe.incr(key)
+    pipe.expire(key, _seconds_until_end_of_day_utc())
 
 
-def increment_specific_filter_usage(device_id: str, preference: str) -> None:
+async def increment_specific_filter_usage(device_id: str, preference: str) -> None:
     if preference not in {"male", "female"}:
         return
-    date_key = _today_key_utc()
-    key = _limit_key(device_id, date_key)
-    new_value = redis_client.incr(key)
-    if new_value == 1:
-        _expire_at_end_of_day_utc(key)
+    pipe = redis_client.pipeline()
+    stage_specific_filter_usage(pipe, device_id, preference)
+    await pipe.execute()
@@ -0,0 +1,157 @@
+"""
+Token-bucket rate limiting shared by all workers.
+
+Buckets live in Redis and are updated by one script call per check. To
+keep clients that are well under their limit off the network, a worker
+takes several tokens at a time and spends them locally for a short
+while, and remembers denials until the bucket can have refilled. Tokens
+are taken from the shared bucket before they are spent, so leasing never
+lets a client exceed its limit across workers.
+"""
+import logging
+import os
+import time
+from dataclasses import dataclass
+from ..db.redis import redis_client, IN_MEMORY_BACKEND
+from .log import log_sampled
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_KEY_PREFIX = "ratelimit:"
+
+# Locally leased tokens are given up after this long so a quiet client's
+# unused tokens don't linger.
+LOCAL_LEASE_SECONDS = 1.0
+# Local lease and denial entries kept before expired ones are pruned
+MAX_LOCAL_ENTRIES = 100_000
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    name: str
+    rate: float  # tokens refilled per second
+    burst: int  # bucket capacity
+
+    @property
+    def lease_size(self) -> int:
+        return max(1, self.burst // 5)
+
+
+# HTTP limits are per client IP, the WebSocket frame limits per device.
+# Control frames (leave, next, report, pongs, anything not chat) get their
+# own looser bucket, so a client throttled on chat can still leave.
+API_LIMIT = RateLimit("api", rate=20, burst=50)
+FIND_LIMIT = RateLimit("find", rate=2, burst=6)
+VERIFY_LIMIT = RateLimit("verify", rate=0.2, burst=5)
+WS_MESSAGE_LIMIT = RateLimit("ws", rate=10, burst=20)
+WS_CONTROL_LIMIT = RateLimit("ws_control", rate=20, burst=40)
+
+
+# KEYS[1]: bucket hash {tokens, ts}
+# ARGV: rate, burst, now, tokens wanted
+# Returns {tokens granted, seconds until one token is available}
+TAKE_TOKENS_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local want = tonumber(ARGV[4])
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+
+local granted = math.min(want, math.floor(tokens))
+tokens = tokens - granted
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+-- Gone once it would have refilled anyway
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+
+local retry_after = 0
+if granted == 0 then
+    retry_after = (1 - tokens) / rate
+end
+return {granted, tostring(retry_after)}
+"""
+
+_take_tokens_script = None if IN_MEMORY_BACKEND else redis_client.register_script(TAKE_TOKENS_SCRIPT)
+
+
+def _bucket_key(limit: RateLimit, key: str) -> str:
+    return f"{RATE_LIMIT_KEY_PREFIX}{limit.name}:{key}"
+
+
+async def _take_in_process(limit: RateLimit, bucket_key: str, now: float, want: int) -> tuple[int, float]:
+    """Same as TAKE_TOKENS_SCRIPT for the in-memory backend (single process)."""
+    tokens, ts = await redis_client.hmget(bucket_key, ["tokens", "ts"])
+    tokens = float(tokens) if tokens is not None else limit.burst
+    ts = float(ts) if ts is not None else now
+    tokens = min(limit.burst, tokens + max(0.0, now - ts) * limit.rate)
+    granted = min(want, int(tokens))
+    tokens -= granted
+    pipe = redis_client.pipeline()
+    pipe.hset(bucket_key, mapping={"tokens": tokens, "ts": now})
+    pipe.expire(bucket_key, (limit.burst - tokens) / limit.rate + 1)
+    await pipe.execute()
+    return granted, 0.0 if granted else (1 - tokens) / limit.rate
+
+
+class RateLimiter:
+    def __init__(self):
+        # (limit name, key) -> [tokens left, monotonic expiry]
+        self.leases = {}
+        # (limit name, key) -> monotonic time until which checks are denied
+        self.denied_until = {}
+
+    async def check(self, limit: RateLimit, key: str) -> tuple[bool, float]:
+        """Spend one token. Returns (allowed, seconds to wait if not)."""
+        if not RATE_LIMIT_ENABLED:
+            return True, 0.0
+        slot = (limit.name, key)
+        now = time.monotonic()
+
+        until = self.denied_until.get(slot)
+        if until is not None:
+            if now < until:
+                return False, until - now
+            del self.denied_until[slot]
+
+        lease = self.leases.get(slot)
+        if lease is not None and lease[0] > 0 and lease[1] > now:
+            lease[0] -= 1
+            return True, 0.0
+
+        try:
+            granted, retry_after = await self._take(limit, key, limit.lease_size)
+        except Exception as e:
+            # Fail open: losing Redis must not take the API down with it
+            log_sampled(logger, logging.WARNING, "Limiter unavailable (%s); allowing", e)
+            return True, 0.0
+
+        self._prune(now)
+        if not granted:
+            self.denied_until[slot] = now + retry_after
+            return False, retry_after
+        self.leases[slot] = [granted - 1, now + LOCAL_LEASE_SECONDS]
+        return True, 0.0
+
+    async def _take(self, limit: RateLimit, key: str, want: int) -> tuple[int, float]:
+        bucket_key = _bucket_key(limit, key)
+        now = time.time()
+        if _take_tokens_script is None:
+            return await _take_in_process(limit, bucket_key, now, want)
+        granted, retry_after = await _take_tokens_script(
+            keys=[bucket_key],
+            args=[limit.rate, limit.burst, now, want],
+        )
+        return int(granted), float(retry_after)
+
+    def _prune(self, now: float):
+        if len(self.leases) > MAX_LOCAL_ENTRIES:
+            self.leases = {slot: lease for slot, lease in self.leases.items() if lease[1] > now}
+        if len(self.denied_until) > MAX_LOCAL_ENTRIES:
+            self.denied_until = {slot: until for slot, until in self.denied_until.items() if until > now}
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,92 @@
+from dataclasses import dataclass
+from ..db.redis import redis_client
+import time
+from .moderation import get_ban_reason
+from .queue import (
+    active_match_key,
+    cooldown_key,
+    is_within_specific_limit,
+    specific_limit_field,
+    specific_limit_key,
+)
+from .user_store import (
+    HASH_STORAGE,
+    PREF_KEY_PREFIX,
+    USER_KEY_PREFIX,
+    PREF_FIELD,
+    BAN_REASON_FIELD,
+    BAN_UNTIL_FIELD,
+    COOLDOWN_UNTIL_FIELD,
+    is_unexpired,
+)
+
+
+@dataclass
+class UserState:
+    """
+    Everything a match request needs to know about one user, read in a
+    single pipelined round-trip instead of one command per field.
+    """
+
+    device_id: str
+    gender: str | None
+    preference: str
+    ban_reason: str | None
+    on_cooldown: bool
+    specific_filter_uses: int
+    active_match: str | None
+
+    @property
+    def banned(self) -> bool:
+        return self.ban_reason is not None
+
+    def is_specific_filter_allowed(self, preference: str) -> bool:
+        if preference not in {"male", "female"}:
+            return True
+        return is_within_specific_limit(self.specific_filter_uses)
+
+
+async def _load_from_hash(device_id: str) -> UserState:
+    pipe = redis_client.pipeline()
+    pipe.hgetall(f"{USER_KEY_PREFIX}{device_id}")
+    pipe.get(active_match_key(device_id))
+    fields, active_match = await pipe.execute()
+
+    now = time.time()
+    banned = is_unexpired(fields.get(BAN_UNTIL_FIELD), now)
+    uses = fields.get(specific_limit_field())
+    return UserState(
+        device_id=device_id,
+        gender=fields.get("gender") or None,
+        preference=fields.get(PREF_FIELD) or "any",
+        ban_reason=fields.get(BAN_REASON_FIELD) if banned else None,
+        on_cooldown=is_unexpired(fields.get(COOLDOWN_UNTIL_FIELD), now),
+        specific_filter_uses=int(uses) if uses else 0,
+        active_match=active_match,
+    )
+
+
+async def load_user_state(device_id: str) -> UserState:
+    if HASH_STORAGE:
+        return await _load_from_hash(device_id)
+
+    # Ban status comes from the ban cache, which rarely needs Redis
+    ban_reason = await get_ban_reason(device_id)
+
+    pipe = redis_client.pipeline()
+    pipe.hget(f"{USER_KEY_PREFIX}{device_id}", "gender")
+    pipe.get(f"{PREF_KEY_PREFIX}{device_id}")
+    pipe.exists(cooldown_key(device_id))
+    pipe.get(specific_limit_key(device_id))
+    pipe.get(active_match_key(device_id))
+    gender, preference, cooldown, uses, active_match = await pipe.execute()
+
+    return UserState(
+        device_id=device_id,
+        gender=gender or None,
+        preference=preference or "any",
+        ban_reason=ban_reason,
+        on_cooldown=cooldown == 1,
+        specific_filter_uses=int(uses) if uses else 0,
+        active_match=active_match,
+    )
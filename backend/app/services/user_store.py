@@ -1,37 +1,66 @@
+import os
+import time
 from ..db.redis import redis_client
 
 USER_KEY_PREFIX = "user:"
 PREF_KEY_PREFIX = "pref:"
 
+# How per-user state is laid out in Redis:
+#   "keys" - one key per field (pref:, cooldown:, ban:, limit:...)
+#   "hash" - the hot fields live in the user:{id} hash next to gender and
+#            profile, with expiry stored as *_until timestamps instead of
+#            key TTLs, so a full read is one HGETALL. Existing data is
+#            converted with `python -m app.tools.migrate_user_hash`.
+# active_match:{id} stays a separate key in both layouts because it is
+# the pairing index written for two users at once by the match script.
+# The reporters:{id}:{bucket} HyperLogLogs (see moderation.py) are
+# separate keys in both layouts too.
+USER_STORAGE_FORMAT = os.getenv("USER_STORAGE_FORMAT", "keys").strip().lower()
+HASH_STORAGE = USER_STORAGE_FORMAT == "hash"
+
+# Field names inside user:{id} when HASH_STORAGE is on
+PREF_FIELD = "pref"
+COOLDOWN_UNTIL_FIELD = "cooldown_until"
+BAN_REASON_FIELD = "ban_reason"
+BAN_UNTIL_FIELD = "ban_until"
+LIMIT_FIELD_PREFIX = "limit:"
+
 
 def _user_key(device_id: str) -> str:
     return f"{USER_KEY_PREFIX}{device_id}"
 
 
+def is_unexpired(until: str | None, now: float | None = None) -> bool:
+    """True if an embedded *_until timestamp is still in the future."""
+    if until is None:
+        return False
+    return float(until) > (time.time() if now is None else now)
+
+
 def _pref_key(device_id: str) -> str:
     return f"{PREF_KEY_PREFIX}{device_id}"
 
 
-def save_gender(device_id: str, gender: str) -> None:
+async def save_gender(device_id: str, gender: str) -> None:
     if not device_id:
         return
     normalized = (gender or "").strip().lower()
     if normalized not in {"male", "female"}:
         normalized = "unknown"
-    redis_client.hset(_user_key(device_id), mapping={"gender": normalized})
+    await redis_client.hset(_user_key(device_id), mapping={"gender": normalized})
 
 
-def get_gender(device_id: str) -> str | None:
+async def get_gender(device_id: str) -> str | None:
     if not device_id:
         return None
-    value = redis_client.hget(_user_key(device_id), "gender")
+    value = await redis_client.hget(_user_key(device_id), "gender")
     return value if value else None
 
 
-def save_profile(device_id: str, nickname: str, bio: str) -> None:
+async def save_profile(device_id: str, nickname: str, bio: str) -> None:
     if not device_id:
         return
-    redis_client.hset(
+    await redis_client.hset(
         _user_key(device_id),
         mapping={
             "nickname": nickname.strip(),
@@ -40,15 +69,36 @@ def save_profile(device_id: str, nickname: str, bio: str) -> None:
     )
 
 
-def set_preference(device_id: str, preference: str) -> None:
-    if not device_id:
-        return
+def normalize_preference(preference: str | None) -> str:
     normalized = (preference or "any").strip().lower()
     if normalized not in {"male", "female", "any"}:
         normalized = "any"
-    redis_client.set(_pref_key(device_id), normalized)
+    return normalized
+
+
+def stage_preference(pipe, device_id: str, preference: str) -> str:
+    """Queue a preference write on `pipe`. Returns the normalized value."""
+    normalized = normalize_preference(preference)
+    if HASH_STORAGE:
+        pipe.hset(_user_key(device_id), mapping={PREF_FIELD: normalized})
+    else:
+        pipe.set(_pref_key(device_id), normalized)
+    return normalized
+
+
+async def set_preference(device_id: str, preference: str) -> None:
+    if not device_id:
+        return
+    normalized = normalize_preference(preference)
+    if HASH_STORAGE:
+        await redis_client.hset(_user_key(device_id), mapping={PREF_FIELD: normalized})
+    else:
+        await redis_client.set(_pref_key(device_id), normalized)
 
 
-def get_preference(device_id: str) -> str:
-    value = redis_client.get(_pref_key(device_id))
+async def get_preference(device_id: str) -> str:
+    if HASH_STORAGE:
+        value = await redis_client.hget(_user_key(device_id), PREF_FIELD)
+    else:
+        value = await redis_client.get(_pref_key(device_id))
     return value if value else "any"
\ No newline at end of file
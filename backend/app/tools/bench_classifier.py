@@ -0,0 +1,87 @@
+"""
+Compare batched and unbatched classifier throughput on this machine.
+
+    python -m app.tools.bench_classifier [--images 400] [--concurrency 64]
+        [--workers 4] [--batch-sizes 1,4,8,16] [--wait-ms 5]
+
+Uses the backend configured by CLASSIFIER_BACKEND, so it can be pointed
+at a real model as well as the built-in heuristic. Batch size 1 is the
+unbatched baseline.
+"""
+import argparse
+import asyncio
+import base64
+import time
+from io import BytesIO
+import numpy as np
+from PIL import Image
+from ..services.classifier_pool import ClassifierPool, CLASSIFIER_WORKERS
+from ..services.gender_ai import CLASSIFIER_BACKEND
+
+
+def _sample_images(count: int, width: int = 1280, height: int = 720) -> list[str]:
+    """Distinct camera-sized JPEG data URLs."""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    images = []
+    for _ in range(count):
+        r, g, b = rng.integers(0, 256, 3)
+        frame = np.stack([(x + r) % 256, (y + g) % 256, (x + y + b) % 256], axis=-1)
+        buffer = BytesIO()
+        Image.fromarray(frame.astype(np.uint8)).save(buffer, "JPEG", quality=90)
+        images.append("data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode())
+    return images
+
+
+async def _run(pool: ClassifierPool, images: list[str], concurrency: int) -> float:
+    """Classify every image with `concurrency` requests in flight; returns images/s."""
+    next_index = 0
+
+    async def client():
+        nonlocal next_index
+        while next_index < len(images):
+            image = images[next_index]
+            next_index += 1
+            await pool.classify(image)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return len(images) / (time.perf_counter() - started)
+
+
+async def bench(images: list[str], concurrency: int, workers: int, batch_sizes: list[int], wait_ms: float):
+    print(f"backend={CLASSIFIER_BACKEND} workers={workers} concurrency={concurrency} images={len(images)}")
+    baseline = None
+    for batch_size in batch_sizes:
+        pool = ClassifierPool(
+            workers,
+            max_pending=concurrency,
+            timeout=60,
+            batch_size=batch_size,
+            batch_wait_ms=wait_ms if batch_size > 1 else 0,
+        )
+        pool.start()
+        # Warm-up pass so process start-up is not measured
+        await _run(pool, images[:workers * batch_size], concurrency)
+        throughput = await _run(pool, images, concurrency)
+        pool.shutdown()
+        baseline = baseline or throughput
+        print(f"batch_size={batch_size:<3} {throughput:8.1f} images/s  ({throughput / baseline:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=CLASSIFIER_WORKERS)
+    parser.add_argument("--batch-sizes", default="1,4,8,16")
+    parser.add_argument("--wait-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    images = _sample_images(args.images)
+    batch_sizes = [int(size) for size in args.batch_sizes.split(",")]
+    asyncio.run(bench(images, args.concurrency, args.workers, batch_sizes, args.wait_ms))
+
+
+if __name__ == "__main__":
+    main()
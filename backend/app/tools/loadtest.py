@@ -0,0 +1,435 @@
+"""
+Load test the verify -> profile -> find -> chat -> next/leave path.
+
+    python -m app.tools.loadtest [--devices 1000] [--concurrency 500]
+        [--rounds 2] [--messages 5] [--redis-url memory://]
+        [--save baseline.json] [--baseline baseline.json]
+
+Starts the app with uvicorn on a free port (REDIS_URL from --redis-url,
+rate limits off) unless --url points at a server that is already running.
+Each virtual device verifies with a generated photo, sets up a profile,
+opens /ws and then, for every round, calls /match/find, chats with its
+partner and ends the chat with `next` (or `leave` on the last round).
+
+Reports throughput and p50/p99 latency per stage, the match rate and the
+time spent queued. --save writes the results as JSON and --baseline
+prints the change against an earlier run. Client and server share the
+machine, so compare runs made with the same settings on the same host.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+from io import BytesIO
+from pathlib import Path
+import httpx
+import numpy as np
+import websockets
+from PIL import Image
+
+BACKEND_DIR = Path(__file__).resolve().parents[2]
+STAGES = ["verify", "profile", "ws_connect", "find", "queue_wait", "chat_ack", "chat_relay", "end"]
+
+
+def _sample_photos(count: int, seed: int, width: int = 640, height: int = 480) -> list[bytes]:
+    """Distinct webcam-sized JPEGs."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    photos = []
+    for _ in range(count):
+        r, g, b = rng.integers(0, 256, 3)
+        frame = np.stack([(x + r) % 256, (y + g) % 256, (x * y + b) % 256], axis=-1)
+        buffer = BytesIO()
+        Image.fromarray(frame.astype(np.uint8)).save(buffer, "JPEG", quality=85)
+        photos.append(buffer.getvalue())
+    return photos
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {stage: [] for stage in STAGES}
+        self.errors = {stage: Counter() for stage in STAGES}
+        self.finds = 0
+        self.matches = 0
+        self.unmatched = 0
+        self.relayed = 0
+        self.failed_devices = 0
+        self.client_lag = []
+
+    def record(self, stage: str, seconds: float):
+        self.latencies[stage].append(seconds)
+
+    def error(self, stage: str, reason):
+        self.errors[stage][str(reason)] += 1
+
+    def summary(self, duration: float) -> dict:
+        stages = {}
+        for stage in STAGES:
+            samples = np.array(self.latencies[stage]) * 1000
+            stages[stage] = {
+                "count": len(samples),
+                "errors": dict(self.errors[stage]),
+                "per_second": len(samples) / duration,
+                "p50_ms": float(np.percentile(samples, 50)) if len(samples) else None,
+                "p99_ms": float(np.percentile(samples, 99)) if len(samples) else None,
+                "max_ms": float(samples.max()) if len(samples) else None,
+            }
+        return {
+            "duration_s": duration,
+            "finds": self.finds,
+            "matches": self.matches,
+            "match_rate": self.matches / self.finds if self.finds else 0.0,
+            "unmatched": self.unmatched,
+            "messages_relayed": self.relayed,
+            "messages_per_second": self.relayed / duration,
+            "failed_devices": self.failed_devices,
+            "client_lag_p99_ms": float(np.percentile(self.client_lag, 99)) * 1000 if self.client_lag else 0.0,
+            "stages": stages,
+        }
+
+
+class StageError(Exception):
+    def __init__(self, stage: str, reason):
+        super().__init__(f"{stage}: {reason}")
+        self.stage = stage
+        self.reason = reason
+
+
+class VirtualDevice:
+    def __init__(self, device_id: str, photo: bytes, http: httpx.AsyncClient, ws_url: str, stats: Stats, args):
+        self.device_id = device_id
+        self.photo = photo
+        self.http = http
+        self.ws_url = ws_url
+        self.stats = stats
+        self.args = args
+        self.ws = None
+        self.next_message_id = 0
+        self.pending_acks = {}
+        self.matched = None
+        self.ended = None
+        self.received = 0
+        self.partner_done = None
+
+    async def _post(self, stage: str, path: str, **kwargs) -> dict:
+        started = time.perf_counter()
+        try:
+            response = await self.http.post(path, **kwargs)
+        except httpx.HTTPError as e:
+            raise StageError(stage, type(e).__name__)
+        if response.status_code != 200:
+            raise StageError(stage, response.status_code)
+        self.stats.record(stage, time.perf_counter() - started)
+        return response.json()
+
+    async def run(self):
+        try:
+            await self._verify()
+            await self._post("profile", "/profile/setup", json={
+                "device_id": self.device_id,
+                "nickname": "load",
+                "bio": "load test device",
+            })
+            started = time.perf_counter()
+            try:
+                self.ws = await websockets.connect(self.ws_url, max_queue=None)
+            except (OSError, websockets.WebSocketException) as e:
+                raise StageError("ws_connect", type(e).__name__)
+            self.stats.record("ws_connect", time.perf_counter() - started)
+            reader = asyncio.create_task(self._read())
+            try:
+                for round_index in range(self.args.rounds):
+                    if not await self._chat_round(round_index):
+                        break
+            finally:
+                reader.cancel()
+                await self.ws.close()
+        except StageError as e:
+            self.stats.error(e.stage, e.reason)
+            self.stats.failed_devices += 1
+        except websockets.ConnectionClosed as e:
+            self.stats.error("chat_ack", f"closed {e.rcvd.code if e.rcvd else ''}".strip())
+            self.stats.failed_devices += 1
+
+    async def _verify(self):
+        # A busy classifier answers 429; back off like a client would
+        for attempt in range(5):
+            try:
+                await self._post(
+                    "verify",
+                    "/verify/gender/upload",
+                    params={"device_id": self.device_id},
+                    content=self.photo,
+                    headers={"Content-Type": "image/jpeg"},
+                )
+                return
+            except StageError as e:
+                if e.reason != 429 or attempt == 4:
+                    raise
+                await asyncio.sleep(0.2 * 2 ** attempt)
+
+    async def _read(self):
+        loop = asyncio.get_running_loop()
+        async for frame in self.ws:
+            event = json.loads(frame)
+            kind = event.get("type")
+            if kind == "chat":
+                sent_at = float(event["message"])
+                self.stats.record("chat_relay", time.perf_counter() - sent_at)
+                self.stats.relayed += 1
+                self.received += 1
+                if self.received >= self.args.messages and not self.partner_done.done():
+                    self.partner_done.set_result(None)
+            elif kind == "delivery":
+                ack = self.pending_acks.pop(event.get("id"), None)
+                if ack is not None and not ack.done():
+                    ack.set_result(loop.time())
+            elif kind == "matched":
+                if self.matched is not None and not self.matched.done():
+                    self.matched.set_result(event.get("partner_id"))
+            elif kind == "ended":
+                if self.ended is not None and not self.ended.done():
+                    self.ended.set_result(event.get("reason"))
+            elif kind == "ping":
+                await self.ws.send(json.dumps({"type": "pong"}))
+
+    async def _chat_round(self, round_index: int) -> bool:
+        """One find -> chat -> next/leave cycle. False once the device gives up."""
+        loop = asyncio.get_running_loop()
+        self.matched = loop.create_future()
+        self.ended = loop.create_future()
+        self.partner_done = loop.create_future()
+        self.received = 0
+
+        self.stats.finds += 1
+        result = await self._post("find", "/match/find", json={
+            "device_id": self.device_id,
+            "preference": "any",
+            "is_next": round_index > 0,
+        })
+        # Whoever completes the match drives the chat and ends it
+        leader = result.get("status") == "matched"
+        if not leader:
+            queued_at = time.perf_counter()
+            try:
+                await asyncio.wait_for(self.matched, self.args.match_timeout)
+            except asyncio.TimeoutError:
+                self.stats.unmatched += 1
+                await self.http.post("/queue/leave", json={"device_id": self.device_id})
+                return False
+            self.stats.record("queue_wait", time.perf_counter() - queued_at)
+        self.stats.matches += 1
+
+        for _ in range(self.args.messages):
+            await self._send_chat()
+            if self.args.think_ms:
+                await asyncio.sleep(random.uniform(0, 2 * self.args.think_ms) / 1000)
+
+        last_round = round_index == self.args.rounds - 1
+        try:
+            if leader:
+                # Let the partner finish its messages before ending the chat
+                await asyncio.wait_for(self.partner_done, self.args.match_timeout)
+                started = time.perf_counter()
+                await self.ws.send(json.dumps({"type": "leave" if last_round else "next"}))
+                await asyncio.wait_for(self.ended, self.args.match_timeout)
+                self.stats.record("end", time.perf_counter() - started)
+            else:
+                await asyncio.wait_for(self.ended, self.args.match_timeout)
+        except asyncio.TimeoutError:
+            self.stats.error("end", "timeout")
+            return False
+        return True
+
+    async def _send_chat(self):
+        loop = asyncio.get_running_loop()
+        self.next_message_id += 1
+        message_id = self.next_message_id
+        ack = loop.create_future()
+        self.pending_acks[message_id] = ack
+        started = loop.time()
+        # The send time doubles as the message so the partner can time the relay
+        await self.ws.send(json.dumps({
+            "type": "chat",
+            "id": message_id,
+            "message": repr(time.perf_counter()),
+        }))
+        try:
+            acked_at = await asyncio.wait_for(ack, self.args.match_timeout)
+        except asyncio.TimeoutError:
+            self.pending_acks.pop(message_id, None)
+            self.stats.error("chat_ack", "timeout")
+            return
+        self.stats.record("chat_ack", acked_at - started)
+
+
+async def _watch_client_lag(stats: Stats, interval: float = 0.05):
+    """
+    How late this process's event loop wakes up. When it is high the
+    harness, not the server, is the bottleneck and latencies are inflated.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        stats.client_lag.append(loop.time() - started - interval)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def _wait_until_up(base_url: str, server: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as http:
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise SystemExit(f"server exited with code {server.returncode}")
+            try:
+                if (await http.get("/health")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise SystemExit("server did not come up")
+
+
+def _start_server(args) -> tuple[subprocess.Popen, str]:
+    if args.workers > 1 and args.redis_url.startswith("memory://"):
+        raise SystemExit("--workers > 1 needs a shared --redis-url")
+    port = _free_port()
+    env = dict(os.environ, REDIS_URL=args.redis_url, RATE_LIMIT_ENABLED="0")
+    log = open(args.server_log, "w") if args.server_log else subprocess.DEVNULL
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "app.main:app",
+            "--host", "127.0.0.1",
+            "--port", str(port),
+            "--workers", str(args.workers),
+            "--log-level", "warning",
+        ],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    return server, f"http://127.0.0.1:{port}"
+
+
+async def run(args, base_url: str) -> dict:
+    photos = _sample_photos(args.photos, args.seed)
+    random.seed(args.seed)
+    run_tag = f"load{int(time.time()) % 100_000:05d}"
+    ws_base = base_url.replace("http", "ws", 1)
+    stats = Stats()
+    gate = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.match_timeout * 3) as http:
+        async def start(index: int):
+            if args.ramp:
+                await asyncio.sleep(args.ramp * index / args.devices)
+            device_id = f"{run_tag}-{index:06d}"
+            async with gate:
+                await VirtualDevice(
+                    device_id,
+                    photos[index % len(photos)],
+                    http,
+                    f"{ws_base}/ws?device_id={device_id}",
+                    stats,
+                    args,
+                ).run()
+
+        watcher = asyncio.create_task(_watch_client_lag(stats))
+        started = time.perf_counter()
+        await asyncio.gather(*(start(index) for index in range(args.devices)))
+        duration = time.perf_counter() - started
+        watcher.cancel()
+
+    return stats.summary(duration)
+
+
+def _format_ms(value) -> str:
+    return "-" if value is None else f"{value:.1f}"
+
+
+def report(results: dict, baseline: dict | None = None):
+    print(
+        f"{results['duration_s']:.1f}s  finds={results['finds']} matches={results['matches']} "
+        f"match_rate={results['match_rate']:.1%} unmatched={results['unmatched']} "
+        f"failed_devices={results['failed_devices']}"
+    )
+    print(f"messages relayed={results['messages_relayed']} ({results['messages_per_second']:.0f}/s)")
+    print(f"client loop lag p99={results['client_lag_p99_ms']:.1f}ms (high values mean the harness is saturated)")
+    print(f"{'stage':<11} {'count':>7} {'errors':>7} {'per_s':>8} {'p50_ms':>9} {'p99_ms':>9} {'max_ms':>9}")
+    for stage, row in results["stages"].items():
+        errors = sum(row["errors"].values())
+        line = (
+            f"{stage:<11} {row['count']:>7} {errors:>7} {row['per_second']:>8.1f} "
+            f"{_format_ms(row['p50_ms']):>9} {_format_ms(row['p99_ms']):>9} {_format_ms(row['max_ms']):>9}"
+        )
+        before = (baseline or {}).get("stages", {}).get(stage)
+        if before and before["p50_ms"] and row["p50_ms"]:
+            line += (
+                f"   p50 {row['p50_ms'] / before['p50_ms'] - 1:+.0%}"
+                f" p99 {row['p99_ms'] / before['p99_ms'] - 1:+.0%}"
+            )
+        print(line)
+        if row["errors"]:
+            print(f"{'':<11} errors: {row['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=500, help="devices active at once")
+    parser.add_argument("--ramp", type=float, default=5, help="seconds over which devices start")
+    parser.add_argument("--rounds", type=int, default=2, help="chats per device")
+    parser.add_argument("--messages", type=int, default=5, help="messages each side sends per chat")
+    parser.add_argument("--think-ms", type=float, default=50, help="mean pause between messages")
+    parser.add_argument("--match-timeout", type=float, default=10)
+    parser.add_argument("--photos", type=int, default=16, help="distinct verification photos")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--url", help="test a running server instead of starting one")
+    parser.add_argument("--redis-url", default="memory://", help="REDIS_URL for the started server")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers for the started server")
+    parser.add_argument("--server-log", help="file for the started server's output")
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results saved with --save")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    server = None
+    base_url = args.url
+    if base_url is None:
+        server, base_url = _start_server(args)
+    try:
+        if server is not None:
+            asyncio.run(_wait_until_up(base_url, server))
+        print(f"target={base_url} devices={args.devices} concurrency={args.concurrency} rounds={args.rounds}")
+        results = asyncio.run(run(args, base_url))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report(results, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
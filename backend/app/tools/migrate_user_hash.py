@@ -0,0 +1,114 @@
+"""
+Convert per-field user keys into the consolidated user:{id} hash used
+when USER_STORAGE_FORMAT=hash.
+
+    python -m app.tools.migrate_user_hash [--dry-run] [--delete-old]
+
+Run it once before switching the format, then again right after the
+switch to pick up anything written in between. Key TTLs become embedded
+*_until timestamps; specific-filter counters from past days are skipped
+since they no longer count towards anything. Safe to re-run.
+"""
+import argparse
+import asyncio
+import time
+from ..db.redis import redis_client, IN_MEMORY_BACKEND
+from ..services.moderation import BAN_KEY_PREFIX
+from ..services.queue import COOLDOWN_KEY_PREFIX, specific_limit_field
+from ..services.user_store import (
+    PREF_KEY_PREFIX,
+    USER_KEY_PREFIX,
+    PREF_FIELD,
+    COOLDOWN_UNTIL_FIELD,
+    BAN_REASON_FIELD,
+    BAN_UNTIL_FIELD,
+)
+
+LIMIT_KEY_PREFIX = "limit:specific:"
+BATCH_SIZE = 500
+
+
+def _plan(key: str, value: str, ttl_ms: int, now: float) -> tuple[str, dict] | None:
+    """Map one legacy key to (device_id, hash fields), or None to skip it."""
+    until = now + ttl_ms / 1000 if ttl_ms > 0 else float("inf")
+
+    if key.startswith(PREF_KEY_PREFIX):
+        return key[len(PREF_KEY_PREFIX):], {PREF_FIELD: value}
+    if key.startswith(COOLDOWN_KEY_PREFIX):
+        return key[len(COOLDOWN_KEY_PREFIX):], {COOLDOWN_UNTIL_FIELD: until}
+    if key.startswith(BAN_KEY_PREFIX):
+        return key[len(BAN_KEY_PREFIX):], {BAN_REASON_FIELD: value, BAN_UNTIL_FIELD: until}
+    if key.startswith(LIMIT_KEY_PREFIX):
+        device_id, date_key = key[len(LIMIT_KEY_PREFIX):].rsplit(":", 1)
+        field = specific_limit_field(date_key)
+        if field != specific_limit_field():
+            return None
+        return device_id, {field: value}
+    return None
+
+
+async def _migrate_batch(keys: list[str], dry_run: bool, delete_old: bool) -> int:
+    read = redis_client.pipeline()
+    for key in keys:
+        read.get(key)
+        read.pttl(key)
+    results = await read.execute()
+
+    now = time.time()
+    write = redis_client.pipeline()
+    migrated = 0
+    for key, value, ttl_ms in zip(keys, results[::2], results[1::2]):
+        # Expired between SCAN and GET
+        if value is None:
+            continue
+        planned = _plan(key, value, ttl_ms, now)
+        if planned is None:
+            continue
+        device_id, fields = planned
+        write.hset(f"{USER_KEY_PREFIX}{device_id}", mapping=fields)
+        if delete_old:
+            write.delete(key)
+        migrated += 1
+
+    if not dry_run:
+        await write.execute()
+    return migrated
+
+
+async def migrate(dry_run: bool = False, delete_old: bool = False) -> int:
+    prefixes = [
+        PREF_KEY_PREFIX,
+        COOLDOWN_KEY_PREFIX,
+        BAN_KEY_PREFIX,
+        LIMIT_KEY_PREFIX,
+    ]
+    total = 0
+    for prefix in prefixes:
+        batch = []
+        async for key in redis_client.scan_iter(match=f"{prefix}*", count=BATCH_SIZE):
+            batch.append(key)
+            if len(batch) >= BATCH_SIZE:
+                total += await _migrate_batch(batch, dry_run, delete_old)
+                batch = []
+        if batch:
+            total += await _migrate_batch(batch, dry_run, delete_old)
+        print(f"[MIGRATE] {prefix}* done ({total} keys so far)")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="scan and report, write nothing")
+    parser.add_argument("--delete-old", action="store_true", help="delete legacy keys once copied")
+    args = parser.parse_args()
+
+    if IN_MEMORY_BACKEND:
+        raise SystemExit("Running on the in-memory backend; nothing to migrate.")
+
+    total = asyncio.run(migrate(args.dry_run, args.delete_old))
+    action = "Would migrate" if args.dry_run else "Migrated"
+    print(f"[MIGRATE] {action} {total} keys into {USER_KEY_PREFIX}* hashes")
+
+
+if __name__ == "__main__":
+    main()
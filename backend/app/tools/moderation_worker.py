@@ -0,0 +1,46 @@
+"""
+Run moderation consumers outside the API workers.
+
+    python -m app.tools.moderation_worker
+
+Start the API with MODERATION_WORKER_ENABLED=0 and run as many of these
+as report volume needs; they share the stream through one consumer group.
+Banned users are notified through the same pub/sub channels the API
+workers deliver socket messages on.
+"""
+import argparse
+import asyncio
+import logging
+from ..db.redis import IN_MEMORY_BACKEND, start_redis, close_redis
+from ..services.log import configure_logging
+from ..services.moderation_worker import run_moderation_worker, CONSUMER_NAME
+from ..ws.socket import notify_suspended
+
+logger = logging.getLogger(__name__)
+
+
+async def run():
+    await start_redis()
+    try:
+        await run_moderation_worker(notify_suspended)
+    finally:
+        await close_redis()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.parse_args()
+
+    if IN_MEMORY_BACKEND:
+        raise SystemExit("The in-memory backend is not shared; run moderation inside the API instead.")
+
+    configure_logging()
+    logger.info("Moderation consumer %s started", CONSUMER_NAME)
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Wire formats for WebSocket frames. A client picks one at connect time by
+offering it as a subprotocol (Sec-WebSocket-Protocol); JSON text frames
+are the default when it offers nothing we support.
+
+Events travel between workers as JSON text whatever the recipient's
+codec, so JSON sockets can be handed the published frame unchanged.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # optional: faster JSON, same output
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional: binary framing is only offered if installed
+    msgpack = None
+
+
+if orjson is not None:
+    def json_dumps(event: dict) -> str:
+        return orjson.dumps(event).decode()
+
+    json_loads = orjson.loads
+else:
+    def json_dumps(event: dict) -> str:
+        return json.dumps(event, separators=(",", ":"), ensure_ascii=False)
+
+    json_loads = json.loads
+
+
+class JsonCodec:
+    name = "json"
+    binary = False
+
+    def encode(self, event: dict) -> str:
+        return json_dumps(event)
+
+    def decode(self, frame: str):
+        # orjson and json both raise ValueError subclasses
+        return json_loads(frame)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    binary = True
+
+    def encode(self, event: dict) -> bytes:
+        return msgpack.packb(event)
+
+    def decode(self, frame: bytes):
+        try:
+            return msgpack.unpackb(frame)
+        except Exception as e:
+            raise ValueError(f"invalid msgpack frame: {e}")
+
+
+JSON_CODEC = JsonCodec()
+
+CODECS = {JSON_CODEC.name: JSON_CODEC}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+
+def negotiate(subprotocols: list[str]) -> tuple[JsonCodec | MsgpackCodec, str | None]:
+    """
+    Codec for the first offered subprotocol we support, plus the
+    subprotocol to confirm in the handshake (None if none was offered).
+    """
+    for offered in subprotocols:
+        codec = CODECS.get(offered)
+        if codec is not None:
+            return codec, offered
+    return JSON_CODEC, None
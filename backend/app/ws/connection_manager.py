@@ -1,29 +1,333 @@
+import asyncio
+import logging
+import os
+import time
 from fastapi import WebSocket
+from ..db.pubsub import create_broker
+from .codec import JSON_CODEC, json_dumps, json_loads, negotiate
+from ..services.log import log_sampled
+from ..services.presence import clear_presence
+from ..services.queue import get_active_match, keep_alive
+
+logger = logging.getLogger(__name__)
+
+DEVICE_CHANNEL_PREFIX = "ws:device:"
+
+# Published on a device channel in place of a client message to tell the
+# owning worker that the device's pairing changed. Events are published
+# as JSON, so they can never start with this.
+PARTNER_UPDATE_PREFIX = "\x00partner:"
+
+# Frames buffered per socket before the overflow policy applies:
+# "drop_oldest" discards the oldest queued frame, "disconnect" closes the
+# socket (code 1013) so a stuck client can reconnect cleanly.
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "64"))
+WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "drop_oldest")
+
+# Every WS_HEARTBEAT_INTERVAL seconds each socket is sent {"type": "ping"}
+# (clients answer {"type": "pong"}). Sockets that sent nothing for
+# WS_HEARTBEAT_TIMEOUT seconds are closed and their chat is ended.
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "20"))
+WS_HEARTBEAT_TIMEOUT = float(os.getenv("WS_HEARTBEAT_TIMEOUT", "60"))
+PING_EVENT = {"type": "ping"}
+
+
+def _device_channel(device_id: str) -> str:
+    return f"{DEVICE_CHANNEL_PREFIX}{device_id}"
+
 
 class ConnectionManager:
-    def __init__(self):
+    """
+    Tracks the sockets connected to this worker. Messages for devices
+    connected elsewhere are published on the device's channel and
+    delivered by the worker that owns the socket.
+    """
+
+    def __init__(self, broker=None):
         self.active_connections = {}
+        # device_id -> Events of /match/status long-polls on this worker,
+        # set when a match is made for that device
+        self.match_waiters = {}
+        # device_id -> partner_id (or None) for sockets on this worker, so
+        # relaying a chat message needs no Redis read. Kept in sync by
+        # set_partner whenever active_match:* changes.
+        self.partners = {}
+        # device_id -> codec negotiated for that socket
+        self.codecs = {}
+        # device_id -> outgoing frames, drained by that socket's writer task
+        self.send_queues = {}
+        self.writers = {}
+        self.dropped_frames = 0
+        # Deepest any send queue has been since the worker started
+        self.peak_queue_depth = 0
+        self.slow_consumers_disconnected = 0
+        self._closing = set()
+        # device_id -> monotonic time of the last frame received
+        self.last_seen = {}
+        # device_id -> coroutine function run when the socket is reaped
+        self.timeout_handlers = {}
+        self.reaped_connections = 0
+        self.broker = broker or create_broker()
+        self._listener = None
+        self._heartbeat_task = None
 
-    async def connect(self, websocket: WebSocket, device_id: str):
-        await websocket.accept()
+    async def connect(self, websocket: WebSocket, device_id: str, on_timeout=None):
+        """
+        Accept the socket with the codec the client asked for and return it.
+        `on_timeout` is awaited if the socket is later reaped for missing
+        heartbeats, before the connection is dropped.
+        """
+        codec, subprotocol = negotiate(websocket.scope.get("subprotocols", []))
+        await websocket.accept(subprotocol=subprotocol)
         self.active_connections[device_id] = websocket
-        print(f"[WS] {device_id} connected. Total: {len(self.active_connections)}")
+        self.codecs[device_id] = codec
+        self._stop_writer(device_id)
+        queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.send_queues[device_id] = queue
+        self.writers[device_id] = asyncio.create_task(self._write_loop(device_id, websocket, queue))
+        self.last_seen[device_id] = time.monotonic()
+        self.timeout_handlers[device_id] = on_timeout
+        await self.broker.subscribe(_device_channel(device_id))
+        await keep_alive(device_id)
+        self._ensure_listener()
+        self._ensure_heartbeat()
+        log_sampled(
+            logger, logging.INFO, "%s connected (%s). Total: %d",
+            device_id, codec.name, len(self.active_connections)
+        )
+        return codec
 
-    def disconnect(self, device_id: str):
+    async def disconnect(self, device_id: str, websocket: WebSocket | None = None):
+        """
+        Forget a device's socket. Pass `websocket` to only do so if it is
+        still the device's current socket (it may have reconnected).
+        """
+        if websocket is not None and self.active_connections.get(device_id) is not websocket:
+            return
         if device_id in self.active_connections:
             del self.active_connections[device_id]
-        print(f"[WS] {device_id} disconnected. Total: {len(self.active_connections)}")
+            self.last_seen.pop(device_id, None)
+            self.timeout_handlers.pop(device_id, None)
+            self.partners.pop(device_id, None)
+            self.codecs.pop(device_id, None)
+            self.send_queues.pop(device_id, None)
+            self._stop_writer(device_id)
+            await self.broker.unsubscribe(_device_channel(device_id))
+            await clear_presence(device_id)
+        log_sampled(logger, logging.INFO, "%s disconnected. Total: %d", device_id, len(self.active_connections))
+
+    def _stop_writer(self, device_id: str):
+        writer = self.writers.pop(device_id, None)
+        # A writer that hit a send error disconnects from inside itself
+        if writer is not None and writer is not asyncio.current_task():
+            writer.cancel()
 
-    async def send_personal_message(self, message: str, device_id: str):
-        """Send a message to a specific device."""
+    async def send_personal_message(self, event: dict, device_id: str):
+        """Send an event to a specific device, on this worker or another."""
+        if device_id in self.active_connections:
+            self._send_local(device_id, event=event)
+            return
+        receivers = await self.broker.publish(_device_channel(device_id), json_dumps(event))
+        if not receivers:
+            log_sampled(logger, logging.DEBUG, "%s not connected", device_id)
+
+    async def get_partner(self, device_id: str) -> str | None:
+        """Current partner of a connected device, from cache when possible."""
+        if device_id in self.partners:
+            return self.partners[device_id]
+        partner_id = await get_active_match(device_id)
+        if device_id not in self.active_connections:
+            return partner_id
+        # An update that arrived while we were reading Redis wins
+        return self.partners.setdefault(device_id, partner_id)
+
+    async def set_partner(self, device_id: str, partner_id: str | None):
+        """
+        Record a pairing change for a device (None when its chat ended).
+        Call after writing active_match:*; the update reaches whichever
+        worker holds the device's socket.
+        """
+        if device_id in self.active_connections:
+            self.partners[device_id] = partner_id
+            return
+        await self.broker.publish(
+            _device_channel(device_id),
+            f"{PARTNER_UPDATE_PREFIX}{partner_id or ''}"
+        )
+
+    def _send_local(self, device_id: str, event: dict | None = None, json_frame: str | None = None):
+        """
+        Queue a frame for a socket on this worker, given the event or (from
+        pub/sub) its JSON encoding. JSON frames go out as they are.
+        """
+        queue = self.send_queues.get(device_id)
+        if queue is None:
+            return
+        codec = self.codecs.get(device_id, JSON_CODEC)
+        if codec.binary:
+            frame = codec.encode(event if event is not None else json_loads(json_frame))
+        else:
+            frame = json_frame if json_frame is not None else codec.encode(event)
+
+        if queue.full():
+            if WS_OVERFLOW_POLICY == "disconnect":
+                self._evict_slow_consumer(device_id)
+                return
+            queue.get_nowait()
+            self.dropped_frames += 1
+        queue.put_nowait(frame)
+        self.peak_queue_depth = max(self.peak_queue_depth, queue.qsize())
+
+    async def _write_loop(self, device_id: str, websocket: WebSocket, queue: asyncio.Queue):
+        """Drain one socket's send queue, so a slow client only stalls itself."""
+        try:
+            while True:
+                frame = await queue.get()
+                if isinstance(frame, bytes):
+                    await websocket.send_bytes(frame)
+                else:
+                    await websocket.send_text(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log_sampled(logger, logging.WARNING, "Failed to send to %s: %s", device_id, e)
+            # Remove the dead connection
+            if self.active_connections.get(device_id) is websocket:
+                await self.disconnect(device_id)
+
+    def _evict_slow_consumer(self, device_id: str):
         websocket = self.active_connections.get(device_id)
-        if websocket:
+        # Stop queueing for it right away; the rest happens in a task
+        self.send_queues.pop(device_id, None)
+        self.slow_consumers_disconnected += 1
+        logger.warning("%s send queue full, disconnecting", device_id)
+        self._close_in_background(device_id, websocket, 1013, "Slow consumer")
+
+    def _close_in_background(self, device_id: str, websocket: WebSocket, code: int, reason: str):
+        """Drop the connection now and close the socket without waiting on it."""
+        async def close():
+            await self.disconnect(device_id, websocket)
             try:
-                await websocket.send_text(message)
-                print(f"[WS] Sent to {device_id}: {message[:50]}...")
+                await websocket.close(code=code, reason=reason)
+            except Exception:
+                pass
+
+        task = asyncio.create_task(close())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    def touch(self, device_id: str):
+        """Record that a frame arrived from the device."""
+        self.last_seen[device_id] = time.monotonic()
+
+    def _ensure_heartbeat(self):
+        if self._heartbeat_task is None or self._heartbeat_task.done():
+            self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def _heartbeat(self):
+        """
+        Ping every socket, reap the ones that stopped answering, and
+        refresh presence and queue leases for the rest in one pipeline.
+        """
+        while True:
+            await asyncio.sleep(WS_HEARTBEAT_INTERVAL)
+            cutoff = time.monotonic() - WS_HEARTBEAT_TIMEOUT
+            for device_id, seen in list(self.last_seen.items()):
+                if seen < cutoff:
+                    await self._reap(device_id)
+                else:
+                    self._send_local(device_id, event=PING_EVENT)
+            try:
+                await keep_alive(*self.active_connections)
             except Exception as e:
-                print(f"[WS] Failed to send to {device_id}: {e}")
-                # Remove the dead connection
-                self.active_connections.pop(device_id, None)
-        else:
-            print(f"[WS] {device_id} not connected")
+                logger.warning("Presence refresh failed: %s", e)
+
+    async def _reap(self, device_id: str):
+        websocket = self.active_connections.get(device_id)
+        if websocket is None:
+            return
+        logger.info("%s missed heartbeats, closing", device_id)
+        self.reaped_connections += 1
+        on_timeout = self.timeout_handlers.get(device_id)
+        if on_timeout is not None:
+            try:
+                await on_timeout()
+            except Exception as e:
+                logger.warning("Cleanup for %s failed: %s", device_id, e)
+        self._close_in_background(device_id, websocket, 1001, "Heartbeat timeout")
+
+    def connection_stats(self) -> dict:
+        depths = [queue.qsize() for queue in self.send_queues.values()]
+        return {
+            "connections": len(self.active_connections),
+            "queued_frames": sum(depths),
+            # Deepest queue right now, and the high-water mark since startup
+            "max_queue_depth": max(depths, default=0),
+            "peak_queue_depth": self.peak_queue_depth,
+            "queue_capacity": WS_SEND_QUEUE_SIZE,
+            "overflow_policy": WS_OVERFLOW_POLICY,
+            "dropped_frames": self.dropped_frames,
+            "slow_consumers_disconnected": self.slow_consumers_disconnected,
+            "reaped_connections": self.reaped_connections,
+        }
+
+    def _ensure_listener(self):
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+
+    async def _listen(self):
+        """Deliver messages other workers published for our sockets."""
+        while True:
+            try:
+                delivery = await self.broker.get_message(timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Pub/sub receive failed: %s", e)
+                await asyncio.sleep(1.0)
+                continue
+            if not delivery:
+                continue
+            channel, message = delivery
+            device_id = channel[len(DEVICE_CHANNEL_PREFIX):]
+            if message.startswith(PARTNER_UPDATE_PREFIX):
+                if device_id in self.active_connections:
+                    partner_id = message[len(PARTNER_UPDATE_PREFIX):]
+                    self.partners[device_id] = partner_id or None
+                continue
+            self._send_local(device_id, json_frame=message)
+
+    async def notify_matched(self, device_id: str, partner_id: str):
+        """
+        Record a new pairing for both sides, then push a `matched` event to
+        the waiting device and wake its long-polls.
+        """
+        await self.set_partner(device_id, partner_id)
+        await self.set_partner(partner_id, device_id)
+        for event in self.match_waiters.get(device_id, ()):
+            event.set()
+        await self.send_personal_message(
+            {
+                "type": "matched",
+                "partner_id": partner_id
+            },
+            device_id
+        )
+
+    async def wait_for_match(self, device_id: str, timeout: float) -> bool:
+        """Block until notify_matched fires for the device or timeout expires."""
+        event = asyncio.Event()
+        waiters = self.match_waiters.setdefault(device_id, set())
+        waiters.add(event)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiters.discard(event)
+            if not waiters:
+                self.match_waiters.pop(device_id, None)
+
+
+manager = ConnectionManager()
@@ -1,11 +1,33 @@
+import logging
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from ..ws.connection_manager import ConnectionManager
+from ..ws.connection_manager import manager
 from ..db.redis import redis_client
-from ..services.moderation import report_user, auto_ban_if_needed, is_banned
-import json
+from ..services.moderation import enqueue_report, is_banned
+from ..services.queue import active_match_key
+from ..services.log import log_sampled
+from ..services.metrics import WS_MESSAGES_RELAYED, WS_MESSAGES_THROTTLED
+from ..services.rate_limit import rate_limiter, WS_MESSAGE_LIMIT, WS_CONTROL_LIMIT
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
-manager = ConnectionManager()
+
+
+async def notify_suspended(device_id: str):
+    """Tell a banned user's socket (on any worker) that they were suspended."""
+    await manager.send_personal_message(
+        {
+            "type": "system",
+            "message": "Your account has been suspended due to reports."
+        },
+        device_id
+    )
+
+
+@router.get("/ws/stats")
+async def websocket_stats():
+    """Send-queue depth, overflow and reaper counters for this worker's sockets."""
+    return manager.connection_stats()
 
 
 @router.websocket("/ws")
@@ -16,122 +38,174 @@ async def websocket_endpoint(websocket: WebSocket):
         await websocket.close()
         return
 
-    if is_banned(device_id):
+    if await is_banned(device_id):
         await websocket.close(code=1008, reason="Banned")
         return
 
-    await manager.connect(websocket, device_id)
-
     async def get_partner_id() -> str | None:
-        return redis_client.get(f"active_match:{device_id}")
+        return await manager.get_partner(device_id)
 
     async def end_match(reason: str):
         partner_id = await get_partner_id()
         if partner_id:
-            redis_client.delete(f"active_match:{device_id}")
-            redis_client.delete(f"active_match:{partner_id}")
+            await redis_client.delete(
+                active_match_key(device_id),
+                active_match_key(partner_id)
+            )
+            await manager.set_partner(device_id, None)
+            await manager.set_partner(partner_id, None)
             await manager.send_personal_message(
-                json.dumps({
+                {
                     "type": "ended",
                     "reason": reason
-                }),
+                },
                 partner_id
             )
 
+    codec = await manager.connect(
+        websocket,
+        device_id,
+        on_timeout=lambda: end_match("timeout")
+    )
+
+    # A match made before this socket subscribed was pushed to nobody, so
+    # replay the current pairing for clients that queued before connecting
+    partner_id = await get_partner_id()
+    if partner_id:
+        await manager.send_personal_message(
+            {
+                "type": "matched",
+                "partner_id": partner_id
+            },
+            device_id
+        )
+
+    # Limits currently dropping frames, so the client is told only once
+    throttled = set()
+
     try:
         while True:
-            raw = await websocket.receive_text()
-
-            try:
-                payload = json.loads(raw)
-            except json.JSONDecodeError:
-                payload = {"type": "chat", "message": raw}
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            frame = message.get("bytes")
+            if frame is None:
+                frame = message.get("text")
+            manager.touch(device_id)
+
+            payload = None
+            # Only frames of the negotiated kind are decoded; a text frame
+            # on a msgpack socket is plain text like any other
+            if isinstance(frame, bytes) == codec.binary:
+                try:
+                    payload = codec.decode(frame)
+                except ValueError:
+                    pass
+            if not isinstance(payload, dict):
+                # Plain text frames are treated as chat messages
+                payload = {"type": "chat", "message": frame if isinstance(frame, str) else ""}
 
             msg_type = payload.get("type")
 
+            # Chat and control frames have separate buckets, so leave/next/
+            # report still get through while chat is throttled
+            limit = WS_MESSAGE_LIMIT if msg_type == "chat" else WS_CONTROL_LIMIT
+            allowed, _ = await rate_limiter.check(limit, device_id)
+            if not allowed:
+                WS_MESSAGES_THROTTLED.inc(limit.name)
+                if limit not in throttled:
+                    await manager.send_personal_message(
+                        {
+                            "type": "error",
+                            "message": "You're sending messages too fast."
+                        },
+                        device_id
+                    )
+                throttled.add(limit)
+                continue
+            throttled.discard(limit)
+
             if msg_type == "chat":
                 partner_id = await get_partner_id()
                 if not partner_id:
                     await manager.send_personal_message(
-                        json.dumps({
+                        {
                             "type": "system",
                             "message": "No active match."
-                        }),
+                        },
                         device_id
                     )
                     continue
 
-                message_text = payload.get("message", "").strip()
-                if not message_text:
+                message_text = payload.get("message")
+                if not isinstance(message_text, str) or not message_text.strip():
                     continue
 
-                # Send to partner with logging
                 try:
-                    msg_obj = {
-                        "type": "chat",
-                        "from": device_id,
-                        "message": message_text
-                    }
-                    msg_json = json.dumps(msg_obj)
-                    print(f"[CHAT] {device_id[:8]} -> {partner_id[:8]}: {message_text[:30]}")
-                    await manager.send_personal_message(msg_json, partner_id)
-                    print(f"[CHAT] ✓ Delivered to {partner_id[:8]}")
+                    await manager.send_personal_message(
+                        {
+                            "type": "chat",
+                            "from": device_id,
+                            "message": message_text.strip()
+                        },
+                        partner_id
+                    )
                 except Exception as e:
-                    print(f"[CHAT] ✗ Error sending to partner {partner_id}: {e}")
-                
-                # Send delivery confirmation back to sender
-                try:
+                    log_sampled(logger, logging.WARNING, "Error sending to partner %s: %s", partner_id, e)
+                    continue
+                WS_MESSAGES_RELAYED.inc()
+
+                # Acknowledge with the client's own message id rather than
+                # echoing the text back; clients that send no id get no ack
+                message_id = payload.get("id")
+                if message_id is not None:
                     await manager.send_personal_message(
-                        json.dumps({
+                        {
                             "type": "delivery",
-                            "status": "sent",
-                            "message": message_text
-                        }),
+                            "id": message_id
+                        },
                         device_id
                     )
-                except Exception as e:
-                    print(f"[CHAT] ✗ Error sending confirmation to {device_id}: {e}")
+
+            elif msg_type == "pong":
+                continue
 
             elif msg_type in {"leave", "next"}:
                 await end_match(msg_type)
                 await manager.send_personal_message(
-                    json.dumps({
+                    {
                         "type": "ended",
                         "reason": msg_type
-                    }),
+                    },
                     device_id
                 )
 
             elif msg_type == "report":
                 partner_id = await get_partner_id()
                 if partner_id:
-                    report_user(partner_id, device_id)
-                    if auto_ban_if_needed(partner_id):
-                        await manager.send_personal_message(
-                            json.dumps({
-                                "type": "system",
-                                "message": "Your account has been suspended due to reports."
-                            }),
-                            partner_id
-                        )
+                    # Counted and acted on by the moderation worker
+                    await enqueue_report(partner_id, device_id)
                 await end_match("report")
                 await manager.send_personal_message(
-                    json.dumps({
+                    {
                         "type": "ended",
                         "reason": "report"
-                    }),
+                    },
                     device_id
                 )
 
             else:
                 await manager.send_personal_message(
-                    json.dumps({
+                    {
                         "type": "error",
                         "message": "Unsupported message type."
-                    }),
+                    },
                     device_id
                 )
 
     except WebSocketDisconnect:
+        pass
+    finally:
+        # However the loop ended, free the partner and this worker's slot
         await end_match("disconnect")
-        manager.disconnect(device_id)
+        await manager.disconnect(device_id, websocket)
@@ -0,0 +1,94 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+# Tests run on the embedded backend; must be set before app.db.redis is
+# imported. Scripts that need real Lua run against fakeredis instead.
+os.environ["REDIS_URL"] = "memory://"
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from app.db.redis import redis_client  # noqa: E402
+from app.services.moderation import ban_cache  # noqa: E402
+from app.services.presence import presence_key  # noqa: E402
+from app.services.queue import QUEUE_LEASES_KEY, active_match_key  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def loop():
+    # One loop for the session: module-level asyncio locks bind to it
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def run(loop):
+    """Run a coroutine to completion and return its result."""
+    return loop.run_until_complete
+
+
+@pytest.fixture(autouse=True)
+def clean_backend(run):
+    run(redis_client.flushall())
+    yield
+
+
+@pytest.fixture
+def fake_redis(run):
+    """A fakeredis client with Lua support, for server-side scripts."""
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    client = fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True)
+    yield client
+    run(client.aclose())
+
+
+class Backend:
+    """
+    Where a parametrized test runs: fakeredis executing the Lua scripts
+    (`scripted`), or the in-memory backend and the in-process equivalents.
+    """
+
+    def __init__(self, client, scripted: bool):
+        self.client = client
+        self.scripted = scripted
+        self._scripts = {}
+
+    async def script(self, source: str, keys: list, args: list):
+        if source not in self._scripts:
+            self._scripts[source] = self.client.register_script(source)
+        return await self._scripts[source](keys=keys, args=args)
+
+
+@pytest.fixture(params=["script", "in_process"])
+def backend(request):
+    if request.param == "script":
+        return Backend(request.getfixturevalue("fake_redis"), scripted=True)
+    return Backend(redis_client, scripted=False)
+
+
+@pytest.fixture
+def enqueue(run):
+    """Put a device straight into a queue bucket with a lease, bypassing join_queue."""
+    def enqueue(client, device_id, bucket, joined_at=None, lease=60, online=True, matched=False):
+        now = time.time()
+        pipe = client.pipeline()
+        pipe.zadd(bucket, {device_id: now - 5 if joined_at is None else joined_at})
+        pipe.zadd(QUEUE_LEASES_KEY, {device_id: now + lease})
+        if online:
+            pipe.set(presence_key(device_id), 1)
+        if matched:
+            pipe.set(active_match_key(device_id), "someone-else")
+        run(pipe.execute())
+    return enqueue
+
+
+@pytest.fixture
+def fresh_ban_cache():
+    """Empty this worker's ban cache so no answer leaks between tests."""
+    ban_cache.filter = None
+    ban_cache.entries.clear()
+    ban_cache.added_during_rebuild = None
+    yield
@@ -0,0 +1,86 @@
+"""Per-worker ban cache: bloom filter in front of an answer cache."""
+import asyncio
+import time
+
+import pytest
+
+from app.db.redis import redis_client
+from app.services import moderation
+from app.services.metrics import BAN_CHECKS
+from app.services.moderation import BAN_INDEX_KEY, ban_cache, ban_user, get_ban_reason
+
+
+pytestmark = pytest.mark.usefixtures("fresh_ban_cache")
+
+
+def checks(result):
+    return BAN_CHECKS.values.get((result,), 0)
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = moderation._BloomFilter(1000)
+    ids = [f"device-{i}" for i in range(1000)]
+    for device_id in ids:
+        bloom.add(device_id)
+    assert all(device_id in bloom for device_id in ids)
+    false_positives = sum(f"other-{i}" in bloom for i in range(10_000))
+    assert false_positives < 100
+
+
+def test_unbuilt_filter_asks_redis(run):
+    before = checks("redis")
+    assert run(get_ban_reason("someone")) is None
+    assert checks("redis") == before + 1
+
+
+def test_filter_answers_unbanned_ids_locally(run):
+    run(ban_cache.rebuild())
+    before = checks("filtered")
+    assert run(get_ban_reason("someone")) is None
+    assert checks("filtered") == before + 1
+
+
+def test_ban_is_seen_without_waiting_for_a_rebuild(run):
+    run(ban_cache.rebuild())
+    run(ban_user("spammer", "abuse"))
+    assert run(get_ban_reason("spammer")) == "abuse"
+
+    # The filter alone still flags it once the cached answer is gone
+    ban_cache.entries.clear()
+    assert run(get_ban_reason("spammer")) == "abuse"
+
+
+def test_rebuild_drops_expired_bans(run):
+    run(redis_client.zadd(BAN_INDEX_KEY, {"expired": time.time() - 1, "active": time.time() + 60}))
+    run(ban_cache.rebuild())
+    assert not ban_cache.might_be_banned("expired")
+    assert ban_cache.might_be_banned("active")
+    assert run(redis_client.zscore(BAN_INDEX_KEY, "expired")) is None
+
+
+def test_ban_added_during_rebuild_is_kept(run, monkeypatch):
+    run(ban_cache.rebuild())
+    make_pipeline = redis_client.pipeline
+
+    def slow_pipeline(*args, **kwargs):
+        pipe = make_pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        async def slow_execute():
+            await asyncio.sleep(0.05)
+            return await execute()
+
+        pipe.execute = slow_execute
+        return pipe
+
+    monkeypatch.setattr(redis_client, "pipeline", slow_pipeline)
+
+    async def ban_mid_rebuild():
+        rebuild = asyncio.create_task(ban_cache.rebuild())
+        await asyncio.sleep(0.01)
+        ban_cache.add("late", "abuse", time.time() + 60)
+        await rebuild
+
+    run(ban_mid_rebuild())
+    assert ban_cache.might_be_banned("late")
+    assert ban_cache.added_during_rebuild is None
@@ -0,0 +1,177 @@
+"""Classifier pool admission, timeouts and failures, with a stub executor."""
+import asyncio
+from concurrent.futures import Executor, Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from app.services.classifier_pool import ClassifierBusy, ClassifierPool
+
+
+class StubExecutor(Executor):
+    """Records each submitted batch; the test decides when and how it finishes."""
+
+    def __init__(self):
+        self.batches = []  # (images, future)
+        self.shut_down = False
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        self.batches.append((args[0], future))
+        return future
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        self.shut_down = True
+
+
+@pytest.fixture
+def stub():
+    return StubExecutor()
+
+
+def make_pool(stub, **options):
+    options = {"workers": 1, "max_pending": 4, "timeout": 5, **options}
+    pool = ClassifierPool(**options)
+    # start() leaves an existing executor alone, so no processes are spawned
+    pool.executor = stub
+    return pool
+
+
+async def settle():
+    """Let queued tasks and executor callbacks run."""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_result_comes_back_and_frees_the_slot(run, stub):
+    pool = make_pool(stub)
+
+    async def scenario():
+        request = asyncio.create_task(pool.classify("image"))
+        await settle()
+        assert pool.pending == 1
+        [(images, future)] = stub.batches
+        assert images == ["image"]
+        future.set_result(["female"])
+        return await request
+
+    assert run(scenario()) == "female"
+    assert pool.pending == 0
+
+
+def test_full_pool_refuses_new_images(run, stub):
+    pool = make_pool(stub, max_pending=2)
+
+    async def scenario():
+        requests = [asyncio.create_task(pool.classify(f"image-{i}")) for i in range(2)]
+        await settle()
+        with pytest.raises(ClassifierBusy):
+            await pool.classify("one-too-many")
+        for _, future in stub.batches:
+            future.set_result(["male"])
+        return await asyncio.gather(*requests)
+
+    assert run(scenario()) == ["male", "male"]
+    assert pool.pending == 0
+
+
+def test_timed_out_images_hold_their_slot_until_classified(run, stub):
+    pool = make_pool(stub, max_pending=1, timeout=0.01)
+
+    async def scenario():
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.classify("slow")
+        # The worker is still busy with it, so it still counts
+        assert pool.pending == 1
+        with pytest.raises(ClassifierBusy):
+            await pool.classify("next")
+        stub.batches[0][1].set_result(["male"])
+        await settle()
+
+    run(scenario())
+    assert pool.pending == 0
+
+
+def test_broken_pool_reports_busy_and_is_rebuilt_later(run, stub):
+    pool = make_pool(stub)
+
+    async def scenario():
+        request = asyncio.create_task(pool.classify("image"))
+        await settle()
+        stub.batches[0][1].set_exception(BrokenProcessPool("worker died"))
+        with pytest.raises(ClassifierBusy):
+            await request
+
+    run(scenario())
+    assert stub.shut_down
+    assert pool.executor is None
+    assert pool.pending == 0
+
+
+def test_classifier_errors_reach_the_caller(run, stub):
+    pool = make_pool(stub)
+
+    async def scenario():
+        request = asyncio.create_task(pool.classify("image"))
+        await settle()
+        stub.batches[0][1].set_exception(ValueError("undecodable"))
+        with pytest.raises(ValueError):
+            await request
+
+    run(scenario())
+    assert pool.executor is stub
+    assert pool.pending == 0
+
+
+def test_full_batch_is_flushed_at_once(run, stub):
+    pool = make_pool(stub, batch_size=3, batch_wait_ms=10_000)
+
+    async def scenario():
+        requests = [asyncio.create_task(pool.classify(f"image-{i}")) for i in range(4)]
+        await settle()
+        # Three fill a batch; the fourth waits for the next one
+        [(images, future)] = stub.batches
+        assert images == ["image-0", "image-1", "image-2"]
+        assert [image for image, _ in pool.batch] == ["image-3"]
+        future.set_result(["male", "female", "male"])
+        results = await asyncio.gather(*requests[:3])
+        # A cancelled request is dropped when its batch is flushed
+        requests[3].cancel()
+        await settle()
+        pool._flush()
+        await settle()
+        return results
+
+    assert run(scenario()) == ["male", "female", "male"]
+    assert len(stub.batches) == 1
+    assert pool.pending == 0
+
+
+def test_partial_batch_is_flushed_by_the_timer(run, stub):
+    pool = make_pool(stub, batch_size=8, batch_wait_ms=20)
+
+    async def scenario():
+        requests = [asyncio.create_task(pool.classify(f"image-{i}")) for i in range(2)]
+        await settle()
+        assert stub.batches == []
+        await asyncio.sleep(0.05)
+        [(images, future)] = stub.batches
+        assert images == ["image-0", "image-1"]
+        future.set_result(["female", "male"])
+        return await asyncio.gather(*requests)
+
+    assert run(scenario()) == ["female", "male"]
+    assert pool._flush_timer is None
+
+
+def test_requests_that_gave_up_are_left_out_of_the_batch(run, stub):
+    pool = make_pool(stub, batch_size=8, batch_wait_ms=50, timeout=0.01)
+
+    async def scenario():
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.classify("abandoned")
+        await asyncio.sleep(0.1)
+
+    run(scenario())
+    assert stub.batches == []
+    assert pool.pending == 0
@@ -0,0 +1,97 @@
+"""MATCH_SCRIPT (run by fakeredis' Lua) and its in-process equivalent."""
+import time
+
+from app.services import queue
+from app.services.presence import presence_key
+
+FEMALE_ANY = queue._queue_key("female", "any")
+FEMALE_MALE = queue._queue_key("female", "male")
+# What a male looking for anyone may be matched with
+QUEUES = queue._compatible_queues("male", "any")
+
+
+async def match(backend, device_id):
+    """Partner found for device_id by MATCH_SCRIPT or _match_in_process, or None."""
+    if backend.scripted:
+        result = await backend.script(
+            queue.MATCH_SCRIPT,
+            keys=[*QUEUES, queue.WAIT_SAMPLES_KEY, queue.QUEUE_LEASES_KEY],
+            args=[device_id, queue.COOLDOWN_SECONDS, time.time(), queue.WAIT_SAMPLE_SIZE, 0,
+                  queue.MATCH_SCAN_CHUNK, queue.MATCH_SCAN_CHUNKS],
+        )
+    else:
+        result = await queue._match_in_process(QUEUES, device_id)
+    return result[0] if result else None
+
+
+async def queued(client, device_id, bucket):
+    return (
+        await client.zscore(bucket, device_id) is not None,
+        await client.zscore(queue.QUEUE_LEASES_KEY, device_id) is not None,
+    )
+
+
+def test_empty_queues_give_no_match(run, backend):
+    assert run(match(backend, "me")) is None
+
+
+def test_longest_waiter_across_buckets_wins(run, backend, enqueue):
+    client = backend.client
+    enqueue(client, "newer", FEMALE_ANY, 10)
+    enqueue(client, "older", FEMALE_MALE, 5)
+
+    assert run(match(backend, "me")) == "older"
+    assert run(client.get(queue.active_match_key("me"))) == "older"
+    assert run(client.get(queue.active_match_key("older"))) == "me"
+    assert run(queued(client, "older", FEMALE_MALE)) == (False, False)
+    assert run(queued(client, "newer", FEMALE_ANY)) == (True, True)
+    assert len(run(client.lrange(queue.WAIT_SAMPLES_KEY, 0, -1))) == 1
+
+
+def test_expired_and_already_matched_entries_are_dropped(run, backend, enqueue):
+    client = backend.client
+    enqueue(client, "expired", FEMALE_ANY, 1, lease=-5)
+    enqueue(client, "busy", FEMALE_ANY, 2, matched=True)
+    enqueue(client, "ready", FEMALE_ANY, 3)
+
+    assert run(match(backend, "me")) == "ready"
+    assert run(queued(client, "expired", FEMALE_ANY)) == (False, False)
+    assert run(queued(client, "busy", FEMALE_ANY)) == (False, False)
+
+
+def test_offline_members_keep_their_place(run, backend, enqueue):
+    client = backend.client
+    enqueue(client, "offline", FEMALE_ANY, 1, online=False)
+    enqueue(client, "online", FEMALE_ANY, 2)
+
+    assert run(match(backend, "me")) == "online"
+    assert run(queued(client, "offline", FEMALE_ANY)) == (True, True)
+    # Back online: first in line again
+    run(client.set(presence_key("offline"), 1))
+    assert run(match(backend, "me-too")) == "offline"
+
+
+def test_scan_walks_past_a_chunk_of_offline_members(run, backend, enqueue):
+    client = backend.client
+    for i in range(queue.MATCH_SCAN_CHUNK * 2 + 5):
+        enqueue(client, f"offline-{i}", FEMALE_ANY, i, online=False)
+    enqueue(client, "expired", FEMALE_ANY, 1000, lease=-5)
+    enqueue(client, "online", FEMALE_ANY, 1001)
+
+    assert run(match(backend, "me")) == "online"
+    assert run(client.zcard(FEMALE_ANY)) == queue.MATCH_SCAN_CHUNK * 2 + 5
+
+
+def test_scan_gives_up_after_a_fixed_number_of_chunks(run, backend, enqueue, monkeypatch):
+    client = backend.client
+    monkeypatch.setattr(queue, "MATCH_SCAN_CHUNK", 2)
+    monkeypatch.setattr(queue, "MATCH_SCAN_CHUNKS", 3)
+    for i in range(6):
+        enqueue(client, f"offline-{i}", FEMALE_ANY, i, online=False)
+    enqueue(client, "online", FEMALE_ANY, 100)
+
+    assert run(match(backend, "me")) is None
+    assert run(queued(client, "online", FEMALE_ANY)) == (True, True)
+    # Once compaction has cleared the dead entries the user is found
+    run(client.zrem(FEMALE_ANY, "offline-0"))
+    assert run(match(backend, "me")) == "online"
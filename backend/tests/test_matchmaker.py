@@ -0,0 +1,149 @@
+"""Batch matchmaker: in-process pairing and the script that commits it."""
+import itertools
+import random
+import time
+
+from app.db.redis import redis_client
+from app.services import queue
+from app.services.queue import ALL_QUEUES, _QUEUE_TYPES, _pair_waiting
+
+MALE_ANY = ALL_QUEUES.index(queue._queue_key("male", "any"))
+MALE_MALE = ALL_QUEUES.index(queue._queue_key("male", "male"))
+MALE_FEMALE = ALL_QUEUES.index(queue._queue_key("male", "female"))
+FEMALE_ANY = ALL_QUEUES.index(queue._queue_key("female", "any"))
+FEMALE_MALE = ALL_QUEUES.index(queue._queue_key("female", "male"))
+
+
+def compatible(index, other):
+    (gender, preference), (other_gender, other_preference) = _QUEUE_TYPES[index], _QUEUE_TYPES[other]
+    return preference in (other_gender, "any") and other_preference in (gender, "any")
+
+
+def test_longest_waiter_takes_the_longest_waiting_partner():
+    waiting = [
+        (1, "m-old", MALE_ANY),
+        (2, "f-old", FEMALE_ANY),
+        (3, "m-new", MALE_ANY),
+        (4, "f-new", FEMALE_MALE),
+    ]
+    assert _pair_waiting(waiting) == [
+        ("m-old", MALE_ANY, "f-old", FEMALE_ANY),
+        ("m-new", MALE_ANY, "f-new", FEMALE_MALE),
+    ]
+
+
+def test_incompatible_users_stay_unpaired():
+    waiting = [(1, "m", MALE_FEMALE), (2, "f", FEMALE_ANY), (3, "f2", FEMALE_MALE)]
+    assert _pair_waiting(waiting) == [("m", MALE_FEMALE, "f", FEMALE_ANY)]
+
+
+def test_a_device_in_two_buckets_is_not_paired_with_itself():
+    waiting = [(1, "d", MALE_ANY), (2, "d", MALE_MALE), (3, "m", MALE_ANY)]
+    assert _pair_waiting(waiting) == [("d", MALE_ANY, "m", MALE_ANY)]
+    assert _pair_waiting(waiting[:2]) == []
+
+
+def test_pairing_with_repeated_devices_uses_each_once():
+    rng = random.Random(11)
+    for _ in range(500):
+        waiting = sorted(
+            (rng.random(), f"d{rng.randrange(10)}", rng.randrange(len(ALL_QUEUES)))
+            for _ in range(rng.randint(0, 30))
+        )
+        entries = {(device_id, index) for _, device_id, index in waiting}
+        pairs = _pair_waiting(waiting)
+
+        paired = [device_id for pair in pairs for device_id in (pair[0], pair[2])]
+        assert len(paired) == len(set(paired))
+        for device_id, index, partner_id, partner_index in pairs:
+            assert {(device_id, index), (partner_id, partner_index)} <= entries
+            assert compatible(index, partner_index)
+
+
+def test_pairing_is_compatible_and_maximal():
+    rng = random.Random(7)
+    for _ in range(500):
+        waiting = sorted(
+            (rng.random(), f"d{i}", rng.randrange(len(ALL_QUEUES)))
+            for i in range(rng.randint(0, 30))
+        )
+        pairs = _pair_waiting(waiting)
+
+        paired = [device_id for pair in pairs for device_id in (pair[0], pair[2])]
+        assert len(paired) == len(set(paired))
+        bucket_of = {device_id: index for _, device_id, index in waiting}
+        for device_id, index, partner_id, partner_index in pairs:
+            assert (bucket_of[device_id], bucket_of[partner_id]) == (index, partner_index)
+            assert compatible(index, partner_index)
+        left = [(device_id, index) for _, device_id, index in waiting if device_id not in paired]
+        for (_, index), (_, other) in itertools.combinations(left, 2):
+            assert not compatible(index, other)
+
+
+async def apply(backend, pairs, now):
+    """(device_id, partner_id) pairs made by APPLY_PAIRS_SCRIPT or _apply_pairs_in_process."""
+    if not backend.scripted:
+        made = await queue._apply_pairs_in_process(pairs, now)
+        return [(device_id, partner_id) for device_id, partner_id, _, _ in made]
+    args = [now, queue.COOLDOWN_SECONDS, queue.WAIT_SAMPLE_SIZE, 0]
+    for device_id, index, partner_id, partner_index in pairs:
+        args += [device_id, index + 1, partner_id, partner_index + 1]
+    made = await backend.script(
+        queue.APPLY_PAIRS_SCRIPT,
+        keys=[*ALL_QUEUES, queue.WAIT_SAMPLES_KEY, queue.QUEUE_LEASES_KEY],
+        args=args,
+    )
+    return [tuple(made[i:i + 2]) for i in range(0, len(made), 4)]
+
+
+def test_apply_rechecks_every_pair(run, backend, enqueue):
+    client = backend.client
+    enqueue(client, "ready-m", ALL_QUEUES[MALE_ANY])
+    enqueue(client, "ready-f", ALL_QUEUES[FEMALE_ANY])
+    enqueue(client, "offline", ALL_QUEUES[MALE_ANY], online=False)
+    enqueue(client, "partner-1", ALL_QUEUES[FEMALE_ANY])
+    enqueue(client, "expired", ALL_QUEUES[FEMALE_ANY], lease=-5)
+    enqueue(client, "partner-2", ALL_QUEUES[MALE_ANY])
+
+    made = run(apply(backend, [
+        ("ready-m", MALE_ANY, "ready-f", FEMALE_ANY),
+        ("offline", MALE_ANY, "partner-1", FEMALE_ANY),
+        ("partner-2", MALE_ANY, "expired", FEMALE_ANY),
+        ("gone", MALE_ANY, "ready-f", FEMALE_ANY),
+    ], time.time()))
+
+    assert made == [("ready-m", "ready-f")]
+    assert run(client.get(queue.active_match_key("ready-f"))) == "ready-m"
+    assert len(run(client.lrange(queue.WAIT_SAMPLES_KEY, 0, -1))) == 2
+    # Offline users keep their entry; expired ones are dropped
+    assert run(client.zscore(ALL_QUEUES[MALE_ANY], "offline")) is not None
+    assert run(client.zscore(ALL_QUEUES[FEMALE_ANY], "expired")) is None
+    assert run(client.zscore(ALL_QUEUES[MALE_ANY], "partner-2")) is not None
+
+
+def test_apply_refuses_self_pairs(run, backend, enqueue):
+    client = backend.client
+    enqueue(client, "me", ALL_QUEUES[MALE_ANY])
+    enqueue(client, "me", ALL_QUEUES[MALE_MALE])
+
+    assert run(apply(backend, [("me", MALE_ANY, "me", MALE_MALE)], time.time())) == []
+    assert run(client.get(queue.active_match_key("me"))) is None
+
+
+def test_pass_does_not_match_a_device_queued_twice_with_itself(run, enqueue):
+    enqueue(redis_client, "me", ALL_QUEUES[MALE_ANY])
+    enqueue(redis_client, "me", ALL_QUEUES[MALE_MALE])
+
+    assert run(queue.match_waiting_users()) == []
+    assert run(redis_client.get(queue.active_match_key("me"))) is None
+
+
+def test_pass_pairs_everyone_compatible_and_counts_specific_filters(run, enqueue):
+    enqueue(redis_client, "m", ALL_QUEUES[MALE_FEMALE])
+    enqueue(redis_client, "f", ALL_QUEUES[FEMALE_ANY])
+    enqueue(redis_client, "lonely", ALL_QUEUES[FEMALE_MALE])
+
+    assert run(queue.match_waiting_users()) == [("m", "f")]
+    assert run(redis_client.get(queue.specific_limit_key("m"))) == "1"
+    assert run(redis_client.get(queue.specific_limit_key("f"))) is None
+    assert run(queue.get_queue_sizes())["female:male"] == 1
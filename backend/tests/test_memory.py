@@ -0,0 +1,174 @@
+"""Keyspace behaviour of the in-memory backend: expiry, eviction, types, pipelines."""
+import asyncio
+
+import pytest
+from redis.exceptions import ResponseError
+
+from app.db import memory
+from app.db.memory import InMemoryRedis, _Keyspace
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Manually advanced stand-in for the backend's monotonic clock."""
+    now = [1000.0]
+    monkeypatch.setattr(memory.time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def keyspace():
+    return _Keyspace(max_keys=100)
+
+
+def test_expired_keys_vanish_when_touched(keyspace, clock):
+    keyspace.set("k", "v", ex=10)
+    assert keyspace.ttl("k") == 10
+    clock[0] += 9.5
+    assert keyspace.get("k") == "v"
+    clock[0] += 0.5
+    assert keyspace.get("k") is None
+    assert keyspace.exists("k") == 0
+    assert keyspace.pttl("k") == -2
+    assert keyspace.dbsize() == 0
+
+
+def test_sweep_reclaims_expired_keys_without_reads(keyspace, clock):
+    for i in range(5):
+        keyspace.set(f"short-{i}", 1, ex=1)
+    keyspace.set("long", 1, ex=100)
+    keyspace.set("plain", 1)
+    clock[0] += 2
+
+    assert keyspace.sweep(limit=3) == 3
+    assert keyspace.sweep() == 2
+    assert keyspace.dbsize() == 2
+    assert keyspace.sweep() == 0
+
+
+def test_sweep_skips_deadlines_replaced_later(keyspace, clock):
+    keyspace.set("k", 1, ex=1)
+    keyspace.expire("k", 100)
+    keyspace.set("reset", 1, ex=1)
+    keyspace.set("reset", 2)
+    clock[0] += 2
+
+    assert keyspace.sweep() == 0
+    assert keyspace.get("k") == "1"
+    assert keyspace.get("reset") == "2"
+    assert keyspace.pttl("reset") == -1
+
+
+def test_incrby_keeps_the_ttl(keyspace, clock):
+    keyspace.set("counter", 1, ex=10)
+    assert keyspace.incrby("counter", 4) == 5
+    assert keyspace.incr("counter") == 6
+    assert keyspace.ttl("counter") == 10
+    clock[0] += 10
+    assert keyspace.incr("counter") == 1
+    assert keyspace.pttl("counter") == -1
+
+
+def test_incr_rejects_non_integers(keyspace):
+    keyspace.set("k", "abc")
+    with pytest.raises(ResponseError, match="not an integer"):
+        keyspace.incr("k")
+
+
+def test_least_recently_used_key_is_evicted(clock):
+    keyspace = _Keyspace(max_keys=3)
+    for key in ("a", "b", "c"):
+        keyspace.set(key, 1, ex=10)
+    keyspace.get("a")
+    keyspace.set("c", 2)  # overwriting never evicts
+    assert keyspace.dbsize() == 3
+
+    keyspace.set("d", 1)
+    assert keyspace.exists("a", "b", "c", "d") == 3
+    assert keyspace.get("b") is None
+    # The evicted key's deadline is gone with it
+    clock[0] += 20
+    assert keyspace.sweep() == 1
+
+
+def test_wrong_type_raises(keyspace):
+    keyspace.sadd("set", "x")
+    keyspace.set("string", 1)
+    with pytest.raises(ResponseError, match="WRONGTYPE"):
+        keyspace.get("set")
+    with pytest.raises(ResponseError, match="WRONGTYPE"):
+        keyspace.zadd("string", {"m": 1})
+    with pytest.raises(ResponseError, match="WRONGTYPE"):
+        keyspace.hget("set", "f")
+    # Generic commands work on any type
+    assert keyspace.delete("set", "string") == 2
+
+
+def test_mget_reads_other_types_as_nil(keyspace):
+    keyspace.set("a", 1)
+    keyspace.sadd("not-a-string", "x")
+    assert keyspace.mget(["a", "missing", "not-a-string"]) == ["1", None, None]
+
+
+def test_hyperloglog_counts_the_union(keyspace):
+    assert keyspace.pfadd("a", "x", "y") == 1
+    assert keyspace.pfadd("a", "x") == 0
+    keyspace.pfadd("b", "x", "z")
+    assert keyspace.pfcount("a", "b", "missing") == 3
+
+
+def test_set_px_and_nx(keyspace, clock):
+    assert keyspace.set("k", 1, px=1500)
+    assert keyspace.pttl("k") == 1500
+    assert keyspace.set("k", 2, nx=True) is None
+    clock[0] += 1.5
+    assert keyspace.set("k", 3, nx=True)
+    assert keyspace.get("k") == "3"
+
+
+def test_values_are_stored_as_strings(keyspace):
+    keyspace.set("int", 1)
+    keyspace.set("float", 0.5)
+    keyspace.hset("h", mapping={"n": 2})
+    assert keyspace.mget(["int", "float"]) == ["1", "0.5"]
+    assert keyspace.hgetall("h") == {"n": "2"}
+    with pytest.raises(ResponseError):
+        keyspace.set("bool", True)
+
+
+def test_pipeline_runs_nothing_until_execute(run):
+    client = InMemoryRedis()
+    pipe = client.pipeline()
+    pipe.set("a", 1).incr("a")
+    pipe.sadd("s", "x", "y")
+    pipe.get("a")
+    assert run(client.exists("a")) == 0
+
+    assert run(pipe.execute()) == [True, 2, 2, "2"]
+    assert run(pipe.execute()) == []
+
+
+def test_pipeline_runs_every_command_before_raising(run):
+    client = InMemoryRedis()
+    run(client.sadd("s", "x"))
+    pipe = client.pipeline()
+    pipe.set("a", 1)
+    pipe.get("s")
+    pipe.set("b", 1)
+    with pytest.raises(ResponseError, match="WRONGTYPE"):
+        run(pipe.execute())
+    assert run(client.exists("a", "b")) == 2
+
+
+def test_background_sweeper_reclaims_expired_keys(run):
+    client = InMemoryRedis(sweep_interval=0.01)
+
+    async def scenario():
+        client.start()
+        await client.set("k", 1, px=10)
+        await asyncio.sleep(0.1)
+        size = client.keyspace.dbsize()
+        await client.aclose()
+        return size
+
+    assert run(scenario()) == 0
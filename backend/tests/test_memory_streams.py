@@ -0,0 +1,56 @@
+"""Stream and consumer-group commands of the in-memory backend."""
+import time
+
+import pytest
+from redis.exceptions import ResponseError
+
+from app.db.memory import _Keyspace
+
+
+@pytest.fixture
+def keyspace():
+    return _Keyspace(max_keys=1000)
+
+
+def test_group_delivers_each_entry_once(keyspace):
+    keyspace.xgroup_create("s", "g", id="0", mkstream=True)
+    first = keyspace.xadd("s", {"n": 1})
+    second = keyspace.xadd("s", {"n": 2})
+
+    [(stream, entries)] = keyspace.xreadgroup("g", "c1", {"s": ">"}, count=10)
+    assert stream == "s"
+    assert entries == [(first, {"n": "1"}), (second, {"n": "2"})]
+    assert keyspace.xreadgroup("g", "c2", {"s": ">"}) == []
+
+
+def test_existing_group_is_busy(keyspace):
+    keyspace.xgroup_create("s", "g", mkstream=True)
+    with pytest.raises(ResponseError, match="BUSYGROUP"):
+        keyspace.xgroup_create("s", "g")
+
+
+def test_unknown_group_is_nogroup(keyspace):
+    keyspace.xadd("s", {"n": 1})
+    with pytest.raises(ResponseError, match="NOGROUP"):
+        keyspace.xreadgroup("missing", "c", {"s": ">"})
+
+
+def test_unacked_entries_are_claimed_after_idle_time(keyspace):
+    keyspace.xgroup_create("s", "g", id="0", mkstream=True)
+    acked = keyspace.xadd("s", {"n": 1})
+    pending = keyspace.xadd("s", {"n": 2})
+    keyspace.xreadgroup("g", "dead", {"s": ">"})
+    assert keyspace.xack("s", "g", acked) == 1
+
+    # Not idle long enough yet
+    assert keyspace.xautoclaim("s", "g", "alive", min_idle_time=60_000)[1] == []
+    time.sleep(0.02)
+    next_id, claimed = keyspace.xautoclaim("s", "g", "alive", min_idle_time=10)[:2]
+    assert claimed == [(pending, {"n": "2"})]
+    assert next_id == "0-0"
+
+
+def test_maxlen_trims_oldest_entries(keyspace):
+    for n in range(10):
+        keyspace.xadd("s", {"n": n}, maxlen=3, approximate=False)
+    assert keyspace.xlen("s") == 3
@@ -0,0 +1,36 @@
+"""Joining, re-joining and leaving the (gender, preference) buckets."""
+from app.db.redis import redis_client
+from app.services import queue
+
+MALE_ANY = queue._queue_key("male", "any")
+MALE_FEMALE = queue._queue_key("male", "female")
+
+
+def buckets_holding(run, device_id):
+    return [key for key in queue.ALL_QUEUES if run(redis_client.zscore(key, device_id)) is not None]
+
+
+def test_rejoining_keeps_the_original_join_time(run):
+    assert run(queue.join_queue("me", "any", gender="male"))
+    joined = run(redis_client.zscore(MALE_ANY, "me"))
+    run(queue.join_queue("me", "any", gender="male"))
+    assert run(redis_client.zscore(MALE_ANY, "me")) == joined
+
+
+def test_changing_preference_moves_the_user(run):
+    run(queue.join_queue("me", "any", gender="male"))
+    run(queue.join_queue("me", "female", gender="male"))
+    assert buckets_holding(run, "me") == [MALE_FEMALE]
+    assert run(queue.get_queue_wait_stats())["queued"] == 1
+
+
+def test_unverified_users_are_not_queued(run):
+    assert not run(queue.join_queue("me", "any", gender=None))
+    assert buckets_holding(run, "me") == []
+
+
+def test_leaving_clears_buckets_and_lease(run):
+    run(queue.join_queue("me", "any", gender="male"))
+    run(queue.leave_all_queues("me"))
+    assert buckets_holding(run, "me") == []
+    assert run(redis_client.zscore(queue.QUEUE_LEASES_KEY, "me")) is None
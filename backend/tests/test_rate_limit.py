@@ -0,0 +1,85 @@
+"""Token buckets: the shared script, its in-process twin and local leasing."""
+import pytest
+
+from app.db.redis import redis_client
+from app.services import rate_limit
+from app.services.rate_limit import RateLimit, RateLimiter, TAKE_TOKENS_SCRIPT, _take_in_process
+
+LIMIT = RateLimit("test", rate=2, burst=10)  # leases 2 tokens at a time
+
+
+@pytest.fixture
+def takes(monkeypatch):
+    """A fresh limiter whose trips to the shared bucket are recorded."""
+    limiter = RateLimiter()
+    calls = []
+    take = limiter._take
+
+    async def counting_take(limit, key, want):
+        calls.append(want)
+        return await take(limit, key, want)
+
+    monkeypatch.setattr(limiter, "_take", counting_take)
+    return limiter, calls
+
+
+def test_leased_tokens_are_spent_locally(run, takes):
+    limiter, calls = takes
+    for _ in range(4):
+        assert run(limiter.check(LIMIT, "me")) == (True, 0.0)
+    assert calls == [LIMIT.lease_size, LIMIT.lease_size]
+
+
+def test_denials_are_remembered_until_the_bucket_refills(run, takes, monkeypatch):
+    limiter, calls = takes
+    now = [1000.0]
+    monkeypatch.setattr(rate_limit.time, "monotonic", lambda: now[0])
+    for _ in range(LIMIT.burst):
+        assert run(limiter.check(LIMIT, "me"))[0]
+    trips = len(calls)
+
+    allowed, retry_after = run(limiter.check(LIMIT, "me"))
+    assert not allowed and retry_after > 0
+    assert not run(limiter.check(LIMIT, "me"))[0]
+    assert len(calls) == trips + 1
+
+    # Past the retry time the shared bucket is asked again
+    now[0] += retry_after
+    run(limiter.check(LIMIT, "me"))
+    assert len(calls) == trips + 2
+
+
+def test_keys_and_limits_have_separate_buckets(run):
+    limiter = RateLimiter()
+    for _ in range(LIMIT.burst):
+        run(limiter.check(LIMIT, "me"))
+    assert not run(limiter.check(LIMIT, "me"))[0]
+    assert run(limiter.check(LIMIT, "you"))[0]
+    assert run(limiter.check(RateLimit("other", rate=2, burst=10), "me"))[0]
+
+
+def test_fails_open_when_the_bucket_is_unreachable(run, monkeypatch):
+    limiter = RateLimiter()
+
+    async def broken(limit, key, want):
+        raise ConnectionError("down")
+
+    monkeypatch.setattr(limiter, "_take", broken)
+    assert run(limiter.check(LIMIT, "me")) == (True, 0.0)
+
+
+def test_in_process_take_matches_the_script(run, fake_redis):
+    script = fake_redis.register_script(TAKE_TOKENS_SCRIPT)
+    key = "ratelimit:test:me"
+    # (seconds since start, tokens wanted)
+    steps = [(0, 4), (0, 4), (0, 4), (0.25, 1), (0.5, 3), (1.2, 2), (30, 20)]
+    for offset, want in steps:
+        now = 1000.0 + offset
+        granted, retry_after = run(script(keys=[key], args=[LIMIT.rate, LIMIT.burst, now, want]))
+        expected = (int(granted), float(retry_after))
+        assert run(_take_in_process(LIMIT, key, now, want)) == pytest.approx(expected)
+
+        script_tokens = run(fake_redis.hget(key, "tokens"))
+        assert float(run(redis_client.hget(key, "tokens"))) == pytest.approx(float(script_tokens))
+        script_ttl = run(fake_redis.pttl(key))
+        assert run(redis_client.pttl(key)) == pytest.approx(script_ttl, abs=50)
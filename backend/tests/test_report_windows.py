@@ -0,0 +1,83 @@
+"""Distinct-reporter counting over rolling windows, and the auto-ban on top."""
+import time
+
+import pytest
+
+from app.db.redis import redis_client
+from app.services import moderation
+from app.services.moderation import (
+    BAN_INDEX_KEY,
+    REPORT_BUCKET_SECONDS,
+    REPORT_THRESHOLD,
+    REPORT_WINDOW_SECONDS,
+    get_report_count,
+    record_reports,
+)
+from app.services.moderation_worker import _ensure_group, process_reports
+
+
+pytestmark = pytest.mark.usefixtures("fresh_ban_cache")
+
+
+def test_repeat_reports_count_once(run):
+    now = time.time()
+    totals = run(record_reports([("target", "alice", now), ("target", "alice", now), ("target", "bob", now)]))
+    assert totals == {"target": 2}
+    assert run(get_report_count("target")) == 2
+
+
+def test_reports_in_earlier_buckets_still_count(run):
+    now = time.time()
+    run(record_reports([("target", "alice", now - 3 * REPORT_BUCKET_SECONDS)]))
+    assert run(record_reports([("target", "bob", now)])) == {"target": 2}
+
+
+def test_reports_older_than_the_window_are_ignored(run):
+    now = time.time()
+    assert run(record_reports([("target", "alice", now - 2 * REPORT_WINDOW_SECONDS)])) == {}
+    assert run(redis_client.keys_matching("reporters:*")) == []
+
+
+def test_reports_age_out_of_the_window(run, monkeypatch):
+    now = time.time()
+    run(record_reports([("target", "alice", now), ("target", "bob", now)]))
+    key = moderation._reporters_key("target", int(now // REPORT_BUCKET_SECONDS))
+    assert 0 < run(redis_client.ttl(key)) <= REPORT_WINDOW_SECONDS + REPORT_BUCKET_SECONDS
+
+    later = now + REPORT_WINDOW_SECONDS + REPORT_BUCKET_SECONDS
+    monkeypatch.setattr(moderation.time, "time", lambda: later)
+    assert run(get_report_count("target")) == 0
+
+
+def report(entry_id, reporter):
+    fields = {"reported": "target", "at": time.time()}
+    if reporter is not None:
+        fields["reporter"] = reporter
+    return f"{entry_id}-0", fields
+
+
+def test_entries_without_a_reporter_are_not_counted(run):
+    run(_ensure_group())
+
+    async def on_ban(device_id):
+        pass
+
+    run(process_reports([report(1, "alice"), report(2, None), report(3, "")], on_ban))
+    assert run(get_report_count("target")) == 1
+
+
+def test_threshold_bans_once(run):
+    run(_ensure_group())
+    notified = []
+
+    async def on_ban(device_id):
+        notified.append(device_id)
+
+    reporters = [f"reporter-{i}" for i in range(REPORT_THRESHOLD)]
+    assert run(process_reports([report(i, r) for i, r in enumerate(reporters)], on_ban)) == ["target"]
+    until = run(redis_client.zscore(BAN_INDEX_KEY, "target"))
+
+    # More reports, and a redelivered one, neither extend nor re-announce it
+    assert run(process_reports([report(10, "latecomer"), report(0, reporters[0])], on_ban)) == []
+    assert notified == ["target"]
+    assert run(redis_client.zscore(BAN_INDEX_KEY, "target")) == until
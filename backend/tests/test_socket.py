@@ -0,0 +1,115 @@
+"""The /ws relay, driven through Starlette's test client."""
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.db.redis import redis_client
+from app.services.queue import active_match_key
+from app.services.rate_limit import RateLimit, rate_limiter
+from app.ws import socket
+from app.ws.connection_manager import manager
+
+msgpack = pytest.importorskip("msgpack")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "leases", {})
+    monkeypatch.setattr(rate_limiter, "denied_until", {})
+    app = FastAPI()
+    app.include_router(socket.router)
+    with TestClient(app) as client:
+        yield client
+
+
+def pair(client, device_id, partner_id):
+    client.portal.call(redis_client.set, active_match_key(device_id), partner_id)
+    client.portal.call(redis_client.set, active_match_key(partner_id), device_id)
+
+
+def wait_until_gone(device_id):
+    deadline = time.monotonic() + 2
+    while device_id in manager.active_connections and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return device_id not in manager.active_connections
+
+
+def test_text_frame_on_a_msgpack_socket_is_plain_chat(client):
+    pair(client, "a", "b")
+    with client.websocket_connect("/ws?device_id=b") as b:
+        assert b.receive_json() == {"type": "matched", "partner_id": "a"}
+        with client.websocket_connect("/ws?device_id=a", subprotocols=["msgpack"]) as a:
+            assert msgpack.unpackb(a.receive_bytes()) == {"type": "matched", "partner_id": "b"}
+            a.send_text("hello")
+            assert b.receive_json() == {"type": "chat", "from": "a", "message": "hello"}
+            a.send_bytes(msgpack.packb({"type": "chat", "message": "hi", "id": 7}))
+            assert b.receive_json() == {"type": "chat", "from": "a", "message": "hi"}
+            assert msgpack.unpackb(a.receive_bytes()) == {"type": "delivery", "id": 7}
+
+
+def test_closing_the_socket_ends_the_match(client):
+    pair(client, "a", "b")
+    with client.websocket_connect("/ws?device_id=b") as b:
+        b.receive_json()
+        with client.websocket_connect("/ws?device_id=a") as a:
+            a.receive_json()
+        assert b.receive_json() == {"type": "ended", "reason": "disconnect"}
+        assert wait_until_gone("a")
+        assert client.portal.call(redis_client.get, active_match_key("b")) is None
+
+
+def test_an_error_in_the_loop_still_cleans_up(client, monkeypatch):
+    pair(client, "a", "b")
+    touch = manager.touch
+
+    def failing_touch(device_id):
+        if device_id == "a":
+            raise RuntimeError("boom")
+        touch(device_id)
+
+    monkeypatch.setattr(manager, "touch", failing_touch)
+    with client.websocket_connect("/ws?device_id=b") as b:
+        b.receive_json()
+        with pytest.raises(RuntimeError):
+            with client.websocket_connect("/ws?device_id=a") as a:
+                a.receive_json()
+                a.send_text("hello")
+                a.receive_json()
+        assert b.receive_json() == {"type": "ended", "reason": "disconnect"}
+        assert wait_until_gone("a")
+
+
+TOO_FAST = {"type": "error", "message": "You're sending messages too fast."}
+
+
+def test_throttled_chat_does_not_block_leaving(client, monkeypatch):
+    monkeypatch.setattr(socket, "WS_MESSAGE_LIMIT", RateLimit("ws", rate=0.01, burst=1))
+    pair(client, "a", "b")
+    with client.websocket_connect("/ws?device_id=b") as b:
+        b.receive_json()
+        with client.websocket_connect("/ws?device_id=a") as a:
+            a.receive_json()
+            a.send_json({"type": "chat", "message": "one"})
+            assert b.receive_json()["message"] == "one"
+            a.send_json({"type": "chat", "message": "two"})
+            a.send_json({"type": "chat", "message": "three"})
+            assert a.receive_json() == TOO_FAST
+            a.send_json({"type": "leave"})
+            assert a.receive_json() == {"type": "ended", "reason": "leave"}
+            assert b.receive_json() == {"type": "ended", "reason": "leave"}
+
+
+def test_control_frames_have_their_own_limit(client, monkeypatch):
+    monkeypatch.setattr(socket, "WS_CONTROL_LIMIT", RateLimit("ws_control", rate=0.01, burst=2))
+    with client.websocket_connect("/ws?device_id=a") as a:
+        unsupported = {"type": "error", "message": "Unsupported message type."}
+        for _ in range(5):
+            a.send_json({"type": "bogus"})
+        assert a.receive_json() == unsupported
+        assert a.receive_json() == unsupported
+        # Told once, then the rest are dropped without a reply
+        assert a.receive_json() == TOO_FAST
+        a.send_json({"type": "chat", "message": "still here"})
+        assert a.receive_json() == {"type": "system", "message": "No active match."}
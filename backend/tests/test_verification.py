@@ -0,0 +1,136 @@
+"""/verify endpoints, with the classifier pool replaced by a stub."""
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api import verification
+from app.services.classifier_pool import ClassifierBusy
+from app.services.user_store import get_gender
+
+DEVICE_ID = "device-0001"
+IMAGE = b"\xff\xd8" + b"x" * 200
+
+
+class StubPool:
+    def __init__(self, outcome="female"):
+        self.outcome = outcome
+        self.images = []
+
+    async def classify(self, image):
+        self.images.append(image)
+        if isinstance(self.outcome, BaseException):
+            raise self.outcome
+        return self.outcome
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = StubPool()
+    monkeypatch.setattr(verification, "classifier_pool", pool)
+    return pool
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.include_router(verification.router)
+    with TestClient(app) as client:
+        yield client
+
+
+def upload(client, body, **kwargs):
+    return client.post(f"/verify/gender/upload?device_id={DEVICE_ID}", content=body, **kwargs)
+
+
+def test_verified_gender_is_saved(client, pool):
+    response = upload(client, IMAGE, headers={"Content-Type": "image/jpeg"})
+    assert response.json() == {"status": "verified", "gender": "female"}
+    assert pool.images == [IMAGE]
+    assert client.portal.call(get_gender, DEVICE_ID) == "female"
+
+
+def test_busy_pool_asks_the_client_to_retry(client, pool):
+    pool.outcome = ClassifierBusy()
+    response = client.post("/verify/gender", json={"device_id": DEVICE_ID, "image_base64": "a" * 200})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_classifier_timeout_is_a_503(client, pool):
+    pool.outcome = asyncio.TimeoutError()
+    response = upload(client, IMAGE)
+    assert response.status_code == 503
+    assert client.portal.call(get_gender, DEVICE_ID) is None
+
+
+LIMIT = 1000
+MULTIPART_LIMIT = LIMIT + verification.MULTIPART_OVERHEAD_BYTES
+
+
+@pytest.fixture
+def small_limit(monkeypatch):
+    monkeypatch.setattr(verification, "VERIFY_MAX_UPLOAD_BYTES", LIMIT)
+
+
+def chunks(data, size=256):
+    """A body with no Content-Length, sent in pieces."""
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def multipart(image, boundary="b0undary"):
+    return (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="device_id"\r\n\r\n'
+        f"{DEVICE_ID}\r\n"
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="image"; filename="face.jpg"\r\n'
+        "Content-Type: image/jpeg\r\n\r\n"
+    ).encode() + image + f"\r\n--{boundary}--\r\n".encode()
+
+
+MULTIPART_TYPE = {"Content-Type": "multipart/form-data; boundary=b0undary"}
+
+
+def test_image_at_the_limit_is_accepted(client, pool, small_limit):
+    assert upload(client, b"x" * LIMIT).status_code == 200
+    response = client.post("/verify/gender/upload", content=multipart(b"x" * LIMIT), headers=MULTIPART_TYPE)
+    assert response.status_code == 200
+    assert len(pool.images) == 2
+
+
+def test_declared_length_over_the_limit_is_refused(client, pool, small_limit):
+    response = upload(client, b"x" * (LIMIT + 1))
+    assert response.status_code == 413
+    assert pool.images == []
+
+
+def test_streamed_body_is_cut_off_at_the_limit(client, pool, small_limit):
+    response = upload(client, chunks(b"x" * (LIMIT * 4)))
+    assert response.status_code == 413
+    assert pool.images == []
+
+
+def test_multipart_image_over_the_limit_is_refused(client, pool, small_limit):
+    response = client.post(
+        "/verify/gender/upload",
+        files={"image": ("face.jpg", b"x" * (LIMIT + 1), "image/jpeg")},
+        data={"device_id": DEVICE_ID},
+    )
+    assert response.status_code == 413
+    # Too big to even declare
+    response = client.post(
+        "/verify/gender/upload", content=multipart(b"x" * MULTIPART_LIMIT), headers=MULTIPART_TYPE
+    )
+    assert response.status_code == 413
+    assert pool.images == []
+
+
+def test_streamed_multipart_is_cut_off_at_the_limit(client, pool, small_limit):
+    response = client.post(
+        "/verify/gender/upload", content=chunks(multipart(b"x" * MULTIPART_LIMIT)), headers=MULTIPART_TYPE
+    )
+    assert response.status_code == 413
+    assert pool.images == []
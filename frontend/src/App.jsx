@@ -8,7 +8,7 @@ const API_BASE = "https://controlled-anon-chat.onrender.com";
 function App() {
   const deviceId = useMemo(() => getDeviceId(), []);
   const wsRef = useRef(null);
-  const pollingIntervalRef = useRef(null);
+  const nextMessageIdRef = useRef(1);
   const messagesEndRef = useRef(null);
 
   const [gender, setGender] = useState("");
@@ -64,11 +64,14 @@ function App() {
       });
   }, [deviceId]);
 
-  // WebSocket connection when partner is found
+  // WebSocket stays open from queueing through the chat, so the server can
+  // push the "matched" event instead of us polling for it
+  const wantSocket = matchStatus === "queued" || Boolean(partnerId);
+
   useEffect(() => {
-    if (!partnerId) return;
+    if (!wantSocket) return;
 
-    log("Connecting WebSocket to partner: " + partnerId.substring(0, 8) + "...");
+    log("Connecting WebSocket...");
     const socket = new WebSocket(
        `wss://controlled-anon-chat.onrender.com/ws?device_id=${deviceId}`
     );
@@ -79,9 +82,23 @@ function App() {
     };
 
     socket.onmessage = (event) => {
-      log("Received: " + event.data.substring(0, 50) + "...");
       try {
         const payload = JSON.parse(event.data);
+
+        // Server heartbeat; answering keeps the connection from being reaped
+        if (payload.type === "ping") {
+          socket.send(JSON.stringify({ type: "pong" }));
+          return;
+        }
+        log("Received: " + event.data.substring(0, 50) + "...");
+
+        if (payload.type === "matched") {
+          log("Match found: " + payload.partner_id.substring(0, 8) + "...");
+          setPartnerId(payload.partner_id);
+          setMatchStatus("matched");
+          setMessages([]);
+          return;
+        }
         
         if (payload.type === "chat") {
           log("Chat from " + payload.from.substring(0, 8) + ": " + payload.message);
@@ -93,7 +110,7 @@ function App() {
         }
         
         if (payload.type === "delivery") {
-          log("Delivery confirmed: " + payload.message);
+          log("Delivery confirmed: #" + payload.id);
           return;
         }
         
@@ -102,7 +119,8 @@ function App() {
           const reasonText = {
             "leave": "Partner left the chat",
             "next": "Partner moved to next chat",
-            "report": "Chat ended"
+            "report": "Chat ended",
+            "timeout": "Partner lost connection"
           }[payload.reason] || "Chat ended";
           
           setMessages((prev) => [...prev, { 
@@ -150,57 +168,62 @@ function App() {
         wsRef.current = null;
       }
     };
-  }, [partnerId, deviceId]);
+  }, [wantSocket, deviceId]);
 
-  // Poll for match status while queued
+  // Long-poll fallback while queued, only used when the socket is down
   useEffect(() => {
-    if (matchStatus !== "queued") {
-      if (pollingIntervalRef.current) {
-        clearInterval(pollingIntervalRef.current);
-        pollingIntervalRef.current = null;
-      }
-      return;
-    }
+    if (matchStatus !== "queued") return;
 
-    log("Starting polling for match...");
-    pollingIntervalRef.current = setInterval(async () => {
-      try {
-        const response = await fetch(`${API_BASE}/match/status`, {
-          method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify({ device_id: deviceId }),
-        });
-        const data = await response.json();
-        if (data.status === "matched") {
-          log("Match found: " + data.partner_id.substring(0, 8) + "...");
-          setPartnerId(data.partner_id);
-          setMatchStatus("matched");
-          setMessages([]);
+    let cancelled = false;
+    const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+    const waitForMatch = async () => {
+      while (!cancelled) {
+        if (wsRef.current && wsRef.current.readyState === WebSocket.OPEN) {
+          await sleep(1000);
+          continue;
+        }
+        try {
+          const response = await fetch(`${API_BASE}/match/status`, {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ device_id: deviceId, wait: 25 }),
+          });
+          const data = await response.json();
+          if (cancelled) return;
+          if (data.status === "matched") {
+            log("Match found: " + data.partner_id.substring(0, 8) + "...");
+            setPartnerId(data.partner_id);
+            setMatchStatus("matched");
+            setMessages([]);
+            return;
+          }
+        } catch (err) {
+          log("Poll error: " + err.message);
+          await sleep(3000);
         }
-      } catch (err) {
-        log("Poll error: " + err.message);
       }
-    }, 1500);
+    };
 
+    waitForMatch();
     return () => {
-      if (pollingIntervalRef.current) {
-        clearInterval(pollingIntervalRef.current);
-        pollingIntervalRef.current = null;
-      }
+      cancelled = true;
     };
   }, [matchStatus, deviceId]);
 
   const handleCapture = async (imageBase64) => {
     setError("");
     log("Sending image for verification...");
-    const response = await fetch(`${API_BASE}/verify/gender`, {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({
-        device_id: deviceId,
-        image_base64: imageBase64,
-      }),
-    });
+    // Send the JPEG bytes rather than the base64 data URL (~25% smaller)
+    const image = await (await fetch(imageBase64)).blob();
+    const response = await fetch(
+      `${API_BASE}/verify/gender/upload?device_id=${encodeURIComponent(deviceId)}`,
+      {
+        method: "POST",
+        headers: { "Content-Type": image.type || "image/jpeg" },
+        body: image,
+      }
+    );
 
     const data = await response.json();
     if (!response.ok) {
@@ -265,7 +288,7 @@ function App() {
       return;
     }
 
-    log("Queued, polling for match...");
+    log("Queued, waiting for match...");
     setMatchStatus("queued");
   };
 
@@ -292,7 +315,8 @@ function App() {
       return;
     }
     
-    wsRef.current.send(JSON.stringify({ type: "chat", message }));
+    const id = nextMessageIdRef.current++;
+    wsRef.current.send(JSON.stringify({ type: "chat", id, message }));
     setMessages((prev) => [...prev, { from: "me", message }]);
     setText("");
   };